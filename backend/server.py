@@ -1,26 +1,159 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Query
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne, monitoring
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
 import logging
-import requests
+import asyncio
+import bisect
+import functools
+import httpx
 import json
 import hashlib
+import heapq
+import itertools
 import secrets
+import socket
+import threading
+import time
+from collections import deque, OrderedDict
+from contextvars import ContextVar
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, NamedTuple, Tuple
 from datetime import datetime, timedelta
 import uuid
 import re
+import zlib
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics
+# Latency histograms exported in Prometheus text format at /api/metrics.
+# Counters are plain attributes. Histograms fed from the event loop need no
+# locks. The Mongo listener runs on Motor's executor threads, so its updates
+# and the creation of new children go through metrics_lock.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+metrics_lock = threading.Lock()
+
+class Histogram:
+    """Latency histogram with error counter and in-flight gauge"""
+    __slots__ = ("counts", "total", "count", "errors", "in_flight")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    def observe(self, seconds: float, failed: bool = False):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if failed:
+            self.errors += 1
+
+class MetricFamily:
+    """Histograms of one operation kind, one per label values"""
+
+    def __init__(self, name: str, description: str, labelnames: tuple):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.children: Dict[tuple, Histogram] = {}
+        metric_families.append(self)
+
+    def labels(self, *values: str) -> Histogram:
+        histogram = self.children.get(values)
+        if histogram is None:
+            with metrics_lock:
+                histogram = self.children.setdefault(values, Histogram())
+        return histogram
+
+    def render(self) -> List[str]:
+        base = self.name[:-len("_seconds")]
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        errors = [f"# TYPE {base}_errors_total counter"]
+        in_flight = [f"# TYPE {base}_in_flight gauge"]
+        for values, histogram in list(self.children.items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {histogram.total:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {histogram.count}")
+            errors.append(f"{base}_errors_total{{{labels}}} {histogram.errors}")
+            in_flight.append(f"{base}_in_flight{{{labels}}} {histogram.in_flight}")
+        return lines + errors + in_flight
+
+metric_families: List[MetricFamily] = []
+
+update_latency = MetricFamily("bot_update_seconds", "Telegram update processing time by update type", ("type",))
+handler_latency = MetricFamily("bot_handler_seconds", "Bot handler execution time", ("handler",))
+mongo_latency = MetricFamily("bot_mongo_seconds", "MongoDB command time", ("command", "collection"))
+http_latency = MetricFamily("bot_http_seconds", "Outbound HTTP request time, errors are transport failures and 4xx/5xx", ("service", "path"))
+callback_latency = MetricFamily("bot_callback_seconds", "Callback query handling time by route", ("route",))
+
+def instrumented(func):
+    """Record latency, raised errors and in-flight calls of an async handler"""
+    histogram = handler_latency.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        histogram.in_flight += 1
+        started_at = time.perf_counter()
+        failed = True
+        try:
+            result = await func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            histogram.in_flight -= 1
+            histogram.observe(time.perf_counter() - started_at, failed)
+    return wrapper
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Feeds every Mongo command into mongo_latency (called from driver threads)"""
+
+    def __init__(self):
+        self._pending: Dict[int, Histogram] = {}
+
+    def started(self, event):
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+        histogram = mongo_latency.labels(event.command_name, collection if isinstance(collection, str) else "")
+        with metrics_lock:
+            histogram.in_flight += 1
+            self._pending[event.request_id] = histogram
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+    def _finish(self, event, failed: bool):
+        with metrics_lock:
+            histogram = self._pending.pop(event.request_id, None)
+            if histogram is not None:
+                histogram.in_flight -= 1
+                histogram.observe(event.duration_micros / 1_000_000, failed)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()])
 db = client[os.environ['DB_NAME']]
 
 # API Configuration
@@ -34,6 +167,90 @@ ADMIN_USERNAME = os.environ['ADMIN_USERNAME']
 ADMIN_TELEGRAM_ID = int(os.environ['ADMIN_TELEGRAM_ID'])
 REQUIRED_CHANNEL = os.environ['REQUIRED_CHANNEL']
 BOT_USERNAME = os.environ.get('BOT_USERNAME', 'search1_test_bot')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+# Outbound HTTP configuration
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', '30'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', '10'))
+USERSBOX_TIMEOUT = float(os.environ.get('USERSBOX_TIMEOUT', '30'))
+CRYPTOBOT_TIMEOUT = float(os.environ.get('CRYPTOBOT_TIMEOUT', '30'))
+
+# Outbound Telegram dispatcher configuration
+TELEGRAM_SEND_WORKERS = int(os.environ.get('TELEGRAM_SEND_WORKERS', '16'))
+TELEGRAM_SEND_MAX_PENDING = int(os.environ.get('TELEGRAM_SEND_MAX_PENDING', '5000'))  # Предел очереди для массовых отправок
+TELEGRAM_RATE_PER_SECOND = float(os.environ.get('TELEGRAM_RATE_PER_SECOND', '30'))  # Общий лимит отправок бота
+TELEGRAM_CHAT_INTERVAL = float(os.environ.get('TELEGRAM_CHAT_INTERVAL', '0.25'))  # Пауза между отправками в один чат
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+TELEGRAM_RETRY_BACKOFF = float(os.environ.get('TELEGRAM_RETRY_BACKOFF', '1'))  # Для 5xx и сетевых ошибок, удваивается
+
+# Update processing configuration
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '16'))
+UPDATE_QUEUE_MAX_PENDING = int(os.environ.get('UPDATE_QUEUE_MAX_PENDING', '10000'))
+PROCESSED_UPDATES_TTL = int(os.environ.get('PROCESSED_UPDATES_TTL', '86400'))  # Сколько помним update_id
+PROCESSED_UPDATES_CACHE_SIZE = int(os.environ.get('PROCESSED_UPDATES_CACHE_SIZE', '100000'))
+PROCESSED_UPDATES_LEASE = int(os.environ.get('PROCESSED_UPDATES_LEASE', '300'))  # Секунд на обработку до перехвата
+PROCESSED_UPDATES_COMPLETE_ATTEMPTS = 4  # Попыток отметить обновление обработанным
+PROCESSED_UPDATES_COMPLETE_BACKOFF = 0.5  # Секунд перед второй попыткой, дальше вдвое больше
+
+# Cache configuration
+SUBSCRIPTION_CACHE_SIZE = int(os.environ.get('SUBSCRIPTION_CACHE_SIZE', '50000'))
+SUBSCRIPTION_CACHE_TTL = float(os.environ.get('SUBSCRIPTION_CACHE_TTL', '600'))
+SUBSCRIPTION_NEGATIVE_CACHE_TTL = float(os.environ.get('SUBSCRIPTION_NEGATIVE_CACHE_TTL', '30'))
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', '5000'))
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', '3600'))
+USER_STATE_CACHE_SIZE = int(os.environ.get('USER_STATE_CACHE_SIZE', '100000'))
+USER_STATE_CACHE_TTL = float(os.environ.get('USER_STATE_CACHE_TTL', '300'))
+USER_STATE_NEGATIVE_CACHE_TTL = float(os.environ.get('USER_STATE_NEGATIVE_CACHE_TTL', '2'))  # "Нет состояния" может устареть на другом воркере
+RENDERED_MESSAGES_CACHE_SIZE = int(os.environ.get('RENDERED_MESSAGES_CACHE_SIZE', '100000'))
+RENDERED_MESSAGES_CACHE_TTL = float(os.environ.get('RENDERED_MESSAGES_CACHE_TTL', '86400'))
+
+# User state configuration
+USER_STATE_BACKEND = os.environ.get('USER_STATE_BACKEND', 'mongo')  # "mongo", "memory"
+USER_STATE_TTL = int(os.environ.get('USER_STATE_TTL', '3600'))  # Незавершенный ввод сбрасывается через час
+
+# Statistics configuration
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', '10'))
+STATS_RECONCILE_INTERVAL = float(os.environ.get('STATS_RECONCILE_INTERVAL', '3600'))
+SUBSCRIPTION_EXPIRY_INTERVAL = float(os.environ.get('SUBSCRIPTION_EXPIRY_INTERVAL', '300'))
+
+# Multi-worker coordination
+WORKER_ID = os.environ.get('WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL = float(os.environ.get('LEASE_TTL', '30'))
+LEASE_RENEW_INTERVAL = float(os.environ.get('LEASE_RENEW_INTERVAL', '10'))
+CLUSTER_EVENTS_MODE = os.environ.get('CLUSTER_EVENTS_MODE', 'auto')  # "auto", "change_stream", "poll", "off"
+CLUSTER_EVENTS_POLL_INTERVAL = float(os.environ.get('CLUSTER_EVENTS_POLL_INTERVAL', '1'))
+CLUSTER_EVENTS_LOOKBACK = float(os.environ.get('CLUSTER_EVENTS_LOOKBACK', '10'))  # Запас на расхождение часов хостов
+CLUSTER_EVENTS_TTL = int(os.environ.get('CLUSTER_EVENTS_TTL', '3600'))
+
+# Broadcast configuration
+BROADCAST_RATE_PER_SECOND = float(os.environ.get('BROADCAST_RATE_PER_SECOND', '25'))
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', '100'))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', '10'))
+BROADCAST_RETRY_DELAY = float(os.environ.get('BROADCAST_RETRY_DELAY', '5'))  # Пауза перед повтором неотправленных, удваивается до минуты
+
+# Search payload storage
+SEARCH_PAYLOAD_RETENTION_DAYS = int(os.environ.get('SEARCH_PAYLOAD_RETENTION_DAYS', '30'))
+SEARCH_PAYLOAD_CODEC = os.environ.get('SEARCH_PAYLOAD_CODEC', 'zstd')  # "zstd", "zlib"
+
+# Search results formatting
+SEARCH_RESULT_MAX_SOURCES = int(os.environ.get('SEARCH_RESULT_MAX_SOURCES', '10'))
+SEARCH_RESULT_ITEMS_PER_SOURCE = int(os.environ.get('SEARCH_RESULT_ITEMS_PER_SOURCE', '3'))
+SEARCH_RESULT_MAX_MESSAGES = int(os.environ.get('SEARCH_RESULT_MAX_MESSAGES', '3'))  # Больше - отправляем файлом
+SEARCH_RESULT_VALUE_MAX_LENGTH = int(os.environ.get('SEARCH_RESULT_VALUE_MAX_LENGTH', '300'))
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Create the main app
 app = FastAPI(title="УЗРИ - Telegram Bot API")
@@ -55,10 +272,15 @@ class User(BaseModel):
     referred_by: Optional[int] = None
     referral_code: str
     total_referrals: int = 0
+    confirmed_referrals: int = 0
+    total_searches: int = 0
+    successful_searches: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_admin: bool = False
     last_active: datetime = Field(default_factory=datetime.utcnow)
     is_subscribed: bool = False
+    subscription_checked_at: Optional[datetime] = None  # Когда последний раз проверяли подписку на канал
+    is_blocked: bool = False  # Пользователь заблокировал бота (403 при рассылке)
 
 class Subscription(BaseModel):
     user_id: int
@@ -73,14 +295,16 @@ class Payment(BaseModel):
     amount: float
     payment_type: str  # "crypto", "stars", "admin"
     payment_id: Optional[str] = None
-    status: str = "pending"  # "pending", "completed", "failed"
+    status: str = "pending"  # "pending", "crediting", "completed", "failed"
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class Search(BaseModel):
     user_id: int
     query: str
+    normalized_query: Optional[str] = None  # Ключ кэша результатов
     search_type: str
-    results: Dict[str, Any]
+    results_ref: Optional[str] = None  # _id ответа usersbox в search_payloads
+    results_count: int = 0
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     cost: float = 25.0
     success: bool = True
@@ -92,181 +316,1112 @@ class UserState(BaseModel):
     data: Optional[Dict[str, Any]] = None  # дополнительные данные
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class BroadcastJob(BaseModel):
+    job_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    admin_id: int
+    chat_id: int
+    text: str
+    status: str = "running"  # "running", "completed", "failed"
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    last_user_id: Optional[Any] = None  # _id последнего обработанного пользователя
+    progress_message_id: Optional[int] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
 class Referral(BaseModel):
     referrer_id: int
     referred_id: int
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     confirmed: bool = False  # Подтвержден ли реферал (подписался ли на канал)
 
+# MongoDB indexes
+# (collection, keys, options) - created idempotently on startup
+MONGO_INDEXES = [
+    ("users", [("telegram_id", ASCENDING)], {"unique": True}),
+    ("users", [("referral_code", ASCENDING)], {"unique": True}),
+    ("users", [("subscription_expires", ASCENDING)], {}),
+    ("users", [("last_active", ASCENDING)], {}),
+    ("searches", [("user_id", ASCENDING), ("success", ASCENDING)], {}),
+    ("searches", [("normalized_query", ASCENDING), ("success", ASCENDING), ("timestamp", DESCENDING)], {}),
+    ("search_payloads", [("last_used_at", ASCENDING)], {"expireAfterSeconds": SEARCH_PAYLOAD_RETENTION_DAYS * 86400}),
+    ("referrals", [("referrer_id", ASCENDING), ("referred_id", ASCENDING)], {"unique": True}),
+    ("referrals", [("referrer_id", ASCENDING), ("confirmed", ASCENDING)], {}),
+    ("referrals", [("referred_id", ASCENDING), ("confirmed", ASCENDING)], {}),
+    ("user_states", [("user_id", ASCENDING)], {"unique": True}),
+    ("user_states", [("created_at", ASCENDING)], {"expireAfterSeconds": USER_STATE_TTL}),
+    ("payments", [("payment_id", ASCENDING)], {"unique": True, "partialFilterExpression": {"payment_id": {"$type": "string"}}}),
+    ("processed_updates", [("created_at", ASCENDING)], {"expireAfterSeconds": PROCESSED_UPDATES_TTL}),
+    ("broadcast_jobs", [("job_id", ASCENDING)], {"unique": True}),
+    ("broadcast_jobs", [("status", ASCENDING)], {}),
+    ("cluster_events", [("created_at", ASCENDING)], {"expireAfterSeconds": CLUSTER_EVENTS_TTL}),
+]
+
+# Query shapes used by the bot: (collection, operation, filter, sort)
+QUERY_SHAPES = [
+    ("users", "find", {"telegram_id": 0}, None),
+    ("users", "find", {"referral_code": ""}, None),
+    ("users", "count", {"subscription_expires": {"$gt": datetime(2000, 1, 1)}}, None),
+    ("users", "count", {"subscription_expires": {"$lte": datetime(2000, 1, 1)}, "subscription_type": {"$ne": None}}, None),
+    ("users", "find", {"telegram_id": {"$ne": 0}, "is_blocked": {"$ne": True}, "_id": {"$gt": ObjectId("0" * 24)}}, {"_id": 1}),
+    ("users", "find", {"_id": {"$gt": ObjectId("0" * 24)}, "last_active": {"$gte": datetime(2000, 1, 1)}}, {"_id": 1}),
+    ("searches", "find", {"normalized_query": "", "success": True, "timestamp": {"$gt": datetime(2000, 1, 1)}}, {"timestamp": -1}),
+    ("search_payloads", "find", {"_id": ""}, None),
+    ("referrals", "find", {"referrer_id": 0, "referred_id": 0}, None),
+    ("referrals", "find", {"referred_id": 0, "confirmed": False}, None),
+    ("user_states", "find", {"user_id": 0}, None),
+    ("stats", "find", {"_id": ""}, None),
+    ("stats", "find", {"_id": {"$gte": "daily:", "$lte": "daily:~"}}, {"_id": 1}),
+    ("payments", "find", {"payment_id": ""}, None),
+    ("broadcast_jobs", "find", {"job_id": ""}, None),
+    ("broadcast_jobs", "find", {"status": "running"}, None),
+    ("leases", "find", {"_id": ""}, None),
+    ("cluster_events", "find", {"_id": {"$gt": ObjectId("0" * 24)}}, {"_id": 1}),
+]
+
+async def ensure_indexes():
+    """Create all indexes used by the bot (safe to run repeatedly)"""
+    for collection, keys, options in MONGO_INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            if e.code in (85, 86):  # IndexOptionsConflict / IndexKeySpecsConflict
+                # Index exists with other options - recreate with the current definition
+                name = "_".join(f"{field}_{direction}" for field, direction in keys)
+                logging.warning(f"Recreating index {collection}.{name}: {e}")
+                await db[collection].drop_index(name)
+                try:
+                    await db[collection].create_index(keys, **options)
+                except OperationFailure as e:
+                    # Например, дубликаты в данных для уникального индекса
+                    logging.error(f"Failed to recreate index {collection}.{name}: {e}")
+            else:
+                logging.error(f"Failed to create index {collection}.{keys}: {e}")
+
+def collect_plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """Collect stage names from an explain() plan tree"""
+    stages = []
+    if not isinstance(plan, dict):
+        return stages
+    if 'stage' in plan:
+        stages.append(plan['stage'])
+    for key in ('inputStage', 'queryPlan', 'winningPlan'):
+        if key in plan:
+            stages.extend(collect_plan_stages(plan[key]))
+    for child in plan.get('inputStages', []):
+        stages.extend(collect_plan_stages(child))
+    return stages
+
+async def audit_query_plans() -> List[Dict[str, Any]]:
+    """Run explain() for every query shape and flag collection scans"""
+    report = []
+    for collection, operation, query_filter, sort in QUERY_SHAPES:
+        if operation == "count":
+            command = {"count": collection, "query": query_filter}
+        else:
+            command = {"find": collection, "filter": query_filter}
+            if sort:
+                command["sort"] = sort
+        explain = await db.command("explain", command, verbosity="queryPlanner")
+        stages = collect_plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))
+        report.append({
+            "collection": collection,
+            "operation": operation,
+            "filter": query_filter,
+            "sort": sort,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    return report
+
+# Outbound HTTP clients
+# One long-lived AsyncClient per upstream service, so every host keeps its own
+# keep-alive pool and the event loop is never blocked by outbound calls.
+HTTP_SERVICES = {
+    "telegram": {
+        "base_url": f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}",
+        "timeout": TELEGRAM_TIMEOUT,
+        "headers": {},
+    },
+    "usersbox": {
+        "base_url": USERSBOX_BASE_URL,
+        "timeout": USERSBOX_TIMEOUT,
+        "headers": {"Authorization": USERSBOX_TOKEN},
+    },
+    "cryptobot": {
+        "base_url": CRYPTOBOT_BASE_URL,
+        "timeout": CRYPTOBOT_TIMEOUT,
+        "headers": {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN},
+    },
+}
+
+http_clients: Dict[str, httpx.AsyncClient] = {}
+
+def get_http_client(service: str) -> httpx.AsyncClient:
+    """Get (or lazily create) the shared HTTP client for a service"""
+    http_client = http_clients.get(service)
+    if http_client is None or http_client.is_closed:
+        config = HTTP_SERVICES[service]
+        http_client = httpx.AsyncClient(
+            base_url=config["base_url"],
+            headers=config["headers"],
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(config["timeout"], connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            )
+        )
+        http_clients[service] = http_client
+    return http_client
+
+async def init_http_clients():
+    """Create HTTP clients for all upstream services"""
+    for service in HTTP_SERVICES:
+        get_http_client(service)
+    logging.info(f"HTTP clients ready: {', '.join(HTTP_SERVICES)} (http2={HTTP2_AVAILABLE})")
+
+async def close_http_clients():
+    """Close all HTTP clients and their connection pools"""
+    for http_client in http_clients.values():
+        await http_client.aclose()
+    http_clients.clear()
+
+async def http_request(service: str, method: str, path: str, **kwargs) -> httpx.Response:
+    """Perform a request through the shared client of a service"""
+    histogram = http_latency.labels(service, path)
+    histogram.in_flight += 1
+    started_at = time.perf_counter()
+    failed = True
+    try:
+        response = await get_http_client(service).request(method, path, **kwargs)
+        failed = response.status_code >= 400
+        return response
+    finally:
+        histogram.in_flight -= 1
+        histogram.observe(time.perf_counter() - started_at, failed)
+
+class TokenBucket:
+    """Async token bucket rate limiter"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1.0):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+# Outbound Telegram requests
+PRIORITY_INTERACTIVE = 0  # Ответы пользователям
+PRIORITY_BULK = 1  # Рассылки
+TELEGRAM_PRIORITIES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+# Methods that deliver something to a chat and count against Telegram flood limits
+TELEGRAM_SEND_METHODS = frozenset({
+    "sendMessage", "sendDocument", "sendPhoto", "sendInvoice",
+    "editMessageText", "editMessageReplyMarkup", "copyMessage", "forwardMessage"
+})
+TELEGRAM_CHAT_SPACING_LIMIT = 10000  # Сколько чатов помним до очистки устаревших
+
+def telegram_error(description: str, error_code: int = 0) -> Dict[str, Any]:
+    return {"ok": False, "error_code": error_code, "description": description}
+
+class TelegramCall:
+    """One outbound Bot API call waiting in the dispatcher"""
+    __slots__ = ("method", "kwargs", "chat_id", "priority", "sequence", "attempts", "future")
+
+    def __init__(self, method: str, kwargs: Dict[str, Any], chat_id: Any, priority: int, sequence: int):
+        self.method = method
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.priority = priority
+        self.sequence = sequence
+        self.attempts = 0
+        self.future: Optional[asyncio.Future] = None
+
+    def __lt__(self, other: "TelegramCall") -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+class TelegramDispatcher:
+    """Outbound Telegram Bot API calls with flood control.
+
+    Send methods are queued by priority and pass a global token bucket and
+    per-chat spacing; a worker takes a token before picking the next call, so
+    interactive replies overtake bulk traffic that is still waiting. 429 and
+    5xx responses are retried after retry_after (or a backoff) without holding
+    a worker. At most max_pending bulk calls are outstanding; further bulk
+    senders wait for a slot. Other methods and calls made before start() run
+    inline with the same limits and retries.
+    """
+
+    def __init__(self, workers: int, max_pending: int, rate: float, chat_interval: float, max_retries: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+        self.pending = dict.fromkeys(TELEGRAM_PRIORITIES, 0)
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = dict.fromkeys(("429", "5xx", "network"), 0)
+        self.dropped = dict.fromkeys(("retries", "shutdown"), 0)
+        self.bulk_waiting = 0
+        self._sequence = itertools.count()
+        self._heap: List[TelegramCall] = []
+        self._available: Optional[asyncio.Semaphore] = None
+        self._bulk_slots: Optional[asyncio.Semaphore] = None
+        self._retrying: Dict[TelegramCall, asyncio.TimerHandle] = {}
+        self._chat_next: Dict[Any, float] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        """Start worker tasks"""
+        if self.running:
+            return
+        self._available = asyncio.Semaphore(0)
+        self._bulk_slots = asyncio.Semaphore(self.max_pending)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Telegram dispatcher started with {self.workers} workers")
+
+    async def stop(self, timeout: float = 10.0):
+        """Wait for queued calls (up to timeout), then fail the rest and stop workers"""
+        deadline = time.monotonic() + timeout
+        while (self._heap or self._retrying or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for handle in self._retrying.values():
+            handle.cancel()
+        abandoned = self._heap + list(self._retrying)
+        self._heap, self._retrying = [], {}
+        self.pending = dict.fromkeys(TELEGRAM_PRIORITIES, 0)
+        for call in abandoned:
+            self.dropped["shutdown"] += 1
+            self._resolve(call, telegram_error("Dispatcher stopped"))
+        if abandoned:
+            logging.warning(f"Telegram dispatcher stopped with {len(abandoned)} unsent calls")
+
+    async def call(self, method: str, kwargs: Dict[str, Any], chat_id: Any = None, priority: int = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+        """Perform a Bot API call, returns decoded response"""
+        call = TelegramCall(method, kwargs, chat_id, priority, next(self._sequence))
+        if method not in TELEGRAM_SEND_METHODS or not self.running:
+            return await self._call_inline(call)
+        if priority == PRIORITY_INTERACTIVE:
+            # Интерактивные ответы не ждут: их число ограничено воркерами обновлений
+            return await self._enqueue(call)
+        # Массовые отправки ждут места в очереди, а не теряются
+        self.bulk_waiting += 1
+        try:
+            await self._bulk_slots.acquire()
+        finally:
+            self.bulk_waiting -= 1
+        try:
+            return await self._enqueue(call)
+        finally:
+            self._bulk_slots.release()
+
+    async def _enqueue(self, call: TelegramCall) -> Dict[str, Any]:
+        if not self.running:
+            # Диспетчер остановили, пока вызов ждал места
+            self.dropped["shutdown"] += 1
+            return telegram_error("Dispatcher stopped")
+        call.future = asyncio.get_running_loop().create_future()
+        self._put(call)
+        return await call.future
+
+    @property
+    def queued(self) -> int:
+        return len(self._heap) + len(self._retrying)
+
+    def _put(self, call: TelegramCall):
+        heapq.heappush(self._heap, call)
+        self.pending[call.priority] += 1
+        self._available.release()
+
+    def _requeue(self, call: TelegramCall):
+        del self._retrying[call]
+        self._put(call)
+
+    def _resolve(self, call: TelegramCall, result: Dict[str, Any]):
+        if not call.future.done():
+            call.future.set_result(result)
+
+    async def _call_inline(self, call: TelegramCall) -> Dict[str, Any]:
+        while True:
+            if call.method in TELEGRAM_SEND_METHODS:
+                await self.bucket.acquire()
+                await self._wait_for_chat(call.chat_id)
+            result, retry_in = await self._attempt(call)
+            if retry_in is None:
+                return result
+            await asyncio.sleep(retry_in)
+
+    async def _worker(self):
+        while True:
+            # Token first: the call is picked only when it can be sent, so it is the most urgent one
+            await self._available.acquire()
+            await self.bucket.acquire()
+            call = heapq.heappop(self._heap)
+            self.pending[call.priority] -= 1
+            if call.future.done():
+                continue  # Вызывающий уже не ждет ответа
+            self.in_flight += 1
+            try:
+                await self._wait_for_chat(call.chat_id)
+                result, retry_in = await self._attempt(call)
+            except asyncio.CancelledError:
+                self.dropped["shutdown"] += 1
+                self._resolve(call, telegram_error("Dispatcher stopped"))
+                raise
+            finally:
+                self.in_flight -= 1
+            if retry_in is None:
+                self._resolve(call, result)
+            else:
+                self._retrying[call] = asyncio.get_running_loop().call_later(retry_in, self._requeue, call)
+
+    async def _wait_for_chat(self, chat_id: Any):
+        """Reserve the next send slot of a chat and wait for it"""
+        if chat_id is None or not self.chat_interval:
+            return
+        now = time.monotonic()
+        ready_at = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = ready_at + self.chat_interval
+        if len(self._chat_next) > TELEGRAM_CHAT_SPACING_LIMIT:
+            self._chat_next = {key: next_at for key, next_at in self._chat_next.items() if next_at > now}
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+
+    async def _attempt(self, call: TelegramCall):
+        """Send once. Returns (result, None) when done or (result, delay) to retry"""
+        call.attempts += 1
+        try:
+            response = await http_request("telegram", "POST", f"/{call.method}", **call.kwargs)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            # Запрос не ушел в Telegram - повтор не создаст дубль
+            result, reason = telegram_error(str(e)), "network"
+        except Exception as e:
+            logging.error(f"Telegram API error ({call.method}): {e}")
+            return self._record(telegram_error(str(e))), None
+        else:
+            try:
+                result = response.json()
+            except ValueError:
+                result = telegram_error(response.text, response.status_code)
+            if response.status_code == 429:
+                reason = "429"
+            elif response.status_code >= 500:
+                reason = "5xx"
+            else:
+                return self._record(result), None
+        
+        if call.attempts > self.max_retries:
+            self.dropped["retries"] += 1
+            logging.error(f"Telegram API error ({call.method}): giving up after {call.attempts} attempts: {result.get('description')}")
+            return self._record(result), None
+        self.retries[reason] += 1
+        if reason == "429":
+            retry_in = float(result.get('parameters', {}).get('retry_after', 1))
+            # Следующие сообщения в этот чат тоже ждут окончания блокировки
+            if call.chat_id is not None:
+                self._chat_next[call.chat_id] = max(self._chat_next.get(call.chat_id, 0.0), time.monotonic() + retry_in)
+        else:
+            retry_in = TELEGRAM_RETRY_BACKOFF * 2 ** (call.attempts - 1)
+        logging.warning(f"Telegram API {call.method} failed ({reason}), retry in {retry_in}s")
+        return result, retry_in
+
+    def _record(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        if result.get('ok'):
+            self.sent += 1
+        else:
+            self.failed += 1
+        return result
+
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth, outcome and drop counters"""
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "pending": {TELEGRAM_PRIORITIES[priority]: count for priority, count in self.pending.items()},
+            "retrying": len(self._retrying),
+            "bulk_waiting": self.bulk_waiting,
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": dict(self.retries),
+            "dropped": dict(self.dropped)
+        }
+
+telegram_dispatcher = TelegramDispatcher(
+    TELEGRAM_SEND_WORKERS, TELEGRAM_SEND_MAX_PENDING, TELEGRAM_RATE_PER_SECOND, TELEGRAM_CHAT_INTERVAL, TELEGRAM_MAX_RETRIES
+)
+
+async def telegram_request(method: str, payload: Dict[str, Any] = None, timeout: float = None,
+                           priority: int = PRIORITY_INTERACTIVE, files: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Call Telegram Bot API method through the dispatcher. Returns decoded response, errors as {"ok": False, ...}"""
+    payload = payload or {}
+    if files:
+        # Поля формы - строки; вложенные объекты (reply_markup и т.п.) передаются JSON-ом
+        fields = {key: value if isinstance(value, str) else json_encode(value) for key, value in payload.items()}
+        kwargs = {"data": fields, "files": files}
+    else:
+        kwargs = {"content": render_json(payload), "headers": {"Content-Type": "application/json"}}
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    return await telegram_dispatcher.call(method, kwargs, payload.get("chat_id"), priority)
+
+detached_tasks: set = set()
+
+def run_detached(coro) -> asyncio.Task:
+    """Run a coroutine without awaiting it, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+    return task
+
+# Caches
+CACHE_MISS = object()
+
+class TTLCache:
+    """Size-bounded LRU cache with per-entry expiry"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict = OrderedDict()
+        caches[name] = self
+
+    def get(self, key: Any, default: Any = CACHE_MISS) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Any, value: Any, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Any):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions
+        }
+
+caches: Dict[str, TTLCache] = {}
+
+subscription_cache = TTLCache("subscription", SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)
+subscription_check_stats = {"upstream_checks": 0, "upstream_time": 0.0, "stored_hits": 0}
+
+search_cache = TTLCache("search", SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+search_cache_stats = {"coalesced": 0, "stored_hits": 0, "upstream_searches": 0}
+search_inflight: Dict[str, asyncio.Future] = {}
+
 # Helper Functions
 def generate_referral_code(telegram_id: int) -> str:
     """Generate unique referral code"""
     data = f"{telegram_id}_{secrets.token_hex(8)}"
     return hashlib.md5(data.encode()).hexdigest()[:8]
 
+# Search type classification
+# Ordered rule table: the first rule whose matcher accepts the query defines its
+# type and normalized form (used as cache key). Patterns are compiled once.
+PHONE_SEPARATORS = str.maketrans('', '', ' -()')
+PHONE_RE = re.compile(r'^\+?\d{10,15}$')
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+CAR_NUMBER_RE = re.compile(r'^[АВЕКМНОРСТУХ]\d{3}[АВЕКМНОРСТУХ]{2}\d{2,3}$')
+NICKNAME_RE = re.compile(r'^[a-zA-Z0-9_]+$')
+IP_RE = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+WORD_RE = re.compile(r'[а-яёa-z]+')
+NAME_WORD_RE = re.compile(r'^[а-яА-ЯёЁa-zA-Z]+$')
+ADDRESS_KEYWORDS = frozenset(['улица', 'ул', 'проспект', 'пр', 'переулок', 'пер', 'дом', 'д', 'квартира', 'кв'])
+
+class SearchQuery(NamedTuple):
+    search_type: str
+    normalized: str
+
+class SearchTypeRule(NamedTuple):
+    search_type: str
+    match: Callable[[str, str], bool]  # (text, compact) -> bool
+    normalize: Callable[[str, str], str]  # (text, compact) -> normalized query
+
+def is_address(text: str) -> bool:
+    """Address keywords are matched as whole words ("д" must not match any text with "д")"""
+    return not ADDRESS_KEYWORDS.isdisjoint(WORD_RE.findall(text.lower()))
+
+def is_full_name(text: str) -> bool:
+    words = text.split(' ')
+    return 2 <= len(words) <= 3 and all(NAME_WORD_RE.match(word) for word in words)
+
+SEARCH_TYPE_RULES: List[SearchTypeRule] = [
+    SearchTypeRule("📱 Телефон", lambda text, compact: PHONE_RE.match(compact) is not None, lambda text, compact: compact),
+    SearchTypeRule("📧 Email", lambda text, compact: EMAIL_RE.match(text) is not None, lambda text, compact: text.lower()),
+    SearchTypeRule("🚗 Автомобиль", lambda text, compact: CAR_NUMBER_RE.match(text.upper().replace(' ', '')) is not None, lambda text, compact: text.upper().replace(' ', '')),
+    SearchTypeRule("🆔 Никнейм", lambda text, compact: text.startswith('@') or NICKNAME_RE.match(text) is not None, lambda text, compact: text.lower()),
+    SearchTypeRule("🌐 IP-адрес", lambda text, compact: IP_RE.match(text) is not None, lambda text, compact: text),
+    SearchTypeRule("🏠 Адрес", lambda text, compact: is_address(text), lambda text, compact: text.lower()),
+    SearchTypeRule("👤 ФИО", lambda text, compact: is_full_name(text), lambda text, compact: text.lower()),
+]
+DEFAULT_SEARCH_TYPE = "🔍 Общий поиск"
+
+def classify_search_query(query: str) -> SearchQuery:
+    """Detect search type and normalized query in a single pass"""
+    text = ' '.join(query.split())
+    compact = text.translate(PHONE_SEPARATORS)
+    for rule in SEARCH_TYPE_RULES:
+        if rule.match(text, compact):
+            return SearchQuery(rule.search_type, rule.normalize(text, compact))
+    return SearchQuery(DEFAULT_SEARCH_TYPE, text.lower())
+
+def normalize_search_query(query: str) -> str:
+    """Normalize search query so equivalent queries share one cache key"""
+    return classify_search_query(query).normalized
+
 def detect_search_type(query: str) -> str:
     """Detect search type based on query pattern"""
-    query = query.strip()
-    
-    phone_patterns = [
-        r'^\+?[7-8]\d{10}$',
-        r'^\+?\d{10,15}$',
-        r'^[7-8]\(\d{3}\)\d{3}-?\d{2}-?\d{2}$'
+    return classify_search_query(query).search_type
+
+# Message templates
+# Static keyboards are serialized once and spliced into request bodies as is,
+# static texts are built once at import. Handlers only interpolate per-user fields.
+class RawJSON(str):
+    """Pre-serialized JSON value, inserted into Telegram request bodies as is"""
+
+def prerender_markup(markup: Dict[str, Any]) -> RawJSON:
+    """Serialize reply markup once"""
+    return RawJSON(json.dumps(markup, ensure_ascii=False, separators=(',', ':')))
+
+json_encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+def render_json(payload: Dict[str, Any]) -> bytes:
+    """Serialize request body (plain string keys), keeping pre-serialized values untouched"""
+    return ("{" + ",".join(
+        f'"{key}":{value if value.__class__ is RawJSON else json_encode(value)}'
+        for key, value in payload.items()
+    ) + "}").encode()
+
+CRYPTO_NAMES = {
+    "btc": "Bitcoin (BTC)",
+    "eth": "Ethereum (ETH)",
+    "usdt": "USDT",
+    "ltc": "Litecoin (LTC)"
+}
+
+MAIN_MENU_ROWS = [
+    [
+        {"text": "🔍 Поиск", "callback_data": "menu_search"},
+        {"text": "👤 Профиль", "callback_data": "menu_profile"}
+    ],
+    [
+        {"text": "💰 Баланс", "callback_data": "menu_balance"},
+        {"text": "🛒 Тарифы", "callback_data": "menu_pricing"}
+    ],
+    [
+        {"text": "🔗 Рефералы", "callback_data": "menu_referral"},
+        {"text": "❓ Помощь", "callback_data": "menu_help"}
+    ],
+    [
+        {"text": "📋 Правила", "callback_data": "menu_rules"},
+        {"text": "💎 Купить поиск (25₽)", "callback_data": "buy_single_search"}
     ]
-    
-    for pattern in phone_patterns:
-        if re.match(pattern, query.replace(' ', '').replace('-', '').replace('(', '').replace(')', '')):
-            return "📱 Телефон"
-    
-    if re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', query):
-        return "📧 Email"
-    
-    if re.match(r'^[АВЕКМНОРСТУХ]\d{3}[АВЕКМНОРСТУХ]{2}\d{2,3}$', query.upper().replace(' ', '')):
-        return "🚗 Автомобиль"
-    
-    if query.startswith('@') or re.match(r'^[a-zA-Z0-9_]+$', query):
-        return "🆔 Никнейм"
-    
-    if re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', query):
-        return "🌐 IP-адрес"
-    
-    address_keywords = ['улица', 'ул', 'проспект', 'пр', 'переулок', 'пер', 'дом', 'д', 'квартира', 'кв']
-    if any(keyword in query.lower() for keyword in address_keywords):
-        return "🏠 Адрес"
-    
-    words = query.split()
-    if 2 <= len(words) <= 3 and all(re.match(r'^[а-яА-ЯёЁa-zA-Z]+$', word) for word in words):
-        return "👤 ФИО"
-    
-    return "🔍 Общий поиск"
+]
 
-def create_main_menu(is_admin: bool = False):
-    """Create main menu keyboard"""
-    keyboard = [
+MAIN_MENU_MARKUP = prerender_markup({"inline_keyboard": MAIN_MENU_ROWS})
+
+# Добавляем админ-панель только для администратора
+ADMIN_MAIN_MENU_MARKUP = prerender_markup({"inline_keyboard": MAIN_MENU_ROWS + [
+    [{"text": "👑 Админ панель", "callback_data": "admin_panel"}]
+]})
+
+# Главное меню после /start для администратора
+WELCOME_ADMIN_MENU_MARKUP = prerender_markup({"inline_keyboard": MAIN_MENU_ROWS + [
+    [{"text": "👑 АДМИН-ПАНЕЛЬ", "callback_data": "admin_panel"}]
+]})
+
+ADMIN_MENU_MARKUP = prerender_markup({
+    "inline_keyboard": [
         [
-            {"text": "🔍 Поиск", "callback_data": "menu_search"},
-            {"text": "👤 Профиль", "callback_data": "menu_profile"}
+            {"text": "💎 Начислить баланс", "callback_data": "admin_add_balance"},
+            {"text": "📊 Статистика", "callback_data": "admin_stats"}
         ],
         [
-            {"text": "💰 Баланс", "callback_data": "menu_balance"},
-            {"text": "🛒 Тарифы", "callback_data": "menu_pricing"}
+            {"text": "👥 Пользователи", "callback_data": "admin_users"},
+            {"text": "💳 Платежи", "callback_data": "admin_payments"}
         ],
         [
-            {"text": "🔗 Рефералы", "callback_data": "menu_referral"},
-            {"text": "❓ Помощь", "callback_data": "menu_help"}
+            {"text": "📢 Рассылка всем", "callback_data": "admin_broadcast"}
         ],
         [
-            {"text": "📋 Правила", "callback_data": "menu_rules"},
-            {"text": "💎 Купить поиск (25₽)", "callback_data": "buy_single_search"}
+            {"text": "◀️ Главное меню", "callback_data": "back_to_menu"}
         ]
     ]
-    
-    # Добавляем админ-панель только для администратора
-    if is_admin:
-        keyboard.append([
-            {"text": "👑 Админ панель", "callback_data": "admin_panel"}
-        ])
-    
-    return {"inline_keyboard": keyboard}
+})
 
-def create_admin_menu():
-    """Create admin menu keyboard"""
-    return {
+BALANCE_MENU_MARKUP = prerender_markup({
+    "inline_keyboard": [
+        [
+            {"text": "🤖 Криптобот", "callback_data": "pay_crypto"},
+            {"text": "⭐ Звезды", "callback_data": "pay_stars"}
+        ],
+        [
+            {"text": "🛒 Купить поиск (25₽)", "callback_data": "buy_single_search"}
+        ],
+        [
+            {"text": "◀️ Назад", "callback_data": "back_to_menu"}
+        ]
+    ]
+})
+
+PRICING_MENU_MARKUP = prerender_markup({
+    "inline_keyboard": [
+        [
+            {"text": "📅 1д (149₽)", "callback_data": "buy_day_sub"},
+            {"text": "📅 3д (299₽)", "callback_data": "buy_3days_sub"}
+        ],
+        [
+            {"text": "📅 1мес (1700₽)", "callback_data": "buy_month_sub"}
+        ],
+        [
+            {"text": "◀️ Назад", "callback_data": "back_to_menu"}
+        ]
+    ]
+})
+
+BACK_KEYBOARD_MARKUP = prerender_markup({
+    "inline_keyboard": [
+        [{"text": "◀️ Назад в меню", "callback_data": "back_to_menu"}]
+    ]
+})
+
+SUBSCRIPTION_KEYBOARD_MARKUP = prerender_markup({
+    "inline_keyboard": [
+        [
+            {"text": "📢 Подписаться на канал", "url": "https://t.me/uzrisebya"}
+        ],
+        [
+            {"text": "✅ Проверить подписку", "callback_data": "check_subscription"}
+        ]
+    ]
+})
+
+CRYPTO_CURRENCIES_MARKUP = prerender_markup({
+    "inline_keyboard": [
+        [
+            {"text": "₿ Bitcoin", "callback_data": "crypto_btc"},
+            {"text": "💎 Ethereum", "callback_data": "crypto_eth"}
+        ],
+        [
+            {"text": "💰 USDT", "callback_data": "crypto_usdt"},
+            {"text": "🔸 Litecoin", "callback_data": "crypto_ltc"}
+        ],
+        [
+            {"text": "◀️ Назад", "callback_data": "menu_balance"}
+        ]
+    ]
+})
+
+STARS_AMOUNTS_MARKUP = prerender_markup({
+    "inline_keyboard": [
+        [
+            {"text": "50⭐ = 100₽", "callback_data": "stars_100"},
+            {"text": "125⭐ = 250₽", "callback_data": "stars_250"}
+        ],
+        [
+            {"text": "250⭐ = 500₽", "callback_data": "stars_500"},
+            {"text": "500⭐ = 1000₽", "callback_data": "stars_1000"}
+        ],
+        [
+            {"text": "1000⭐ = 2000₽", "callback_data": "stars_2000"}
+        ],
+        [
+            {"text": "💰 Своя сумма", "callback_data": "stars_custom"}
+        ],
+        [
+            {"text": "◀️ Назад", "callback_data": "menu_balance"}
+        ]
+    ]
+})
+
+def build_crypto_amounts_markup(crypto_type: str) -> RawJSON:
+    """Amount picker for one cryptocurrency"""
+    return prerender_markup({
         "inline_keyboard": [
             [
-                {"text": "💎 Начислить баланс", "callback_data": "admin_add_balance"},
-                {"text": "📊 Статистика", "callback_data": "admin_stats"}
+                {"text": "100₽", "callback_data": f"crypto_{crypto_type}_100"},
+                {"text": "250₽", "callback_data": f"crypto_{crypto_type}_250"}
             ],
             [
-                {"text": "👥 Пользователи", "callback_data": "admin_users"},
-                {"text": "💳 Платежи", "callback_data": "admin_payments"}
+                {"text": "500₽", "callback_data": f"crypto_{crypto_type}_500"},
+                {"text": "1000₽", "callback_data": f"crypto_{crypto_type}_1000"}
             ],
             [
-                {"text": "📢 Рассылка всем", "callback_data": "admin_broadcast"}
+                {"text": "2000₽", "callback_data": f"crypto_{crypto_type}_2000"},
+                {"text": "5000₽", "callback_data": f"crypto_{crypto_type}_5000"}
             ],
             [
-                {"text": "◀️ Главное меню", "callback_data": "back_to_menu"}
+                {"text": "💰 Своя сумма", "callback_data": f"crypto_{crypto_type}_custom"}
+            ],
+            [
+                {"text": "◀️ Назад", "callback_data": "pay_crypto"}
             ]
         ]
-    }
+    })
+
+CRYPTO_AMOUNTS_MARKUPS = {crypto_type: build_crypto_amounts_markup(crypto_type) for crypto_type in CRYPTO_NAMES}
+
+def crypto_amounts_markup(crypto_type: str) -> RawJSON:
+    """Cached amount picker, built on the fly for unknown coins"""
+    markup = CRYPTO_AMOUNTS_MARKUPS.get(crypto_type)
+    return markup if markup is not None else build_crypto_amounts_markup(crypto_type)
+
+def create_main_menu(is_admin: bool = False):
+    """Create main menu keyboard"""
+    return ADMIN_MAIN_MENU_MARKUP if is_admin else MAIN_MENU_MARKUP
+
+def create_admin_menu():
+    """Create admin menu keyboard"""
+    return ADMIN_MENU_MARKUP
 
 def create_balance_menu():
     """Create balance menu keyboard"""
-    return {
-        "inline_keyboard": [
-            [
-                {"text": "🤖 Криптобот", "callback_data": "pay_crypto"},
-                {"text": "⭐ Звезды", "callback_data": "pay_stars"}
-            ],
-            [
-                {"text": "🛒 Купить поиск (25₽)", "callback_data": "buy_single_search"}
-            ],
-            [
-                {"text": "◀️ Назад", "callback_data": "back_to_menu"}
-            ]
-        ]
-    }
+    return BALANCE_MENU_MARKUP
 
 def create_pricing_menu():
     """Create pricing menu keyboard"""
-    return {
-        "inline_keyboard": [
-            [
-                {"text": "📅 1д (149₽)", "callback_data": "buy_day_sub"},
-                {"text": "📅 3д (299₽)", "callback_data": "buy_3days_sub"}
-            ],
-            [
-                {"text": "📅 1мес (1700₽)", "callback_data": "buy_month_sub"}
-            ],
-            [
-                {"text": "◀️ Назад", "callback_data": "back_to_menu"}
-            ]
-        ]
-    }
+    return PRICING_MENU_MARKUP
 
 def create_back_keyboard():
     """Create back button keyboard"""
-    return {
-        "inline_keyboard": [
-            [{"text": "◀️ Назад в меню", "callback_data": "back_to_menu"}]
-        ]
-    }
+    return BACK_KEYBOARD_MARKUP
 
 def create_subscription_keyboard():
     """Create subscription check keyboard"""
-    return {
-        "inline_keyboard": [
-            [
-                {"text": "📢 Подписаться на канал", "url": "https://t.me/uzrisebya"}
-            ],
-            [
-                {"text": "✅ Проверить подписку", "callback_data": "check_subscription"}
-            ]
-        ]
-    }
+    return SUBSCRIPTION_KEYBOARD_MARKUP
+
+MAIN_MENU_FEATURES_TEXT = (
+    "🔍 *ЧТО УМЕЕТ НАШИХ БОТ:*\n\n"
+    "📊 *ПОИСК ПО 1000+ БАЗАМ ДАННЫХ:*\n"
+    "📱 Телефоны: +79123456789\n"
+    "📧 Email: user@mail.ru\n"
+    "👤 ФИО: Иван Петров Сергеевич\n"
+    "🚗 Автономера: А123ВС777\n"
+    "🆔 Никнеймы: @username\n"
+    "🌐 IP-адреса: 192.168.1.1\n"
+    "🏠 Адреса и геолокация\n\n"
+    "🗄️ *ИСТОЧНИКИ ДАННЫХ:*\n"
+    "🟡 Яндекс (Еда, Такси, Карты)\n"
+    "🟢 Авито (объявления, пользователи)\n"
+    "🔵 ВКонтакте (профили)\n"
+    "🟠 Одноклассники\n"
+    "📦 СДЭК (доставка)\n"
+    "🍕 Delivery Club и многие другие\n\n"
+    # Важная информация о бесплатном пробиве
+    "🎁 *БЕСПЛАТНЫЕ ПРОБИВЫ:*\n"
+    "За каждого одобренного реферала получите 1 бесплатную попытку пробива данных!\n\n"
+)
+
+MAIN_MENU_FOOTER_TEXT = (
+    "💳 *ДОСТУПНЫЕ ТАРИФЫ:*\n"
+    "• Разовые поиски\n"
+    "• Подписка на 1 день\n"
+    "• Подписка на 3 дня\n"
+    "• Подписка на 1 месяц\n\n"
+    "🔍 *Выберите действие:*"
+)
+
+SEARCH_LIMIT_REACHED_TEXT = (
+    "⏰ *ДНЕВНОЙ ЛИМИТ ИСЧЕРПАН*\n\n"
+    "📅 Вы использовали все 12 поисков по подписке на сегодня\n"
+    "🕒 Попробуйте завтра или купите отдельные поиски"
+)
+
+SEARCH_MENU_HELP_TEXT = (
+    "\n📝 *ТИПЫ ПОИСКА:*\n"
+    "📱 Телефон: +79123456789, 89123456789\n"
+    "📧 Email: user@mail.ru, admin@site.com\n"
+    "👤 ФИО: Иван Петров, Анна Сергеевна\n"
+    "🚗 Авто: А123ВС777, В456ОР199\n"
+    "🆔 Никнейм: @username, nickname\n"
+    "🌐 IP: 192.168.1.1, 8.8.8.8\n"
+    "🏠 Адрес: улица Ленина дом 5\n\n"
+    "🗄️ *ИСТОЧНИКИ (1000+ БАЗ):*\n"
+    "🟡 Яндекс • 🟢 Авито • 🔵 ВКонтакте\n"
+    "🟠 Одноклассники • 📦 СДЭК • 🍕 Delivery Club\n"
+    "📊 И многие другие сервисы\n\n"
+    "➡️ *Просто отправьте данные для поиска*"
+)
+
+BALANCE_MENU_FOOTER_TEXT = (
+    "💡 *СПОСОБЫ ПОПОЛНЕНИЯ:*\n"
+    "🤖 Криптобот - автоматически\n"
+    "⭐ Звезды Telegram - мгновенно\n\n"
+    "💎 *Минимальное пополнение:* 100 ₽\n"
+    "🔍 *Один поиск:* 25 ₽\n\n"
+    "💼 *Или оформите подписку для экономии!*"
+)
+
+PRICING_TEXT = (
+    "🛒 *ТАРИФЫ И ПОДПИСКИ*\n\n"
+    "💎 *РАЗОВЫЕ ПОИСКИ:*\n"
+    "🔍 1 поиск = 25 ₽\n"
+    "💡 Идеально для разового использования\n\n"
+    "⭐ *ВЫГОДНЫЕ ПОДПИСКИ*:\n\n"
+    "📅 *1 ДЕНЬ - 149 ₽*\n"
+    "• До 12 поисков в день\n"
+    "• Экономия: 151 ₽ (по сравнению с разовыми)\n"
+    "• Цена за поиск: ~12₽\n\n"
+    "📅 *3 ДНЯ - 299 ₽* 🔥\n"
+    "• До 36 поисков за 3 дня\n"
+    "• Экономия: 601 ₽\n"
+    "• Цена за поиск: ~8₽\n\n"
+    "📅 *1 МЕСЯЦ - 1700 ₽* 💎\n"
+    "• До 360 поисков за месяц\n"
+    "• Экономия: 7300 ₽\n"
+    "• Цена за поиск: ~5₽\n\n"
+    "🎁 *БЕСПЛАТНО:*\n"
+    "• Приглашайте друзей и получайте бесплатные поиски!\n"
+    "• 1 одобренный реферал = 1 бесплатная попытка\n\n"
+    "💡 *Чем больше тариф, тем больше экономия!*"
+)
+
+HELP_TEXT = (
+    "❓ *СПРАВКА И ПОДДЕРЖКА*\n\n"
+    "🎯 *О СЕРВИСЕ:*\n"
+    "УЗРИ помогает найти информацию о людях из открытых источников интернета.\n\n"
+    "💰 *ТАРИФЫ:*\n"
+    "🔍 Разовый поиск: 25 ₽\n"
+    "📅 Подписки: от 149 ₽/день\n\n"
+    "💳 *ПОПОЛНЕНИЕ:*\n"
+    "🤖 Криптобот\n"
+    "⭐ Звезды Telegram\n"
+    "💎 Минимум: 100 ₽\n\n"
+    "🔗 *РЕФЕРАЛЫ:*\n"
+    "🔍 1 попытка поиска за подтвержденного реферала\n\n"
+    "📞 *ПОДДЕРЖКА:*\n"
+    "@Sigicara - техническая поддержка\n\n"
+    "⚖️ *ВАЖНО:*\n"
+    "Перед использованием изучите правила сервиса"
+)
+
+RULES_TEXT = (
+    "📋 *ПРАВИЛА ИСПОЛЬЗОВАНИЯ СЕРВИСА*\n\n"
+    "*1. СОГЛАСИЕ С ПРАВИЛАМИ*\n"
+    "Используя данный бот, вы полностью подтверждаете согласие со всеми правилами сервиса.\n\n"
+    "*2. НАЗНАЧЕНИЕ СЕРВИСА*\n"
+    "• Поиск информации о себе в открытых источниках\n"
+    "• Проверка утечек персональных данных\n"
+    "• Анализ цифрового следа\n\n"
+    "*3. ЗАПРЕЩАЕТСЯ*\n"
+    "• Поиск данных без согласия владельца\n"
+    "• Использование для мошенничества\n"
+    "• Нарушение законов РФ\n"
+    "• Продажа полученной информации\n"
+    "• Преследование и шантаж\n\n"
+    "*4. ТАРИФИКАЦИЯ*\n"
+    "• Разовый поиск: 25 ₽\n"
+    "• Подписки с лимитом 12 поисков/день\n"
+    "• Минимальное пополнение: 100 ₽\n"
+    "• Возврат средств не предусмотрен\n\n"
+    "*5. ОТВЕТСТВЕННОСТЬ*\n"
+    "• Администрация не несет ответственности за использование данных\n"
+    "• Пользователь самостоятельно отвечает за свои действия\n"
+    "• При нарушении правил - блокировка аккаунта\n\n"
+    "*6. ТЕХНИЧЕСКАЯ ПОДДЕРЖКА*\n"
+    "@Sigicara - техническая поддержка\n\n"
+    "⚖️ *Используя сервис, вы подтверждаете согласие с данными правилами.*"
+)
+
+ADMIN_PANEL_TEXT = (
+    "👑 *АДМИН-ПАНЕЛЬ*\n\n"
+    "🔧 Управление сервисом УЗРИ\n\n"
+    "💎 *Начислить баланс* - добавить деньги пользователю\n"
+    "📊 *Статистика* - общая статистика сервиса\n"
+    "👥 *Пользователи* - список активных пользователей\n"
+    "💳 *Платежи* - история транзакций"
+)
+
+BROADCAST_PROMPT_TEXT = (
+    "📢 *МАССОВАЯ РАССЫЛКА*\n\n"
+    "📝 *Отправьте сообщение, которое нужно разослать всем пользователям бота*\n\n"
+    "⚠️ *Внимание:* Сообщение будет отправлено всем пользователям без возможности отмены\n\n"
+    "💡 *Поддерживается Markdown форматирование*\n"
+    "❌ Для отмены нажмите кнопку ниже"
+)
+
+CRYPTO_PAYMENT_TEXT = (
+    "🤖 *ПОПОЛНЕНИЕ ЧЕРЕЗ КРИПТОБОТ*\n\n"
+    "💰 *Доступные способы:*\n"
+    "₿ Bitcoin (BTC)\n"
+    "💎 Ethereum (ETH)\n"
+    "💰 USDT (TRC-20/ERC-20)\n"
+    "🔸 Litecoin (LTC)\n\n"
+    "📋 *Как пополнить:*\n"
+    "1. Выберите сумму и валюту\n"
+    "2. Получите адрес кошелька\n"
+    "3. Переведите средства\n"
+    "4. Средства поступят автоматически\n\n"
+    "⚡ *Минимальная сумма:* 100 ₽\n"
+    "🚀 *Зачисление:* 1-30 минут\n\n"
+    "📞 *Поддержка:* @Sigicara"
+)
+
+STARS_PAYMENT_TEXT = (
+    "⭐ *ПОПОЛНЕНИЕ ЗВЕЗДАМИ TELEGRAM*\n\n"
+    "💫 *Быстро и удобно!*\n"
+    "Используйте звезды Telegram для мгновенного пополнения баланса\n\n"
+    "💰 *Курс обмена:*\n"
+    "1 ⭐ = 2 ₽\n\n"
+    "🎯 *Варианты пополнения:*\n\n"
+)
+
+CRYPTO_AMOUNT_PROMPT_TEXT = (
+    "📝 *Выберите сумму для пополнения:*\n"
+    "После выбора вы получите адрес кошелька для перевода\n\n"
+    "⚡ *Зачисление: 1-30 минут*"
+)
+
+CUSTOM_AMOUNT_HEADER_TEXT = "💰 *СВОЯ СУММА ПОПОЛНЕНИЯ*\n\n"
+
+CUSTOM_AMOUNT_FOOTER_TEXT = (
+    "📝 Введите сумму в рублях (от 100₽ до 50,000₽)\n"
+    "💡 Сумма должна быть кратна 50₽\n\n"
+    "❌ Для отмены нажмите кнопку"
+)
+
+STARS_CUSTOM_AMOUNT_TEXT = (
+    CUSTOM_AMOUNT_HEADER_TEXT +
+    "⭐ *Курс:* 1 звезда = 2₽\n\n" +
+    CUSTOM_AMOUNT_FOOTER_TEXT
+)
+
+async def check_daily_limit_reset(user: User) -> User:
+    """Check if daily search limit should be reset"""
+    now = datetime.utcnow()
+    if now.date() > user.daily_searches_reset.date():
+        await db.users.update_one(
+            {"telegram_id": user.telegram_id},
+            {
+                "$set": {
+                    "daily_searches_used": 0,
+                    "daily_searches_reset": now
+                }
+            }
+        )
+        user.daily_searches_used = 0
+        user.daily_searches_reset = now
+    return user
+
+async def has_active_subscription(user: User) -> bool:
+    """Check if user has active subscription"""
+    if not user.subscription_expires:
+        return False
+    return datetime.utcnow() < user.subscription_expires
+
+SEARCH_COST = 25.0
+DAILY_SEARCH_LIMIT = 12
+
+async def reserve_search(user: User) -> tuple[bool, str]:
+    """Atomically reserve one search. Returns (reserved, payment method or error)
+
+    Subscription quota (with the daily reset of check_daily_limit_reset) or
+    balance is taken in a single conditional update, so parallel searches
+    cannot exceed the limit or overdraw the balance.
+    """
+    # Admin always can search
+    if user.is_admin:
+        return True, ""
+    
+    now = datetime.utcnow()
+    today = datetime(now.year, now.month, now.day)
+    
+    if await has_active_subscription(user):
+        active_subscription = {"telegram_id": user.telegram_id, "subscription_expires": {"$gt": now}}
+        reserved = await db.users.find_one_and_update(
+            {
+                **active_subscription,
+                "daily_searches_reset": {"$gte": today},
+                "daily_searches_used": {"$lt": DAILY_SEARCH_LIMIT}
+            },
+            {"$inc": {"daily_searches_used": 1}},
+            projection={"_id": 1}
+        )
+        if reserved is None:
+            # Первый поиск нового дня - сбрасываем счетчик
+            reserved = await db.users.find_one_and_update(
+                {**active_subscription, "daily_searches_reset": {"$lt": today}},
+                {"$set": {"daily_searches_used": 1, "daily_searches_reset": now}},
+                projection={"_id": 1}
+            )
+        if reserved is not None:
+            return True, "subscription"
+        return False, f"превышен дневной лимит подписки ({DAILY_SEARCH_LIMIT} поисков)"
+    
+    reserved = await db.users.find_one_and_update(
+        {"telegram_id": user.telegram_id, "balance": {"$gte": SEARCH_COST}},
+        {"$inc": {"balance": -SEARCH_COST}},
+        projection={"_id": 1}
+    )
+    if reserved is not None:
+        return True, "balance"
+    return False, "недостаточно средств"
 
-async def check_daily_limit_reset(user: User) -> User:
-    """Check if daily search limit should be reset"""
-    now = datetime.utcnow()
-    if now.date() > user.daily_searches_reset.date():
+async def refund_search(user: User, payment_method: str):
+    """Return a search reserved by reserve_search"""
+    if payment_method == "subscription":
+        await db.users.update_one(
+            {"telegram_id": user.telegram_id, "daily_searches_used": {"$gt": 0}},
+            {"$inc": {"daily_searches_used": -1}}
+        )
+    elif payment_method == "balance":
         await db.users.update_one(
             {"telegram_id": user.telegram_id},
-            {
-                "$set": {
-                    "daily_searches_used": 0,
-                    "daily_searches_reset": now
-                }
-            }
+            {"$inc": {"balance": SEARCH_COST}}
         )
-        user.daily_searches_used = 0
-        user.daily_searches_reset = now
-    return user
-
-async def has_active_subscription(user: User) -> bool:
-    """Check if user has active subscription"""
-    if not user.subscription_expires:
-        return False
-    return datetime.utcnow() < user.subscription_expires
 
 async def can_search(user: User) -> tuple[bool, str]:
     """Check if user can perform search"""
@@ -289,108 +1444,373 @@ async def can_search(user: User) -> tuple[bool, str]:
 
 async def usersbox_request(endpoint: str, params: Dict = None) -> Dict:
     """Make request to usersbox API"""
-    headers = {"Authorization": USERSBOX_TOKEN}
-    url = f"{USERSBOX_BASE_URL}{endpoint}"
-    
     try:
-        response = requests.get(url, headers=headers, params=params or {}, timeout=30)
+        response = await http_request("usersbox", "GET", endpoint, params=params or {})
         return response.json()
     except Exception as e:
         logging.error(f"Usersbox API error: {e}")
         return {"status": "error", "error": {"message": str(e)}}
 
-def format_search_results(results: Dict[str, Any], query: str, search_type: str) -> str:
-    """Format usersbox API results for Telegram"""
+# Search payloads
+# Raw usersbox responses live out of line in search_payloads, compressed and
+# keyed by a hash of normalized query + response, so identical responses are
+# stored once. searches keeps only results_ref; payloads expire
+# SEARCH_PAYLOAD_RETENTION_DAYS after the last search that referenced them.
+SEARCH_PAYLOAD_CODECS: Dict[str, tuple] = {
+    "zlib": (lambda raw: zlib.compress(raw, 6), zlib.decompress),
+}
+if zstandard is not None:
+    SEARCH_PAYLOAD_CODECS["zstd"] = (
+        lambda raw: zstandard.ZstdCompressor(level=3).compress(raw),
+        lambda data: zstandard.ZstdDecompressor().decompress(data)
+    )
+
+@functools.lru_cache(maxsize=None)
+def search_payload_codec() -> str:
+    """Configured codec, zlib when it is not installed (warned once)"""
+    if SEARCH_PAYLOAD_CODEC in SEARCH_PAYLOAD_CODECS:
+        return SEARCH_PAYLOAD_CODEC
+    logging.warning(f"Search payload codec {SEARCH_PAYLOAD_CODEC!r} is not available, storing payloads with zlib")
+    return "zlib"
+
+def encode_search_payload(normalized_query: str, results: Dict[str, Any]) -> tuple:
+    """Returns (content hash, canonical JSON bytes)"""
+    raw = json.dumps(results, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str).encode()
+    digest = hashlib.sha256(normalized_query.encode() + b"\0" + raw).hexdigest()
+    return digest, raw
+
+async def store_search_payload(normalized_query: str, results: Dict[str, Any], used_at: datetime = None) -> str:
+    """Store a usersbox response (deduplicated), returns its reference"""
+    ref, raw = encode_search_payload(normalized_query, results)
+    codec = search_payload_codec()
+    now = datetime.utcnow()
+    await db.search_payloads.update_one(
+        {"_id": ref},
+        {
+            "$max": {"last_used_at": used_at or now},
+            "$setOnInsert": {
+                "codec": codec,
+                "data": SEARCH_PAYLOAD_CODECS[codec][0](raw),
+                "size": len(raw),
+                "created_at": now,
+            }
+        },
+        upsert=True
+    )
+    return ref
+
+def decode_search_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    decompress = SEARCH_PAYLOAD_CODECS[payload['codec']][1]
+    return json.loads(decompress(payload['data']))
+
+async def load_search_payload(ref: str) -> Optional[Dict[str, Any]]:
+    """Load a stored usersbox response, None if it has expired"""
+    payload = await db.search_payloads.find_one({"_id": ref})
+    return decode_search_payload(payload) if payload else None
+
+async def load_stored_search(normalized_query: str) -> Optional[Dict[str, Any]]:
+    """Load recent successful results for the query from the searches log"""
+    since = datetime.utcnow() - timedelta(seconds=SEARCH_CACHE_TTL)
+    search_data = await db.searches.find_one(
+        {"normalized_query": normalized_query, "success": True, "timestamp": {"$gt": since}},
+        {"results_ref": 1, "results": 1},
+        sort=[("timestamp", -1)]
+    )
+    if not search_data:
+        return None
+    if search_data.get('results_ref'):
+        return await load_search_payload(search_data['results_ref'])
+    # Записи до переноса ответов в search_payloads
+    return search_data.get('results')
+
+async def search_usersbox(query: str, normalized_query: str = None) -> Dict[str, Any]:
+    """Search usersbox with result cache and single-flight coalescing.
+
+    Concurrent identical searches wait for one upstream call. Only successful
+    responses are cached.
+    """
+    key = normalized_query or normalize_search_query(query)
+    
+    cached = search_cache.get(key)
+    if cached is not CACHE_MISS:
+        return cached
+    
+    inflight = search_inflight.get(key)
+    if inflight is not None:
+        search_cache_stats["coalesced"] += 1
+        return await asyncio.shield(inflight)
+    
+    future = asyncio.get_running_loop().create_future()
+    search_inflight[key] = future
+    try:
+        results = None
+        try:
+            results = await load_stored_search(key)
+        except Exception as e:
+            logging.error(f"Stored search lookup error: {e}")
+        
+        if results is not None:
+            search_cache_stats["stored_hits"] += 1
+        else:
+            search_cache_stats["upstream_searches"] += 1
+            results = await usersbox_request("/search", {"q": query})
+        
+        if results.get('status') == 'success':
+            search_cache.set(key, results)
+        future.set_result(results)
+        return results
+    except Exception as e:
+        # Ждущие получают ошибку в виде ответа usersbox: CancelledError убил бы их воркеры
+        future.set_result({"status": "error", "error": {"message": str(e)}})
+        raise
+    finally:
+        search_inflight.pop(key, None)
+        if not future.done():
+            # Отменили сам запрос - отменяем и ожидание
+            future.cancel()
+
+# Search results formatting
+TELEGRAM_MESSAGE_LIMIT = 4096  # UTF-16 code units after entity parsing
+
+SEARCH_DB_NAMES = {
+    'yandex': '🟡 Яндекс',
+    'avito': '🟢 Авито',
+    'vk': '🔵 ВКонтакте',
+    'ok': '🟠 Одноклассники',
+    'delivery_club': '🍕 Delivery Club',
+    'cdek': '📦 СДЭК'
+}
+
+FIELD_ICONS = {
+    **dict.fromkeys(['phone', 'телефон', 'tel', 'mobile'], "📞"),
+    **dict.fromkeys(['email', 'почта', 'mail', 'e_mail'], "📧"),
+    **dict.fromkeys(['full_name', 'name', 'имя', 'фио', 'first_name', 'last_name'], "👤"),
+    **dict.fromkeys(['birth_date', 'birthday', 'дата_рождения', 'bdate'], "🎂"),
+    **dict.fromkeys(['address', 'адрес', 'city', 'город'], "🏠"),
+    **dict.fromkeys(['sex', 'gender', 'пол'], "⚥"),
+}
+
+GENDER_NAMES = {'1': 'Ж', '2': 'М', 'male': 'М', 'female': 'Ж'}
+
+MARKDOWN_ESCAPES = str.maketrans({'_': '\\_', '*': '\\*', '`': '\\`', '[': '\\['})
+
+SEARCH_RESULTS_FOOTER = (
+    "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+    "🔒 *Конфиденциальность:* Используйте данные ответственно"
+)
+
+class SearchReply(NamedTuple):
+    messages: List[str]
+    document: Optional[bytes] = None  # Полный отчет файлом, если не влезает в сообщения
+
+def telegram_length(text: str) -> int:
+    """Message length as Telegram counts it (UTF-16 code units)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def clip_value(value: Any) -> str:
+    text = str(value)
+    if len(text) > SEARCH_RESULT_VALUE_MAX_LENGTH:
+        text = text[:SEARCH_RESULT_VALUE_MAX_LENGTH - 1] + "…"
+    return text
+
+def escape_markdown(value: Any) -> str:
+    """Escape a value for parse_mode=Markdown"""
+    return clip_value(value).translate(MARKDOWN_ESCAPES)
+
+def code_span(value: Any) -> str:
+    """Inline code; backticks can't be escaped inside it"""
+    return "`" + clip_value(value).replace("`", "'") + "`"
+
+def format_field(key: str, value: Any) -> Optional[str]:
+    """Display value of a hit field, None for fields we don't show"""
+    icon = FIELD_ICONS.get(key)
+    if icon is None:
+        return None
+    if icon == "⚥":
+        value = GENDER_NAMES.get(str(value), value)
+    return f"{icon} {escape_markdown(value)}\n"
+
+class MessageChunker:
+    """Packs rendered blocks into messages that fit the Telegram limit"""
+
+    def __init__(self, max_messages: int, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.max_messages = max_messages
+        self.limit = limit
+        self.messages: List[str] = []
+        self.overflow = False
+        self._parts: List[str] = []
+        self._size = 0
+
+    def add(self, block: str) -> bool:
+        """Append a block, starting a new message when it doesn't fit. False once out of messages"""
+        if self.overflow:
+            return False
+        size = telegram_length(block)
+        if size > self.limit:
+            self.overflow = True
+            return False
+        if self._parts and self._size + size > self.limit:
+            self._flush()
+            if len(self.messages) >= self.max_messages:
+                self.overflow = True
+                return False
+        self._parts.append(block)
+        self._size += size
+        return True
+
+    def finish(self) -> List[str]:
+        self._flush()
+        return self.messages
+
+    def _flush(self):
+        if self._parts:
+            self.messages.append("".join(self._parts))
+            self._parts = []
+            self._size = 0
+
+def iter_result_sources(data: Dict[str, Any]):
+    """Yield (database, collection, hits_count, hit items) for each source"""
+    items = data.get('items')
+    if not isinstance(items, list):
+        return
+    for source_data in items:
+        if not isinstance(source_data, dict) or 'source' not in source_data or 'hits' not in source_data:
+            continue
+        source = source_data['source']
+        hits = source_data['hits']
+        hits_count = hits.get('hitsCount', hits.get('count', 0))
+        yield source.get('database', 'N/A'), source.get('collection', 'N/A'), hits_count, hits.get('items') or []
+
+def render_source_block(index: int, database: str, collection: str, hits_count: int, items: List[Dict[str, Any]]) -> str:
+    db_display = SEARCH_DB_NAMES.get(database) or f"📊 {escape_markdown(database)}"
+    parts = [
+        f"*{index}. {db_display}*\n",
+        f"📁 База: {escape_markdown(collection)}\n",
+        f"🔢 Записей: {hits_count}\n",
+    ]
+    if items:
+        parts.append("💾 *Данные:*\n")
+        for item in items[:SEARCH_RESULT_ITEMS_PER_SOURCE]:
+            for key, value in item.items():
+                if key.startswith('_'):
+                    continue
+                line = format_field(key, value)
+                if line:
+                    parts.append(line)
+    parts.append("\n")
+    return "".join(parts)
+
+def render_search_document(data: Dict[str, Any], query: str, search_type: str) -> bytes:
+    """Full plain-text report with every source, hit and field"""
+    lines = [f"Запрос: {query}", f"Тип: {search_type}", f"Найдено: {data.get('count', 0)}", ""]
+    for index, (database, collection, hits_count, items) in enumerate(iter_result_sources(data), 1):
+        lines.append(f"{index}. {SEARCH_DB_NAMES.get(database, database)} / {collection} ({hits_count})")
+        for item in items:
+            for key, value in item.items():
+                if not key.startswith('_'):
+                    lines.append(f"   {FIELD_ICONS.get(key, '•')} {key}: {value}")
+            lines.append("")
+        lines.append("")
+    return "\n".join(lines).encode('utf-8')
+
+def render_search_results(results: Dict[str, Any], query: str, search_type: str) -> SearchReply:
+    """Format usersbox API results as one or more Telegram messages.
+
+    Blocks are rendered one source at a time into a chunker bounded by the
+    Telegram limit; when the sources don't fit into SEARCH_RESULT_MAX_MESSAGES
+    the reply is a short summary plus the full report as a document.
+    """
     if results.get('status') == 'error':
-        return f"❌ *Ошибка:* {results.get('error', {}).get('message', 'Неизвестная ошибка')}"
+        message = escape_markdown(results.get('error', {}).get('message', 'Неизвестная ошибка'))
+        return SearchReply([f"❌ *Ошибка:* {message}"])
 
     data = results.get('data', {})
     total_count = data.get('count', 0)
     
     if total_count == 0:
-        return f"🔍 *Поиск:* `{query}`\n{search_type}\n\n❌ *Результатов не найдено*\n\n💡 *Попробуйте изменить формат запроса*"
+        return SearchReply([f"🔍 *Поиск:* {code_span(query)}\n{search_type}\n\n❌ *Результатов не найдено*\n\n💡 *Попробуйте изменить формат запроса*"])
     
-    formatted_text = f"🎯 *РЕЗУЛЬТАТЫ ПОИСКА*\n\n"
-    formatted_text += f"🔍 *Запрос:* `{query}`\n"
-    formatted_text += f"📂 *Тип:* {search_type}\n"
-    formatted_text += f"📊 *Найдено:* {total_count} записей\n\n"
+    header = (
+        f"🎯 *РЕЗУЛЬТАТЫ ПОИСКА*\n\n"
+        f"🔍 *Запрос:* {code_span(query)}\n"
+        f"📂 *Тип:* {search_type}\n"
+        f"📊 *Найдено:* {total_count} записей\n\n"
+    )
 
-    if 'items' in data and isinstance(data['items'], list):
-        formatted_text += "📋 *ДАННЫЕ ИЗ БАЗ:*\n\n"
-        
-        for i, source_data in enumerate(data['items'][:5], 1):
-            if 'source' in source_data and 'hits' in source_data:
-                source = source_data['source']
-                hits = source_data['hits']
-                hits_count = hits.get('hitsCount', hits.get('count', 0))
-                
-                db_names = {
-                    'yandex': '🟡 Яндекс',
-                    'avito': '🟢 Авито',
-                    'vk': '🔵 ВКонтакте',
-                    'ok': '🟠 Одноклассники',
-                    'delivery_club': '🍕 Delivery Club',
-                    'cdek': '📦 СДЭК'
-                }
-                
-                db_display = db_names.get(source.get('database', ''), f"📊 {source.get('database', 'N/A')}")
-                
-                formatted_text += f"*{i}. {db_display}*\n"
-                formatted_text += f"📁 База: {source.get('collection', 'N/A')}\n"
-                formatted_text += f"🔢 Записей: {hits_count}\n"
-
-                if 'items' in hits and hits['items']:
-                    formatted_text += "💾 *Данные:*\n"
-                    for item in hits['items'][:2]:
-                        for key, value in item.items():
-                            if key.startswith('_'):
-                                continue
-                            
-                            if key in ['phone', 'телефон', 'tel', 'mobile']:
-                                formatted_text += f"📞 {value}\n"
-                            elif key in ['email', 'почта', 'mail', 'e_mail']:
-                                formatted_text += f"📧 {value}\n"
-                            elif key in ['full_name', 'name', 'имя', 'фио', 'first_name', 'last_name']:
-                                formatted_text += f"👤 {value}\n"
-                            elif key in ['birth_date', 'birthday', 'дата_рождения', 'bdate']:
-                                formatted_text += f"🎂 {value}\n"
-                            elif key in ['address', 'адрес', 'city', 'город']:
-                                formatted_text += f"🏠 {value}\n"
-                            elif key in ['sex', 'gender', 'пол']:
-                                gender_map = {'1': 'Ж', '2': 'М', 'male': 'М', 'female': 'Ж'}
-                                formatted_text += f"⚥ {gender_map.get(str(value), value)}\n"
-                
-                formatted_text += "\n"
+    chunker = MessageChunker(SEARCH_RESULT_MAX_MESSAGES)
+    chunker.add(header)
+    if isinstance(data.get('items'), list):
+        chunker.add("📋 *ДАННЫЕ ИЗ БАЗ:*\n\n")
+        for index, source in enumerate(iter_result_sources(data), 1):
+            if index > SEARCH_RESULT_MAX_SOURCES or not chunker.add(render_source_block(index, *source)):
+                break
+    chunker.add(SEARCH_RESULTS_FOOTER)
 
-    formatted_text += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-    formatted_text += "🔒 *Конфиденциальность:* Используйте данные ответственно"
+    if chunker.overflow:
+        summary = header + "📎 *Результатов слишком много для сообщения - полный отчет в файле*\n\n" + SEARCH_RESULTS_FOOTER
+        return SearchReply([summary], render_search_document(data, query, search_type))
     
-    return formatted_text
+    return SearchReply(chunker.finish())
+
+async def check_subscription(user_id: int, user: User = None, force: bool = False) -> bool:
+    """Check if user is subscribed to required channel.
 
-async def check_subscription(user_id: int) -> bool:
-    """Check if user is subscribed to required channel"""
+    Results are cached (positive and negative answers with separate TTLs) and
+    persisted in users.is_subscribed / subscription_checked_at. force=True skips
+    the cache, e.g. when the user presses "check subscription".
+    """
+    if force:
+        subscription_cache.invalidate(user_id)
+    else:
+        cached = subscription_cache.get(user_id)
+        if cached is not CACHE_MISS:
+            return cached
+        
+        # Recent positive check stored on the user record
+        if user and user.is_subscribed and user.subscription_checked_at:
+            checked_ago = (datetime.utcnow() - user.subscription_checked_at).total_seconds()
+            if checked_ago < SUBSCRIPTION_CACHE_TTL:
+                subscription_check_stats["stored_hits"] += 1
+                subscription_cache.set(user_id, True, SUBSCRIPTION_CACHE_TTL - checked_ago)
+                return True
+    
+    started_at = time.monotonic()
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getChatMember"
         params = {
             "chat_id": REQUIRED_CHANNEL,
             "user_id": user_id
         }
         
-        response = requests.get(url, params=params, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('ok'):
-                status = data.get('result', {}).get('status')
-                return status in ['member', 'administrator', 'creator']
+        data = await telegram_request("getChatMember", params)
+        if not data.get('ok'):
+            # Ошибку API не кэшируем
+            return False
         
-        return False
+        status = data.get('result', {}).get('status')
+        is_subscribed = status in ['member', 'administrator', 'creator']
     except Exception as e:
         logging.error(f"Subscription check error: {e}")
         return False
+    finally:
+        subscription_check_stats["upstream_checks"] += 1
+        subscription_check_stats["upstream_time"] += time.monotonic() - started_at
+    
+    subscription_cache.set(user_id, is_subscribed, SUBSCRIPTION_CACHE_TTL if is_subscribed else SUBSCRIPTION_NEGATIVE_CACHE_TTL)
+    await db.users.update_one(
+        {"telegram_id": user_id},
+        {"$set": {"is_subscribed": is_subscribed, "subscription_checked_at": datetime.utcnow()}}
+    )
+    if force:
+        # Другие воркеры могли закэшировать старый ответ
+        await publish_cache_invalidation(subscription_cache, user_id)
+    return is_subscribed
 
-async def send_telegram_message(chat_id: int, text: str, parse_mode: str = "Markdown", reply_markup: dict = None) -> bool:
+async def send_telegram_message(chat_id: int, text: str, parse_mode: str = "Markdown", reply_markup: Any = None) -> bool:
     """Send message to Telegram user"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    return await post_telegram_message(chat_id, text, parse_mode, reply_markup) is not None
+
+async def post_telegram_message(chat_id: int, text: str, parse_mode: str = "Markdown", reply_markup: Any = None) -> Optional[Dict[str, Any]]:
+    """Send message to Telegram user, returns the sent Message (None on failure)"""
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -400,69 +1820,730 @@ async def send_telegram_message(chat_id: int, text: str, parse_mode: str = "Mark
     if reply_markup:
         payload["reply_markup"] = reply_markup
     
-    try:
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code == 200:
-            logging.info(f"✅ Сообщение отправлено в чат {chat_id}")
+    result = await telegram_request("sendMessage", payload)
+    if result.get('ok'):
+        logging.info(f"✅ Сообщение отправлено в чат {chat_id}")
+        target = callback_message.get()
+        if target is not None and target[0] == chat_id:
+            # Новое сообщение уже ниже нажатой кнопки - следующие экраны тоже идут новыми
+            callback_message.set(None)
+        return result.get('result', {})
+    else:
+        logging.error(f"❌ Ошибка отправки сообщения в чат {chat_id}: {result.get('error_code')} - {result.get('description')}")
+        return None
+
+# Message rendering
+# Navigation screens replace the message whose button was pressed instead of
+# posting a new one. rendered_messages remembers what each message shows, keyed
+# by (chat_id, message_id) and tagged with the message's date/edit_date. An edit
+# on another worker changes that version, so the stale copy is not used. The
+# version only has one-second resolution, though: two edits within the same
+# second share it. The copy is therefore trusted only once the second of its
+# version has passed. A concurrent edit in that very second can still go
+# unnoticed; it takes two workers editing one message within one second.
+callback_message: ContextVar[Optional[Tuple[int, int, int]]] = ContextVar("callback_message", default=None)
+rendered_messages = TTLCache("rendered_messages", RENDERED_MESSAGES_CACHE_SIZE, RENDERED_MESSAGES_CACHE_TTL)
+render_stats = dict.fromkeys(("sent", "edited", "markup_edited", "unchanged", "fallback"), 0)
+
+def message_version(message: Dict[str, Any]) -> int:
+    return message.get('edit_date') or message.get('date') or 0
+
+def message_fingerprint(text: str, parse_mode: str, reply_markup: Any) -> Tuple[int, int]:
+    """Hashes of the text and of the keyboard of a screen"""
+    markup = reply_markup if reply_markup is None or isinstance(reply_markup, str) else json_encode(reply_markup)
+    return hash((text, parse_mode)), hash(markup)
+
+async def render_message(chat_id: int, text: str, parse_mode: str = "Markdown", reply_markup: Any = None) -> bool:
+    """Show a screen: edit the message whose button was pressed, send a new one otherwise"""
+    fingerprint = message_fingerprint(text, parse_mode, reply_markup)
+    target = callback_message.get()
+    if target is not None and target[0] == chat_id:
+        message_id, version = target[1], target[2]
+        shown = rendered_messages.get((chat_id, message_id), None)
+        if shown is not None and (shown[0] != version or version >= time.time() - 1):
+            shown = None  # Сообщение с тех пор меняли или могли поменять в ту же секунду
+        if shown is not None and shown[1] == fingerprint:
+            render_stats["unchanged"] += 1
             return True
+        
+        payload = {"chat_id": chat_id, "message_id": message_id}
+        if shown is not None and shown[1][0] == fingerprint[0]:
+            method, counter = "editMessageReplyMarkup", "markup_edited"
         else:
-            error_data = response.json() if response.headers.get('content-type') == 'application/json' else response.text
-            logging.error(f"❌ Ошибка отправки сообщения в чат {chat_id}: {response.status_code} - {error_data}")
-            return False
-    except Exception as e:
-        logging.error(f"❌ Исключение при отправке сообщения в чат {chat_id}: {e}")
+            method, counter = "editMessageText", "edited"
+            payload.update(text=text, parse_mode=parse_mode)
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        
+        result = await telegram_request(method, payload)
+        if result.get('ok') or "message is not modified" in str(result.get('description')):
+            edited = result.get('result')
+            if isinstance(edited, dict):
+                version = message_version(edited)
+            rendered_messages.set((chat_id, message_id), (version, fingerprint))
+            callback_message.set((chat_id, message_id, version))
+            render_stats[counter] += 1
+            return True
+        # Например, в сообщении нет текста (счет, файл) - показываем экран новым сообщением
+        logging.info(f"Cannot edit message {message_id} in chat {chat_id}: {result.get('description')}")
+        render_stats["fallback"] += 1
+    
+    message = await post_telegram_message(chat_id, text, parse_mode, reply_markup)
+    if message is None:
         return False
+    render_stats["sent"] += 1
+    if message.get('message_id'):
+        rendered_messages.set((chat_id, message['message_id']), (message_version(message), fingerprint))
+    return True
+
+async def send_telegram_document(chat_id: int, filename: str, content: bytes, caption: str = None) -> bool:
+    """Upload a file to Telegram user"""
+    data = {"chat_id": chat_id}
+    if caption:
+        data["caption"] = caption
+    result = await telegram_request("sendDocument", data, files={"document": (filename, content, "text/plain")})
+    if result.get('ok'):
+        return True
+    logging.error(f"❌ Ошибка отправки файла в чат {chat_id}: {result.get('error_code')} - {result.get('description')}")
+    return False
+
+async def send_search_reply(chat_id: int, reply: SearchReply) -> bool:
+    """Send formatted search results, menu goes under the last message. True if every part was delivered"""
+    delivered = True
+    for index, text in enumerate(reply.messages, 1):
+        is_last = index == len(reply.messages) and reply.document is None
+        delivered &= await send_telegram_message(chat_id, text, reply_markup=create_main_menu() if is_last else None)
+    if reply.document is not None:
+        filename = f"search_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.txt"
+        delivered &= await send_telegram_document(chat_id, filename, reply.document)
+        await send_telegram_message(chat_id, "🔍 *Выберите действие:*", reply_markup=create_main_menu())
+    return delivered
 
 async def get_or_create_user(telegram_id: int, username: str = None, first_name: str = None, last_name: str = None, referral_code: str = None) -> tuple[User, bool]:
-    """Get existing user or create new one. Returns (user, is_new_user)"""
-    user_data = await db.users.find_one({"telegram_id": telegram_id})
+    """Get existing user or create new one. Returns (user, is_new_user)
+
+    Single atomic upsert: profile fields are refreshed on every call, defaults
+    are written only when the user document is inserted.
+    """
+    now = datetime.utcnow()
+    profile = {
+        "last_active": now,
+        "username": username,
+        "first_name": first_name,
+        "last_name": last_name,
+        "is_admin": telegram_id == ADMIN_TELEGRAM_ID,  # Проверяем по ID, а не username
+        "is_blocked": False  # Пользователь снова пишет боту
+    }
+    new_user = User(
+        telegram_id=telegram_id,
+        referral_code=generate_referral_code(telegram_id),
+        balance=0.0,  # Новые пользователи без денег
+        created_at=now,
+        **profile
+    )
+    defaults = {key: value for key, value in new_user.dict().items() if key not in profile and key != "telegram_id"}
     
-    if user_data:
-        # Проверяем и обновляем админ статус по Telegram ID
-        is_admin = telegram_id == ADMIN_TELEGRAM_ID
-        
-        await db.users.update_one(
-            {"telegram_id": telegram_id},
-            {
-                "$set": {
-                    "last_active": datetime.utcnow(),
-                    "username": username,
-                    "first_name": first_name,
-                    "last_name": last_name,
-                    "is_admin": is_admin  # Обновляем админ статус по ID
-                }
-            }
-        )
-        
-        # Обновляем объект пользователя с новым админ статусом
-        user_data['is_admin'] = is_admin
-        user_data['username'] = username
-        user_data['first_name'] = first_name
-        user_data['last_name'] = last_name
-        user_data['last_active'] = datetime.utcnow()
-        
-        return User(**user_data), False
-    else:
-        referral_code_generated = generate_referral_code(telegram_id)
-        is_admin = telegram_id == ADMIN_TELEGRAM_ID  # Проверяем по ID, а не username
-        
-        user = User(
-            telegram_id=telegram_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name,
-            referral_code=referral_code_generated,
-            is_admin=is_admin,
-            balance=0.0  # Новые пользователи без денег
-        )
-        
-        await db.users.insert_one(user.dict())
+    for attempt in range(2):
+        try:
+            user_data = await db.users.find_one_and_update(
+                {"telegram_id": telegram_id},
+                {"$set": profile, "$setOnInsert": defaults},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            # Параллельное первое сообщение уже создало пользователя - повторяем как обновление
+            if attempt:
+                raise
+    
+    # Referral code is only written on insert, so it identifies the document we created
+    is_new_user = user_data['referral_code'] == new_user.referral_code
+    
+    if is_new_user:
+        await increment_stats({"users": 1})
         
         # Process referral for new user
         if referral_code:
             await process_referral(telegram_id, referral_code)
-        
-        return user, True
+    
+    return User(**user_data), is_new_user
+
+# Statistics
+# Counters are kept in the stats collection: one "totals" document and one
+# "daily:YYYY-MM-DD" document per day. They are incremented next to the writes
+# they count and periodically reconciled against the raw collections.
+STATS_TOTALS_ID = "totals"
+
+stats_cache = TTLCache("stats", 1, STATS_CACHE_TTL)
+
+async def increment_stats(counters: Dict[str, float]):
+    """Increment total and today's counters in one round-trip"""
+    day = datetime.utcnow().strftime('%Y-%m-%d')
+    try:
+        await db.stats.bulk_write([
+            UpdateOne({"_id": STATS_TOTALS_ID}, {"$inc": counters}, upsert=True),
+            UpdateOne({"_id": f"daily:{day}"}, {"$inc": counters, "$setOnInsert": {"date": day}}, upsert=True)
+        ], ordered=False)
+    except Exception as e:
+        logging.error(f"Stats update error: {e}")
+
+async def reconcile_stats() -> Dict[str, Any]:
+    """Recalculate totals from raw collections"""
+    search_totals = await db.searches.aggregate([
+        {"$group": {
+            "_id": None,
+            "searches": {"$sum": 1},
+            "successful_searches": {"$sum": {"$cond": ["$success", 1, 0]}},
+            "search_revenue": {"$sum": "$cost"}
+        }}
+    ]).to_list(1)
+    payment_totals = await db.payments.aggregate([
+        {"$match": {"status": "completed"}},
+        {"$group": {"_id": "$payment_type", "count": {"$sum": 1}, "amount": {"$sum": "$amount"}}}
+    ]).to_list(None)
+    
+    totals = {
+        "users": await db.users.count_documents({}),
+        "referrals": await db.referrals.count_documents({}),
+        "active_subscriptions": await db.users.count_documents({"subscription_expires": {"$gt": datetime.utcnow()}}),
+        "searches": 0,
+        "successful_searches": 0,
+        "search_revenue": 0.0,
+        "payments": sum(entry['count'] for entry in payment_totals),
+        "reconciled_at": datetime.utcnow()
+    }
+    if search_totals:
+        for key in ("searches", "successful_searches", "search_revenue"):
+            totals[key] = search_totals[0][key]
+    for entry in payment_totals:
+        totals[f"payments_amount.{entry['_id']}"] = entry['amount']
+    
+    # Subscription purchases are not logged separately, their counters stay incremental
+    await db.stats.update_one({"_id": STATS_TOTALS_ID}, {"$set": totals}, upsert=True)
+    stats_cache.clear()
+    await publish_cache_invalidation(stats_cache)
+    logging.info(f"Stats reconciled: {totals['users']} users, {totals['searches']} searches")
+    return totals
+
+async def get_stats_snapshot() -> Dict[str, Any]:
+    """Current totals, served from cache"""
+    snapshot = stats_cache.get(STATS_TOTALS_ID)
+    if snapshot is CACHE_MISS:
+        snapshot = await db.stats.find_one({"_id": STATS_TOTALS_ID})
+        if snapshot is None:
+            await reconcile_stats()
+            snapshot = await db.stats.find_one({"_id": STATS_TOTALS_ID})
+        stats_cache.set(STATS_TOTALS_ID, snapshot)
+    return snapshot
+
+async def get_daily_stats(days: int) -> List[Dict[str, Any]]:
+    """Daily counters for the last days, oldest first"""
+    today = datetime.utcnow()
+    since = (today - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    series = await db.stats.find(
+        {"_id": {"$gte": f"daily:{since}", "$lte": f"daily:{today.strftime('%Y-%m-%d')}"}},
+        {"_id": 0}
+    ).sort("_id", 1).to_list(days)
+    return series
+
+async def stats_reconcile_loop():
+    """Reconcile stats counters periodically"""
+    while True:
+        try:
+            await reconcile_stats()
+        except Exception as e:
+            logging.error(f"Stats reconciliation failed: {e}")
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+
+# Per-user counters (users.total_searches, successful_searches, confirmed_referrals)
+# are incremented next to the searches/referrals writes; this rebuilds them.
+USER_COUNTERS_BATCH_SIZE = 1000
+
+async def reconcile_user_counters() -> int:
+    """Recalculate per-user counters from searches and referrals. Returns users updated"""
+    counters: Dict[int, Dict[str, int]] = {}
+    async for entry in db.searches.aggregate([
+        {"$group": {
+            "_id": "$user_id",
+            "total_searches": {"$sum": 1},
+            "successful_searches": {"$sum": {"$cond": ["$success", 1, 0]}}
+        }}
+    ]):
+        counters[entry['_id']] = {"total_searches": entry['total_searches'], "successful_searches": entry['successful_searches']}
+    async for entry in db.referrals.aggregate([
+        {"$match": {"confirmed": True}},
+        {"$group": {"_id": "$referrer_id", "confirmed_referrals": {"$sum": 1}}}
+    ]):
+        counters.setdefault(entry['_id'], {})["confirmed_referrals"] = entry['confirmed_referrals']
+    
+    # Пользователи без поисков и рефералов получают нули
+    for field in ("total_searches", "successful_searches", "confirmed_referrals"):
+        await db.users.update_many({field: {"$exists": False}}, {"$set": {field: 0}})
+    
+    updated = 0
+    batch = []
+    for telegram_id, values in counters.items():
+        values = {"total_searches": 0, "successful_searches": 0, "confirmed_referrals": 0, **values}
+        batch.append(UpdateOne({"telegram_id": telegram_id}, {"$set": values}))
+        if len(batch) >= USER_COUNTERS_BATCH_SIZE:
+            updated += (await db.users.bulk_write(batch, ordered=False)).matched_count
+            batch = []
+    if batch:
+        updated += (await db.users.bulk_write(batch, ordered=False)).matched_count
+    logging.info(f"User counters reconciled: {updated} users")
+    return updated
+
+async def expire_subscriptions() -> int:
+    """Clear expired subscriptions and refresh the active subscriptions counter"""
+    now = datetime.utcnow()
+    result = await db.users.update_many(
+        {"subscription_expires": {"$lte": now}, "subscription_type": {"$ne": None}},
+        {"$set": {"subscription_type": None}}
+    )
+    if result.modified_count:
+        active = await db.users.count_documents({"subscription_expires": {"$gt": now}})
+        await db.stats.update_one({"_id": STATS_TOTALS_ID}, {"$set": {"active_subscriptions": active}}, upsert=True)
+        stats_cache.clear()
+        await publish_cache_invalidation(stats_cache)
+        logging.info(f"Expired {result.modified_count} subscriptions")
+    return result.modified_count
+
+async def subscription_expiry_loop():
+    """Expire subscriptions periodically"""
+    while True:
+        try:
+            await expire_subscriptions()
+        except Exception as e:
+            logging.error(f"Subscription expiry failed: {e}")
+        await asyncio.sleep(SUBSCRIPTION_EXPIRY_INTERVAL)
+
+# Cluster coordination
+# Several workers (uvicorn processes or hosts) share one webhook URL. Singleton
+# jobs are elected through leases in the leases collection; cache invalidations
+# are published to cluster_events and applied by every other worker, received
+# through a change stream on replica sets or by polling otherwise.
+# Leases rely on roughly synchronized clocks between hosts.
+async def acquire_lease(name: str) -> bool:
+    """Take or renew a named lease. False if another worker holds it"""
+    now = datetime.utcnow()
+    try:
+        await db.leases.update_one(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=LEASE_TTL), "renewed_at": now}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Документ есть, но аренда действует у другого воркера
+        return False
+    return True
+
+async def release_lease(name: str):
+    await db.leases.delete_one({"_id": name, "owner": WORKER_ID})
+
+async def run_with_lease(name: str, job: Callable[[], Any]) -> bool:
+    """Run job() while holding the lease, renewing it in the background.
+
+    Returns False right away if another worker holds the lease. The job is
+    cancelled if the lease can't be renewed before it expires.
+    """
+    if not await acquire_lease(name):
+        return False
+    task = asyncio.create_task(job())
+    renewed_at = time.monotonic()
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=LEASE_RENEW_INTERVAL)
+            if done:
+                await task
+                return True
+            try:
+                held = await acquire_lease(name)
+                if held:
+                    renewed_at = time.monotonic()
+            except Exception as e:
+                logging.error(f"Lease {name} renewal failed: {e}")
+                held = time.monotonic() - renewed_at < LEASE_TTL
+            if not held:
+                logging.warning(f"Lease {name} lost by {WORKER_ID}, stopping job")
+                return True
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        try:
+            await release_lease(name)
+        except Exception as e:
+            logging.error(f"Lease {name} release failed: {e}")
+
+async def singleton_loop(name: str, job: Callable[[], Any]):
+    """Keep exactly one instance of a background job running across workers"""
+    while True:
+        try:
+            if await run_with_lease(name, job):
+                logging.info(f"Singleton job {name} stopped on {WORKER_ID}")
+        except Exception as e:
+            logging.error(f"Singleton job {name} failed: {e}")
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+
+cluster_event_handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+cluster_event_stats = {"mode": None, "published": 0, "received": 0}
+
+async def publish_event(topic: str, payload: Dict[str, Any]):
+    """Notify other workers. Delivery is best effort"""
+    if CLUSTER_EVENTS_MODE == "off":
+        return
+    try:
+        await db.cluster_events.insert_one({
+            "topic": topic,
+            "payload": payload,
+            "origin": WORKER_ID,
+            "created_at": datetime.utcnow()
+        })
+        cluster_event_stats["published"] += 1
+    except Exception as e:
+        logging.error(f"Cluster event publish failed ({topic}): {e}")
+
+async def publish_cache_invalidation(cache: TTLCache, key: Any = None):
+    """Drop a key (or the whole cache when key is None) on other workers"""
+    await publish_event("cache.invalidate", {"cache": cache.name, "key": key})
+
+def apply_cache_invalidation(payload: Dict[str, Any]):
+    cache = caches.get(payload.get('cache'))
+    if cache is None:
+        return
+    if payload.get('key') is None:
+        cache.clear()
+    else:
+        cache.invalidate(payload['key'])
+
+cluster_event_handlers["cache.invalidate"] = apply_cache_invalidation
+
+def dispatch_cluster_event(event: Dict[str, Any]):
+    if event.get('origin') == WORKER_ID:
+        return
+    handler = cluster_event_handlers.get(event.get('topic'))
+    if handler is None:
+        return
+    cluster_event_stats["received"] += 1
+    try:
+        handler(event.get('payload') or {})
+    except Exception as e:
+        logging.error(f"Cluster event {event.get('topic')} handling failed: {e}")
+
+async def watch_cluster_events():
+    async with db.cluster_events.watch([{"$match": {"operationType": "insert"}}]) as stream:
+        cluster_event_stats["mode"] = "change_stream"
+        async for change in stream:
+            dispatch_cluster_event(change['fullDocument'])
+
+async def poll_cluster_events():
+    cluster_event_stats["mode"] = "poll"
+    seen: deque = deque()
+    seen_ids = set()
+    while True:
+        # ObjectId с разных хостов не строго монотонны - перечитываем окно и отбрасываем виденные
+        window_start = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=CLUSTER_EVENTS_LOOKBACK))
+        async for event in db.cluster_events.find({"_id": {"$gt": window_start}}).sort("_id", 1):
+            if event['_id'] in seen_ids:
+                continue
+            seen.append(event['_id'])
+            seen_ids.add(event['_id'])
+            dispatch_cluster_event(event)
+        while seen and seen[0] <= window_start:
+            seen_ids.discard(seen.popleft())
+        await asyncio.sleep(CLUSTER_EVENTS_POLL_INTERVAL)
+
+async def cluster_events_listener():
+    """Receive events published by other workers"""
+    use_change_stream = CLUSTER_EVENTS_MODE in ("auto", "change_stream")
+    while True:
+        try:
+            if use_change_stream:
+                await watch_cluster_events()
+            else:
+                await poll_cluster_events()
+        except OperationFailure as e:
+            if use_change_stream and CLUSTER_EVENTS_MODE == "auto" and e.code == 40573:
+                # Change streams работают только на replica set
+                logging.info("Change streams unavailable, polling cluster_events")
+                use_change_stream = False
+                continue
+            logging.error(f"Cluster events listener error: {e}")
+        except Exception as e:
+            logging.error(f"Cluster events listener error: {e}")
+        await asyncio.sleep(CLUSTER_EVENTS_POLL_INTERVAL)
+
+# Update processing
+def get_update_chat_key(update_data: Dict[str, Any]) -> Any:
+    """Get the key used to keep updates of one chat in order"""
+    message = update_data.get('message') or update_data.get('callback_query', {}).get('message')
+    if message and message.get('chat', {}).get('id') is not None:
+        return message['chat']['id']
+    for key in ('callback_query', 'pre_checkout_query'):
+        sender_id = update_data.get(key, {}).get('from', {}).get('id')
+        if sender_id is not None:
+            return sender_id
+    return f"update_{update_data.get('update_id')}"
+
+# Telegram redelivers updates (webhook retries, polling restarts). Every update
+# is claimed once: in-process cache first, then an insert into processed_updates
+# (TTL), which also covers other workers. The claim starts as "processing" with a
+# lease and becomes "done" once handled. A failed update releases its claim; one
+# whose worker died keeps it only until the lease runs out, after which a
+# redelivery takes it over. Only "done" updates are duplicates for good.
+processed_updates_cache = TTLCache("processed_updates", PROCESSED_UPDATES_CACHE_SIZE, PROCESSED_UPDATES_TTL)
+update_dedup_stats = {"duplicates": 0, "lease_takeovers": 0, "complete_failures": 0}
+
+async def claim_update(update_id: int) -> bool:
+    """Lease update for processing. False if it is done or leased elsewhere"""
+    if processed_updates_cache.get(update_id) is not CACHE_MISS:
+        update_dedup_stats["duplicates"] += 1
+        return False
+    # Отметка в кэше держит повторы в этом процессе, пока идет запрос в Mongo
+    processed_updates_cache.set(update_id, True)
+    try:
+        return await claim_update_in_db(update_id)
+    except Exception:
+        # Mongo недоступна - не помним обновление, иначе повторная доставка потеряется
+        processed_updates_cache.invalidate(update_id)
+        raise
+
+async def claim_update_in_db(update_id: int) -> bool:
+    """Insert the lease or take over an expired one"""
+    now = datetime.utcnow()
+    lease_until = now + timedelta(seconds=PROCESSED_UPDATES_LEASE)
+    try:
+        await db.processed_updates.insert_one(
+            {"_id": update_id, "status": "processing", "lease_until": lease_until, "created_at": now}
+        )
+        return True
+    except DuplicateKeyError:
+        pass
+    # Обработчик упал вместе с процессом - забираем просроченную аренду
+    taken = await db.processed_updates.find_one_and_update(
+        {"_id": update_id, "status": "processing", "lease_until": {"$lt": now}},
+        {"$set": {"lease_until": lease_until}}
+    )
+    if taken is not None:
+        update_dedup_stats["lease_takeovers"] += 1
+        logging.warning(f"Update {update_id} lease expired, processing it again")
+        return True
+    claim = await db.processed_updates.find_one({"_id": update_id}, {"status": 1})
+    if claim is None or claim.get("status") == "processing":
+        # Аренда еще у другого воркера - не запоминаем, чтобы повтор после его падения прошел
+        processed_updates_cache.invalidate(update_id)
+    update_dedup_stats["duplicates"] += 1
+    return False
+
+async def complete_update(update_id: int):
+    """Mark a leased update as handled, retrying so the lease does not expire into a rerun"""
+    for attempt in range(PROCESSED_UPDATES_COMPLETE_ATTEMPTS):
+        try:
+            await db.processed_updates.update_one({"_id": update_id}, {"$set": {"status": "done"}})
+            return
+        except Exception as e:
+            logging.warning(f"Cannot mark update {update_id} as done (attempt {attempt + 1}): {e}")
+            if attempt + 1 < PROCESSED_UPDATES_COMPLETE_ATTEMPTS:
+                await asyncio.sleep(PROCESSED_UPDATES_COMPLETE_BACKOFF * 2 ** attempt)
+    # Повтор после истечения аренды обработает обновление снова; платежи защищены payment_id
+    update_dedup_stats["complete_failures"] += 1
+    logging.error(f"Update {update_id} stays leased, it will be processed again after {PROCESSED_UPDATES_LEASE}s")
+
+async def release_update(update_id: int):
+    """Forget the claim so the update is processed again when redelivered"""
+    processed_updates_cache.invalidate(update_id)
+    await db.processed_updates.delete_one({"_id": update_id})
+
+def get_update_type(update_data: Dict[str, Any]) -> str:
+    """Dispatch branch of handle_telegram_update the update goes to"""
+    for update_type in ('pre_checkout_query', 'callback_query'):
+        if update_type in update_data:
+            return update_type
+    message = update_data.get('message')
+    if not message:
+        return "other"
+    if message.get('successful_payment'):
+        return "successful_payment"
+    if message.get('text', '').startswith('/'):
+        return "command"
+    return "message"
+
+# Webhook replies
+# Telegram accepts one Bot API call as the body of the webhook response. When
+# that call depends on the update alone, the webhook returns it and records the
+# method on the update; the handler then skips it. Polling has no response body,
+# so the same handlers make a regular request there.
+WEBHOOK_REPLY_KEY = "_webhook_reply"  # Telegram не использует ключи с подчеркиванием
+webhook_reply_builders: Dict[str, Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]] = {}
+webhook_replied: ContextVar[Optional[str]] = ContextVar("webhook_replied", default=None)
+webhook_reply_stats: Dict[str, int] = {}
+
+def build_webhook_reply(update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Method call to return from the webhook, marks the update as answered"""
+    for update_type, builder in webhook_reply_builders.items():
+        if update_type in update_data:
+            reply = builder(update_data[update_type])
+            if reply is not None:
+                update_data[WEBHOOK_REPLY_KEY] = reply["method"]
+            return reply
+    return None
+
+def replied_in_webhook(method: str) -> bool:
+    """True when the current update's reply already went out as the webhook response"""
+    return webhook_replied.get() == method
+
+def callback_query_reply(callback_query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if not callback_query.get('id'):
+        return None
+    return {"method": "answerCallbackQuery", "callback_query_id": callback_query['id']}
+
+def pre_checkout_answer(pre_checkout_query: Dict[str, Any]) -> Dict[str, Any]:
+    """answerPreCheckoutQuery parameters: approve valid Stars payments only"""
+    if pre_checkout_query.get('invoice_payload', '').startswith('stars_payment_'):
+        return {"pre_checkout_query_id": pre_checkout_query.get('id'), "ok": True}
+    return {"pre_checkout_query_id": pre_checkout_query.get('id'), "ok": False, "error_message": "Неверный платеж"}
+
+def pre_checkout_query_reply(pre_checkout_query: Dict[str, Any]) -> Dict[str, Any]:
+    return {"method": "answerPreCheckoutQuery", **pre_checkout_answer(pre_checkout_query)}
+
+webhook_reply_builders["callback_query"] = callback_query_reply
+webhook_reply_builders["pre_checkout_query"] = pre_checkout_query_reply
+
+async def process_telegram_update(update_data: Dict[str, Any]):
+    """Handle an update at most once per update_id"""
+    # Воркер обрабатывает обновления по очереди в одной задаче - значение выставляется каждый раз
+    webhook_replied.set(update_data.get(WEBHOOK_REPLY_KEY))
+    update_id = update_data.get('update_id')
+    if update_id is None:
+        await handle_telegram_update(update_data)
+        return
+    if not await claim_update(update_id):
+        logging.info(f"Duplicate update {update_id} skipped")
+        return
+    histogram = update_latency.labels(get_update_type(update_data))
+    histogram.in_flight += 1
+    started_at = time.perf_counter()
+    failed = True
+    try:
+        await handle_telegram_update(update_data)
+        failed = False
+    except Exception:
+        await release_update(update_id)
+        raise
+    finally:
+        histogram.in_flight -= 1
+        histogram.observe(time.perf_counter() - started_at, failed)
+    await complete_update(update_id)
+
+class UpdateQueue:
+    """Bounded in-process queue of Telegram updates processed by async workers.
+
+    Updates of the same chat are handled strictly in order, different chats in parallel.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.handle_time_total = 0.0
+        self.handle_time_max = 0.0
+        self._lanes: Dict[Any, deque] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        """Start worker tasks"""
+        if self.running:
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Update queue started with {self.workers} workers")
+
+    async def stop(self, timeout: float = 10.0):
+        """Wait for pending updates (up to timeout) and stop workers"""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.pending:
+            logging.warning(f"Update queue stopped with {self.pending} unprocessed updates")
+
+    def submit(self, update_data: Dict[str, Any], on_done: Callable[[Dict[str, Any]], None] = None) -> bool:
+        """Enqueue update. Returns False when the queue is full.
+
+        on_done is called once the update is handled (successfully or not).
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return False
+        key = get_update_chat_key(update_data)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+            self._ready.put_nowait(key)
+        lane.append((time.monotonic(), update_data, on_done))
+        self.pending += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            lane = self._lanes[key]
+            # Lane stays registered while it is drained, so new updates of this chat
+            # are appended here instead of being picked up by another worker
+            while lane:
+                enqueued_at, update_data, on_done = lane.popleft()
+                started_at = time.monotonic()
+                waited = started_at - enqueued_at
+                self.wait_time_total += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+                try:
+                    await process_telegram_update(update_data)
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"Update {update_data.get('update_id')} processing failed: {e}")
+                finally:
+                    self.pending -= 1
+                    handled = time.monotonic() - started_at
+                    self.handle_time_total += handled
+                    self.handle_time_max = max(self.handle_time_max, handled)
+                    if on_done is not None:
+                        on_done(update_data)
+            del self._lanes[key]
+
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth and latency metrics"""
+        finished = self.processed + self.failed
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "active_chats": len(self._lanes),
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.wait_time_total / finished * 1000, 2) if finished else 0.0,
+            "max_wait_ms": round(self.wait_time_max * 1000, 2),
+            "avg_handle_ms": round(self.handle_time_total / finished * 1000, 2) if finished else 0.0,
+            "max_handle_ms": round(self.handle_time_max * 1000, 2)
+        }
+
+update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_MAX_PENDING)
 
 # API Routes
 @api_router.get("/")
@@ -477,11 +2558,105 @@ async def telegram_webhook(secret: str, request: Request):
     
     try:
         update_data = await request.json()
-        await handle_telegram_update(update_data)
-        return {"status": "ok"}
     except Exception as e:
         logging.error(f"Webhook processing failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Webhook processing failed: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid update: {str(e)}")
+    
+    reply = build_webhook_reply(update_data)
+    if not update_queue.running:
+        # Queue is not started (e.g. app imported without startup) - process inline
+        await process_telegram_update(update_data)
+    elif not update_queue.submit(update_data):
+        # Telegram will redeliver the update later
+        logging.warning(f"Update queue is full, rejecting update {update_data.get('update_id')}")
+        raise HTTPException(status_code=503, detail="Update queue is full")
+    
+    if reply is None:
+        return {"status": "ok"}
+    # Считаем только принятые обновления: после 503 ответ не уходит
+    webhook_reply_stats[reply["method"]] = webhook_reply_stats.get(reply["method"], 0) + 1
+    return Response(render_json(reply), media_type="application/json")
+
+@api_router.get("/cache/stats")
+async def get_cache_stats():
+    """Get hit rates of in-process caches"""
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    
+    upstream_checks = subscription_check_stats["upstream_checks"]
+    avg_check_ms = subscription_check_stats["upstream_time"] / upstream_checks * 1000 if upstream_checks else 0.0
+    saved_checks = subscription_cache.hits + subscription_check_stats["stored_hits"]
+    stats["subscription"].update({
+        "stored_hits": subscription_check_stats["stored_hits"],
+        "upstream_checks": upstream_checks,
+        "avg_check_ms": round(avg_check_ms, 2),
+        "saved_ms": round(saved_checks * avg_check_ms, 2)
+    })
+    stats["search"].update(search_cache_stats)
+    stats["search"]["inflight"] = len(search_inflight)
+    return stats
+
+@api_router.get("/updates/metrics")
+async def get_update_metrics():
+    """Get update queue depth and latency metrics"""
+    return {**update_queue.metrics(), **update_dedup_stats, "telegram_send": telegram_dispatcher.metrics(), "render": render_stats,
+            "webhook_replies": webhook_reply_stats}
+
+def render_metrics() -> str:
+    """All metrics in Prometheus text exposition format"""
+    lines = []
+    for family in metric_families:
+        lines.extend(family.render())
+    queue = update_queue.metrics()
+    lines.append("# TYPE bot_update_queue_pending gauge")
+    lines.append(f"bot_update_queue_pending {queue['pending']}")
+    for counter in ("processed", "failed", "rejected"):
+        lines.append(f"# TYPE bot_update_queue_{counter}_total counter")
+        lines.append(f"bot_update_queue_{counter}_total {queue[counter]}")
+    send = telegram_dispatcher.metrics()
+    lines.append("# TYPE bot_telegram_send_pending gauge")
+    lines.extend(f'bot_telegram_send_pending{{priority="{priority}"}} {count}' for priority, count in send["pending"].items())
+    lines.append("# TYPE bot_telegram_send_retrying gauge")
+    lines.append(f"bot_telegram_send_retrying {send['retrying']}")
+    lines.append("# TYPE bot_telegram_send_bulk_waiting gauge")
+    lines.append(f"bot_telegram_send_bulk_waiting {send['bulk_waiting']}")
+    lines.append("# TYPE bot_telegram_send_total counter")
+    lines.extend(f'bot_telegram_send_total{{result="{result}"}} {send[result]}' for result in ("sent", "failed"))
+    for counter in ("retries", "dropped"):
+        lines.append(f"# TYPE bot_telegram_send_{counter}_total counter")
+        lines.extend(f'bot_telegram_send_{counter}_total{{reason="{reason}"}} {count}' for reason, count in send[counter].items())
+    lines.append("# TYPE bot_callback_unmatched_total counter")
+    lines.append(f"bot_callback_unmatched_total {callback_router.unmatched}")
+    lines.append("# TYPE bot_callback_denied_total counter")
+    lines.append(f"bot_callback_denied_total {callback_router.denied}")
+    lines.append("# TYPE bot_webhook_replies_total counter")
+    lines.extend(f'bot_webhook_replies_total{{method="{method}"}} {count}' for method, count in webhook_reply_stats.items())
+    lines.append("# TYPE bot_render_total counter")
+    lines.extend(f'bot_render_total{{result="{result}"}} {count}' for result, count in render_stats.items())
+    lines.append("# TYPE bot_update_duplicates_total counter")
+    lines.append(f"bot_update_duplicates_total {update_dedup_stats['duplicates']}")
+    lines.append("# TYPE bot_update_lease_takeovers_total counter")
+    lines.append(f"bot_update_lease_takeovers_total {update_dedup_stats['lease_takeovers']}")
+    lines.append("# TYPE bot_update_complete_failures_total counter")
+    lines.append(f"bot_update_complete_failures_total {update_dedup_stats['complete_failures']}")
+    for counter in ("hits", "misses", "evictions"):
+        lines.append(f"# TYPE bot_cache_{counter}_total counter")
+        lines.extend(f'bot_cache_{counter}_total{{cache="{name}"}} {getattr(cache, counter)}' for name, cache in caches.items())
+    return "\n".join(lines) + "\n"
+
+@api_router.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@api_router.get("/cluster/status")
+async def get_cluster_status():
+    """Get this worker's id, leases and cluster event delivery state"""
+    leases = await db.leases.find().to_list(None)
+    return {
+        "worker_id": WORKER_ID,
+        "events": cluster_event_stats,
+        "leases": [serialize_document(lease) for lease in leases]
+    }
 
 @api_router.post("/cryptobot/webhook")
 async def cryptobot_webhook(request: Request):
@@ -494,6 +2669,47 @@ async def cryptobot_webhook(request: Request):
         logging.error(f"CryptoBot webhook processing failed: {e}")
         raise HTTPException(status_code=500, detail=f"CryptoBot webhook processing failed: {str(e)}")
 
+async def credit_payment(payment: Payment) -> bool:
+    """Record payment and credit the balance once per payment_id.
+
+    The payment is inserted as "pending" first: the unique payment_id index
+    makes a redelivered notification land on the existing record instead.
+    A record still "pending" there means an earlier delivery died before
+    crediting, so it is finished now. Only the delivery that moves the record
+    from "pending" to "crediting" touches the balance.
+    Returns False for processed duplicates and unknown users.
+    """
+    payment.status = "pending"
+    try:
+        inserted = await db.payments.insert_one(payment.dict())
+        record_filter = {"_id": inserted.inserted_id}
+    except DuplicateKeyError:
+        record_filter = {"payment_id": payment.payment_id}
+    
+    record = await db.payments.find_one_and_update(
+        {**record_filter, "status": "pending"},
+        {"$set": {"status": "crediting"}}
+    )
+    if record is None:
+        logging.warning(f"Payment {payment.payment_id} already processed, skipping")
+        return False
+    if "_id" not in record_filter:
+        logging.warning(f"Payment {payment.payment_id} was left pending, crediting it now")
+    
+    result = await db.users.update_one(
+        {"telegram_id": payment.user_id},
+        {"$inc": {"balance": payment.amount}}
+    )
+    payment.status = "completed" if result.matched_count else "failed"
+    await db.payments.update_one({"_id": record["_id"]}, {"$set": {"status": payment.status}})
+    if payment.status != "completed":
+        logging.error(f"Failed to update balance for user {payment.user_id}")
+        return False
+    
+    await increment_stats({"payments": 1, f"payments_amount.{payment.payment_type}": payment.amount})
+    return True
+
+@instrumented
 async def handle_cryptobot_payment(webhook_data: Dict[str, Any]):
     """Handle CryptoBot payment notification"""
     try:
@@ -521,23 +2737,14 @@ async def handle_cryptobot_payment(webhook_data: Dict[str, Any]):
             user_id = int(user_match.group(1))
             
             if status == 'paid':
-                # Update user balance
-                result = await db.users.update_one(
-                    {"telegram_id": user_id},
-                    {"$inc": {"balance": amount}}
+                payment = Payment(
+                    user_id=user_id,
+                    amount=amount,
+                    payment_type="crypto",
+                    payment_id=str(invoice_id)
                 )
                 
-                if result.modified_count > 0:
-                    # Save payment record
-                    payment = Payment(
-                        user_id=user_id,
-                        amount=amount,
-                        payment_type="crypto",
-                        payment_id=invoice_id,
-                        status="completed"
-                    )
-                    await db.payments.insert_one(payment.dict())
-                    
+                if await credit_payment(payment):
                     # Send notification to user
                     notification_text = f"🎉 *ПОПОЛНЕНИЕ УСПЕШНО!*\n\n"
                     notification_text += f"🤖 *Способ:* Криптовалюта\n"
@@ -553,14 +2760,13 @@ async def handle_cryptobot_payment(webhook_data: Dict[str, Any]):
                     )
                     
                     logging.info(f"Crypto payment processed: {amount}₽ for user {user_id}")
-                else:
-                    logging.error(f"Failed to update balance for user {user_id}")
             else:
                 logging.warning(f"CryptoBot payment not paid: status={status}")
                 
     except Exception as e:
         logging.error(f"Error processing CryptoBot payment: {e}")
 
+@instrumented
 async def handle_callback_query(callback_query: Dict[str, Any]):
     """Handle callback queries from inline keyboard buttons"""
     chat_id = callback_query.get('message', {}).get('chat', {}).get('id')
@@ -568,13 +2774,20 @@ async def handle_callback_query(callback_query: Dict[str, Any]):
     data = callback_query.get('data')
     callback_query_id = callback_query.get('id')
     
-    # Answer callback query
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerCallbackQuery"
-        requests.post(url, json={"callback_query_id": callback_query_id}, timeout=5)
-    except:
-        pass
+    # Answer callback query: already done by the webhook response, otherwise concurrently with the user lookup
+    if not replied_in_webhook("answerCallbackQuery"):
+        run_detached(telegram_request("answerCallbackQuery", {"callback_query_id": callback_query_id}, timeout=5))
     
+    message = callback_query.get('message', {})
+    target = (chat_id, message['message_id'], message_version(message)) if chat_id and message.get('message_id') else None
+    token = callback_message.set(target)
+    try:
+        await dispatch_callback_query(callback_query, chat_id, user_id, data)
+    finally:
+        callback_message.reset(token)
+
+async def dispatch_callback_query(callback_query: Dict[str, Any], chat_id: int, user_id: int, data: str):
+    """Route a callback query to its handler"""
     user, is_new_user = await get_or_create_user(
         telegram_id=user_id,
         username=callback_query.get('from', {}).get('username'),
@@ -582,73 +2795,135 @@ async def handle_callback_query(callback_query: Dict[str, Any]):
         last_name=callback_query.get('from', {}).get('last_name')
     )
     
-    # Handle different callback data
-    if data == "check_subscription":
-        await handle_subscription_check(chat_id, user_id)
-    elif data == "back_to_menu":
-        await show_main_menu(chat_id, user)
-    elif data == "menu_search":
-        await show_search_menu(chat_id, user)
-    elif data == "menu_profile":
-        await show_profile_menu(chat_id, user)
-    elif data == "menu_balance":
-        await show_balance_menu(chat_id, user)
-    elif data == "menu_pricing":
-        await show_pricing_menu(chat_id, user)
-    elif data == "menu_referral":
-        await show_referral_menu(chat_id, user)
-    elif data == "menu_help":
-        await show_help_menu(chat_id, user)
-    elif data == "menu_rules":
-        await show_rules_menu(chat_id, user)
-    elif data.startswith("admin_") and user.is_admin:
-        await handle_admin_callback(chat_id, user, data)
-    elif data.startswith("pay_"):
-        await handle_payment_callback(chat_id, user, data)
-    elif data.startswith("buy_"):
-        await handle_purchase_callback(chat_id, user, data)
-    elif data.startswith("crypto_"):
-        logging.info(f"🤖 CRYPTO CALLBACK: {data}")
-        if "_btc" in data or "_eth" in data or "_usdt" in data or "_ltc" in data:
-            logging.info(f"🔍 Найдена криптовалюта в callback: {data}")
-            underscore_count = data.count("_")
-            logging.info(f"📊 Количество подчеркиваний: {underscore_count}")
-            
-            if data.count("_") >= 2:  # crypto_btc_100 or crypto_btc_custom format
-                parts = data.split("_")
-                logging.info(f"📝 Части callback: {parts}")
-                crypto_type = parts[1]
-                amount = parts[2]
-                logging.info(f"💰 crypto_type: {crypto_type}, amount: {amount}")
-                
-                if amount == "custom":
-                    logging.info("🔧 Вызываем handle_crypto_custom_amount")
-                    await handle_crypto_custom_amount(chat_id, user, crypto_type)
+    if data:
+        await callback_router.dispatch(data, chat_id, user)
+
+# Callback routing
+# Callback data is a list of "_"-separated segments. Routes without parameters
+# are found with one dict lookup, parameterized ones ("crypto_{crypto_type:coin}")
+# in a trie walked segment by segment, so adding routes does not slow down
+# matching of existing ones.
+def parse_crypto_type(value: str) -> str:
+    if value not in CRYPTO_NAMES:
+        raise ValueError(f"Unknown crypto currency: {value}")
+    return value
+
+CALLBACK_CONVERTERS: Dict[str, Callable[[str], Any]] = {
+    "str": str,
+    "int": int,
+    "coin": parse_crypto_type,
+}
+
+CALLBACK_PATTERN_SEGMENT = re.compile(r"\{[^}]+\}|[^_]+")  # Имена параметров могут содержать "_"
+
+class CallbackRoute(NamedTuple):
+    pattern: str
+    handler: Callable[..., Any]  # handler(chat_id, user, **params)
+    admin: bool
+    histogram: Histogram
+
+class CallbackTrieNode:
+    __slots__ = ("literals", "params", "route")
+
+    def __init__(self):
+        self.literals: Dict[str, "CallbackTrieNode"] = {}
+        self.params: List[tuple] = []  # (name, converter, node), tried after literals
+        self.route: Optional[CallbackRoute] = None
+
+class CallbackRouter:
+    """Callback data -> handler with exact and parameterized routes"""
+
+    def __init__(self):
+        self.exact: Dict[str, CallbackRoute] = {}
+        self.root = CallbackTrieNode()
+        self.unmatched = 0
+        self.denied = 0
+
+    def add(self, pattern: str, handler: Callable[..., Any], admin: bool = False):
+        """Register a route. Parameter segments are "{name}" or "{name:converter}" """
+        route = CallbackRoute(pattern, handler, admin, callback_latency.labels(pattern))
+        if "{" not in pattern:
+            self.exact[pattern] = route
+            return
+        node = self.root
+        for segment in CALLBACK_PATTERN_SEGMENT.findall(pattern):
+            if segment.startswith("{"):
+                name, _, converter_name = segment[1:-1].partition(":")
+                converter = CALLBACK_CONVERTERS[converter_name or "str"]
+                for param_name, param_converter, child in node.params:
+                    if (param_name, param_converter) == (name, converter):
+                        node = child
+                        break
                 else:
-                    logging.info("💳 Вызываем handle_crypto_payment_amount")
-                    await handle_crypto_payment_amount(chat_id, user, crypto_type, amount)
-            else:  # crypto_btc format
-                crypto_type = data.split("_")[1]
-                logging.info(f"🏠 Вызываем handle_crypto_payment для {crypto_type}")
-                await handle_crypto_payment(chat_id, user, crypto_type)
-        else:
-            logging.warning(f"❌ Неизвестный crypto callback: {data}")
-    elif data.startswith("stars_"):
-        amount = data.split("_")[1]
-        if amount == "custom":
-            await handle_stars_custom_amount(chat_id, user)
-        else:
-            await handle_stars_payment(chat_id, user, amount)
+                    child = CallbackTrieNode()
+                    node.params.append((name, converter, child))
+                    node = child
+            else:
+                node = node.literals.setdefault(segment, CallbackTrieNode())
+        if node.route is not None:
+            raise ValueError(f"Duplicate callback route: {pattern}")
+        node.route = route
+
+    def resolve(self, data: str) -> Optional[Tuple[CallbackRoute, Dict[str, Any]]]:
+        """Matching route and converted parameters"""
+        route = self.exact.get(data)
+        if route is not None:
+            return route, {}
+        return self._match(self.root, data.split("_"), 0, {})
+
+    def _match(self, node: CallbackTrieNode, segments: List[str], index: int, params: Dict[str, Any]):
+        if index == len(segments):
+            return (node.route, params) if node.route is not None else None
+        segment = segments[index]
+        child = node.literals.get(segment)
+        if child is not None:
+            found = self._match(child, segments, index + 1, params)
+            if found is not None:
+                return found
+        if not segment:
+            return None
+        for name, converter, child in node.params:
+            try:
+                value = converter(segment)
+            except ValueError:
+                continue
+            found = self._match(child, segments, index + 1, {**params, name: value})
+            if found is not None:
+                return found
+        return None
 
+    async def dispatch(self, data: str, chat_id: int, user: User) -> bool:
+        """Run the handler of a callback. False when nothing handled it"""
+        resolved = self.resolve(data)
+        if resolved is None:
+            self.unmatched += 1
+            logging.warning(f"Unknown callback: {data}")
+            return False
+        route, params = resolved
+        if route.admin and not user.is_admin:
+            self.denied += 1
+            logging.warning(f"Admin callback {data} from non-admin user {user.telegram_id}")
+            return False
+        
+        histogram = route.histogram
+        histogram.in_flight += 1
+        started_at = time.perf_counter()
+        failed = True
+        try:
+            await route.handler(chat_id, user, **params)
+            failed = False
+        finally:
+            histogram.in_flight -= 1
+            histogram.observe(time.perf_counter() - started_at, failed)
+        return True
+
+callback_router = CallbackRouter()
+
+@instrumented
 async def handle_subscription_check(chat_id: int, user_id: int):
     """Handle subscription check"""
-    is_subscribed = await check_subscription(user_id)
+    is_subscribed = await check_subscription(user_id, force=True)
     if is_subscribed:
-        await db.users.update_one(
-            {"telegram_id": user_id},
-            {"$set": {"is_subscribed": True}}
-        )
-        
         # Confirm referral if exists
         await confirm_referral(user_id)
         
@@ -663,7 +2938,7 @@ async def handle_subscription_check(chat_id: int, user_id: int):
             user = User(**user_data)
             await show_main_menu(chat_id, user)
     else:
-        await send_telegram_message(
+        await render_message(
             chat_id,
             "❌ *Подписка не найдена*\n\n📢 Подпишитесь на канал @uzrisebya и попробуйте снова",
             reply_markup=create_subscription_keyboard()
@@ -672,18 +2947,16 @@ async def handle_subscription_check(chat_id: int, user_id: int):
 async def confirm_referral(user_id: int):
     """Confirm referral when user subscribes to channel"""
     try:
-        referral = await db.referrals.find_one({"referred_id": user_id, "confirmed": False})
+        # Mark referral as confirmed (only one caller wins)
+        referral = await db.referrals.find_one_and_update(
+            {"referred_id": user_id, "confirmed": False},
+            {"$set": {"confirmed": True}}
+        )
         if referral:
-            # Mark referral as confirmed
-            await db.referrals.update_one(
-                {"_id": referral["_id"]},
-                {"$set": {"confirmed": True}}
-            )
-            
             # Give 1 search attempt (25₽ equivalent) to referrer
             await db.users.update_one(
                 {"telegram_id": referral["referrer_id"]},
-                {"$inc": {"balance": 25.0}}
+                {"$inc": {"balance": 25.0, "confirmed_referrals": 1}}
             )
             
             # Notify referrer
@@ -696,34 +2969,14 @@ async def confirm_referral(user_id: int):
     except Exception as e:
         logging.error(f"Error confirming referral: {e}")
 
+@instrumented
 async def show_main_menu(chat_id: int, user: User):
     """Show main menu"""
     welcome_text = f"🎯 *СЕРВИС УЗРИ - ПОИСК ДАННЫХ*\n\n"
     welcome_text += f"👋 Добро пожаловать, {user.first_name or 'пользователь'}!\n\n"
     
     # Подробное описание возможностей бота
-    welcome_text += f"🔍 *ЧТО УМЕЕТ НАШИХ БОТ:*\n\n"
-    
-    welcome_text += f"📊 *ПОИСК ПО 1000+ БАЗАМ ДАННЫХ:*\n"
-    welcome_text += f"📱 Телефоны: +79123456789\n"
-    welcome_text += f"📧 Email: user@mail.ru\n"
-    welcome_text += f"👤 ФИО: Иван Петров Сергеевич\n"
-    welcome_text += f"🚗 Автономера: А123ВС777\n"
-    welcome_text += f"🆔 Никнеймы: @username\n"
-    welcome_text += f"🌐 IP-адреса: 192.168.1.1\n"
-    welcome_text += f"🏠 Адреса и геолокация\n\n"
-    
-    welcome_text += f"🗄️ *ИСТОЧНИКИ ДАННЫХ:*\n"
-    welcome_text += f"🟡 Яндекс (Еда, Такси, Карты)\n"
-    welcome_text += f"🟢 Авито (объявления, пользователи)\n"
-    welcome_text += f"🔵 ВКонтакте (профили)\n"
-    welcome_text += f"🟠 Одноклассники\n"
-    welcome_text += f"📦 СДЭК (доставка)\n"
-    welcome_text += f"🍕 Delivery Club и многие другие\n\n"
-    
-    # Важная информация о бесплатном пробиве
-    welcome_text += f"🎁 *БЕСПЛАТНЫЕ ПРОБИВЫ:*\n"
-    welcome_text += f"За каждого одобренного реферала получите 1 бесплатную попытку пробива данных!\n\n"
+    welcome_text += MAIN_MENU_FEATURES_TEXT
     
     # Show subscription status
     if await has_active_subscription(user):
@@ -739,69 +2992,19 @@ async def show_main_menu(chat_id: int, user: User):
     welcome_text += f"👥 *Рефералов:* {user.total_referrals}\n\n"
     
     # Информация о тарифах без цен
-    welcome_text += f"💳 *ДОСТУПНЫЕ ТАРИФЫ:*\n"
-    welcome_text += f"• Разовые поиски\n"
-    welcome_text += f"• Подписка на 1 день\n"
-    welcome_text += f"• Подписка на 3 дня\n"
-    welcome_text += f"• Подписка на 1 месяц\n\n"
-    
-    welcome_text += f"🔍 *Выберите действие:*"
+    welcome_text += MAIN_MENU_FOOTER_TEXT
     
-    if user.is_admin:
-        # Show admin menu for eriksson_sop
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "🔍 Поиск", "callback_data": "menu_search"},
-                    {"text": "👤 Профиль", "callback_data": "menu_profile"}
-                ],
-                [
-                    {"text": "💰 Баланс", "callback_data": "menu_balance"},
-                    {"text": "🛒 Тарифы", "callback_data": "menu_pricing"}
-                ],
-                [
-                    {"text": "🔗 Рефералы", "callback_data": "menu_referral"},
-                    {"text": "❓ Помощь", "callback_data": "menu_help"}
-                ],
-                [
-                    {"text": "📋 Правила", "callback_data": "menu_rules"},
-                    {"text": "💎 Купить поиск (25₽)", "callback_data": "buy_single_search"}
-                ],
-                [
-                    {"text": "👑 АДМИН-ПАНЕЛЬ", "callback_data": "admin_panel"}
-                ]
-            ]
-        }
-    else:
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "🔍 Поиск", "callback_data": "menu_search"},
-                    {"text": "👤 Профиль", "callback_data": "menu_profile"}
-                ],
-                [
-                    {"text": "💰 Баланс", "callback_data": "menu_balance"},
-                    {"text": "🛒 Тарифы", "callback_data": "menu_pricing"}
-                ],
-                [
-                    {"text": "🔗 Рефералы", "callback_data": "menu_referral"},
-                    {"text": "❓ Помощь", "callback_data": "menu_help"}
-                ],
-                [
-                    {"text": "📋 Правила", "callback_data": "menu_rules"},
-                    {"text": "💎 Купить поиск (25₽)", "callback_data": "buy_single_search"}
-                ]
-            ]
-        }
+    keyboard = WELCOME_ADMIN_MENU_MARKUP if user.is_admin else MAIN_MENU_MARKUP
     
-    await send_telegram_message(chat_id, welcome_text, reply_markup=keyboard)
+    await render_message(chat_id, welcome_text, reply_markup=keyboard)
 
+@instrumented
 async def show_search_menu(chat_id: int, user: User):
     """Show search menu"""
     if not user.is_admin:
-        is_subscribed = await check_subscription(user.telegram_id)
+        is_subscribed = await check_subscription(user.telegram_id, user)
         if not is_subscribed:
-            await send_telegram_message(
+            await render_message(
                 chat_id,
                 "🔒 *Для поиска нужна подписка!*\n\n📢 Подпишитесь на @uzrisebya",
                 reply_markup=create_subscription_keyboard()
@@ -812,16 +3015,14 @@ async def show_search_menu(chat_id: int, user: User):
     
     if not can_search_result and not user.is_admin:
         if "превышен дневной лимит" in payment_method:
-            search_text = f"⏰ *ДНЕВНОЙ ЛИМИТ ИСЧЕРПАН*\n\n"
-            search_text += f"📅 Вы использовали все 12 поисков по подписке на сегодня\n"
-            search_text += f"🕒 Попробуйте завтра или купите отдельные поиски"
+            search_text = SEARCH_LIMIT_REACHED_TEXT
         else:
             search_text = f"💰 *НЕДОСТАТОЧНО СРЕДСТВ*\n\n"
             search_text += f"💳 Ваш баланс: {user.balance:.2f} ₽\n"
             search_text += f"💎 Нужно: 25 ₽ за поиск\n\n"
             search_text += f"💡 Пополните баланс или оформите подписку"
         
-        await send_telegram_message(chat_id, search_text, reply_markup=create_back_keyboard())
+        await render_message(chat_id, search_text, reply_markup=create_back_keyboard())
         return
     
     search_text = f"🔍 *ПОИСК ПО БАЗАМ ДАННЫХ*\n\n"
@@ -837,29 +3038,13 @@ async def show_search_menu(chat_id: int, user: User):
         searches_available = int(user.balance // 25)
         search_text += f"🔍 *Доступно поисков:* {searches_available}\n"
     
-    search_text += f"\n📝 *ТИПЫ ПОИСКА:*\n"
-    search_text += f"📱 Телефон: +79123456789, 89123456789\n"
-    search_text += f"📧 Email: user@mail.ru, admin@site.com\n"
-    search_text += f"👤 ФИО: Иван Петров, Анна Сергеевна\n"
-    search_text += f"🚗 Авто: А123ВС777, В456ОР199\n"
-    search_text += f"🆔 Никнейм: @username, nickname\n"
-    search_text += f"🌐 IP: 192.168.1.1, 8.8.8.8\n"
-    search_text += f"🏠 Адрес: улица Ленина дом 5\n\n"
-    
-    search_text += f"🗄️ *ИСТОЧНИКИ (1000+ БАЗ):*\n"
-    search_text += f"🟡 Яндекс • 🟢 Авито • 🔵 ВКонтакте\n"
-    search_text += f"🟠 Одноклассники • 📦 СДЭК • 🍕 Delivery Club\n"
-    search_text += f"📊 И многие другие сервисы\n\n"
+    search_text += SEARCH_MENU_HELP_TEXT
     
-    search_text += f"➡️ *Просто отправьте данные для поиска*"
-    
-    await send_telegram_message(chat_id, search_text, reply_markup=create_back_keyboard())
+    await render_message(chat_id, search_text, reply_markup=create_back_keyboard())
 
+@instrumented
 async def show_profile_menu(chat_id: int, user: User):
     """Show profile menu"""
-    total_searches = await db.searches.count_documents({"user_id": user.telegram_id})
-    successful_searches = await db.searches.count_documents({"user_id": user.telegram_id, "success": True})
-    
     profile_text = f"👤 *ВАШ ПРОФИЛЬ*\n\n"
     profile_text += f"🆔 *ID:* `{user.telegram_id}`\n"
     profile_text += f"👤 *Имя:* {user.first_name or 'N/A'}\n"
@@ -879,16 +3064,17 @@ async def show_profile_menu(chat_id: int, user: User):
         profile_text += f"❌ Подписка: Нет\n"
     
     profile_text += f"\n📊 *СТАТИСТИКА:*\n"
-    profile_text += f"🔍 Поисков: {total_searches}\n"
-    profile_text += f"✅ Успешных: {successful_searches}\n"
+    profile_text += f"🔍 Поисков: {user.total_searches}\n"
+    profile_text += f"✅ Успешных: {user.successful_searches}\n"
     profile_text += f"👥 Рефералов: {user.total_referrals}\n"
     profile_text += f"📅 Регистрация: {user.created_at.strftime('%d.%m.%Y')}\n\n"
     
     if user.is_admin:
         profile_text += f"👑 *Статус:* АДМИНИСТРАТОР\n"
     
-    await send_telegram_message(chat_id, profile_text, reply_markup=create_back_keyboard())
+    await render_message(chat_id, profile_text, reply_markup=create_back_keyboard())
 
+@instrumented
 async def show_balance_menu(chat_id: int, user: User):
     """Show balance menu"""
     balance_text = f"💰 *ВАШ БАЛАНС*\n\n"
@@ -897,61 +3083,29 @@ async def show_balance_menu(chat_id: int, user: User):
     searches_available = int(user.balance // 25)
     balance_text += f"🔍 *Доступно поисков:* {searches_available}\n\n"
     
-    balance_text += f"💡 *СПОСОБЫ ПОПОЛНЕНИЯ:*\n"
-    balance_text += f"🤖 Криптобот - автоматически\n"
-    balance_text += f"⭐ Звезды Telegram - мгновенно\n\n"
-    balance_text += f"💎 *Минимальное пополнение:* 100 ₽\n"
-    balance_text += f"🔍 *Один поиск:* 25 ₽\n\n"
-    balance_text += f"💼 *Или оформите подписку для экономии!*"
+    balance_text += BALANCE_MENU_FOOTER_TEXT
     
-    await send_telegram_message(chat_id, balance_text, reply_markup=create_balance_menu())
+    await render_message(chat_id, balance_text, reply_markup=create_balance_menu())
 
+@instrumented
 async def show_pricing_menu(chat_id: int, user: User):
     """Show pricing menu"""
-    pricing_text = f"🛒 *ТАРИФЫ И ПОДПИСКИ*\n\n"
-    
-    pricing_text += f"💎 *РАЗОВЫЕ ПОИСКИ:*\n"
-    pricing_text += f"🔍 1 поиск = 25 ₽\n"
-    pricing_text += f"💡 Идеально для разового использования\n\n"
-    
-    pricing_text += f"⭐ *ВЫГОДНЫЕ ПОДПИСКИ*:\n\n"
-    
-    pricing_text += f"📅 *1 ДЕНЬ - 149 ₽*\n"
-    pricing_text += f"• До 12 поисков в день\n"
-    pricing_text += f"• Экономия: 151 ₽ (по сравнению с разовыми)\n"
-    pricing_text += f"• Цена за поиск: ~12₽\n\n"
-    
-    pricing_text += f"📅 *3 ДНЯ - 299 ₽* 🔥\n"
-    pricing_text += f"• До 36 поисков за 3 дня\n"
-    pricing_text += f"• Экономия: 601 ₽\n"
-    pricing_text += f"• Цена за поиск: ~8₽\n\n"
-    
-    pricing_text += f"📅 *1 МЕСЯЦ - 1700 ₽* 💎\n"
-    pricing_text += f"• До 360 поисков за месяц\n"
-    pricing_text += f"• Экономия: 7300 ₽\n"
-    pricing_text += f"• Цена за поиск: ~5₽\n\n"
-    
-    pricing_text += f"🎁 *БЕСПЛАТНО:*\n"
-    pricing_text += f"• Приглашайте друзей и получайте бесплатные поиски!\n"
-    pricing_text += f"• 1 одобренный реферал = 1 бесплатная попытка\n\n"
+    pricing_text = PRICING_TEXT
     
-    pricing_text += f"💡 *Чем больше тариф, тем больше экономия!*"
-    
-    await send_telegram_message(chat_id, pricing_text, reply_markup=create_pricing_menu())
+    await render_message(chat_id, pricing_text, reply_markup=create_pricing_menu())
 
+@instrumented
 async def show_referral_menu(chat_id: int, user: User):
     """Show referral menu"""
     referral_link = f"https://t.me/{BOT_USERNAME}?start={user.referral_code}"
-    confirmed_referrals = await db.referrals.count_documents({"referrer_id": user.telegram_id, "confirmed": True})
-    
     referral_text = f"🔗 *РЕФЕРАЛЬНАЯ ПРОГРАММА*\n\n"
     referral_text += f"🔍 *За подтвержденного реферала:* +1 попытка поиска\n"
     referral_text += f"📋 *Условие:* реферал должен подписаться на @uzrisebya\n\n"
     
     referral_text += f"📊 *ВАША СТАТИСТИКА:*\n"
     referral_text += f"👥 Всего приглашено: {user.total_referrals}\n"
-    referral_text += f"✅ Подтверждено: {confirmed_referrals}\n"
-    referral_text += f"🔍 Получено попыток: {confirmed_referrals}\n\n"
+    referral_text += f"✅ Подтверждено: {user.confirmed_referrals}\n"
+    referral_text += f"🔍 Получено попыток: {user.confirmed_referrals}\n\n"
     
     referral_text += f"🔗 *ВАША ССЫЛКА:*\n"
     referral_text += f"`{referral_link}`\n\n"
@@ -962,225 +3116,102 @@ async def show_referral_menu(chat_id: int, user: User):
     referral_text += f"3. Друг подписывается на @uzrisebya\n"
     referral_text += f"4. Вам начисляется 1 попытка поиска"
     
-    await send_telegram_message(chat_id, referral_text, reply_markup=create_back_keyboard())
+    await render_message(chat_id, referral_text, reply_markup=create_back_keyboard())
 
+@instrumented
 async def show_help_menu(chat_id: int, user: User):
     """Show help menu"""
-    help_text = f"❓ *СПРАВКА И ПОДДЕРЖКА*\n\n"
-    help_text += f"🎯 *О СЕРВИСЕ:*\n"
-    help_text += f"УЗРИ помогает найти информацию о людях из открытых источников интернета.\n\n"
-    
-    help_text += f"💰 *ТАРИФЫ:*\n"
-    help_text += f"🔍 Разовый поиск: 25 ₽\n"
-    help_text += f"📅 Подписки: от 149 ₽/день\n\n"
-    
-    help_text += f"💳 *ПОПОЛНЕНИЕ:*\n"
-    help_text += f"🤖 Криптобот\n"
-    help_text += f"⭐ Звезды Telegram\n"
-    help_text += f"💎 Минимум: 100 ₽\n\n"
+    help_text = HELP_TEXT
     
-    help_text += f"🔗 *РЕФЕРАЛЫ:*\n"
-    help_text += f"🔍 1 попытка поиска за подтвержденного реферала\n\n"
-    
-    help_text += f"📞 *ПОДДЕРЖКА:*\n"
-    help_text += f"@Sigicara - техническая поддержка\n\n"
-    
-    help_text += f"⚖️ *ВАЖНО:*\n"
-    help_text += f"Перед использованием изучите правила сервиса"
-    
-    await send_telegram_message(chat_id, help_text, reply_markup=create_back_keyboard())
+    await render_message(chat_id, help_text, reply_markup=create_back_keyboard())
 
+@instrumented
 async def show_rules_menu(chat_id: int, user: User):
     """Show rules menu"""
-    rules_text = f"📋 *ПРАВИЛА ИСПОЛЬЗОВАНИЯ СЕРВИСА*\n\n"
-    
-    rules_text += f"*1. СОГЛАСИЕ С ПРАВИЛАМИ*\n"
-    rules_text += f"Используя данный бот, вы полностью подтверждаете согласие со всеми правилами сервиса.\n\n"
+    rules_text = RULES_TEXT
     
-    rules_text += f"*2. НАЗНАЧЕНИЕ СЕРВИСА*\n"
-    rules_text += f"• Поиск информации о себе в открытых источниках\n"
-    rules_text += f"• Проверка утечек персональных данных\n"
-    rules_text += f"• Анализ цифрового следа\n\n"
-    
-    rules_text += f"*3. ЗАПРЕЩАЕТСЯ*\n"
-    rules_text += f"• Поиск данных без согласия владельца\n"
-    rules_text += f"• Использование для мошенничества\n"
-    rules_text += f"• Нарушение законов РФ\n"
-    rules_text += f"• Продажа полученной информации\n"
-    rules_text += f"• Преследование и шантаж\n\n"
-    
-    rules_text += f"*4. ТАРИФИКАЦИЯ*\n"
-    rules_text += f"• Разовый поиск: 25 ₽\n"
-    rules_text += f"• Подписки с лимитом 12 поисков/день\n"
-    rules_text += f"• Минимальное пополнение: 100 ₽\n"
-    rules_text += f"• Возврат средств не предусмотрен\n\n"
-    
-    rules_text += f"*5. ОТВЕТСТВЕННОСТЬ*\n"
-    rules_text += f"• Администрация не несет ответственности за использование данных\n"
-    rules_text += f"• Пользователь самостоятельно отвечает за свои действия\n"
-    rules_text += f"• При нарушении правил - блокировка аккаунта\n\n"
-    
-    rules_text += f"*6. ТЕХНИЧЕСКАЯ ПОДДЕРЖКА*\n"
-    rules_text += f"@Sigicara - техническая поддержка\n\n"
-    
-    rules_text += f"⚖️ *Используя сервис, вы подтверждаете согласие с данными правилами.*"
-    
-    await send_telegram_message(chat_id, rules_text, reply_markup=create_back_keyboard())
+    await render_message(chat_id, rules_text, reply_markup=create_back_keyboard())
 
+@instrumented
 async def handle_admin_callback(chat_id: int, user: User, data: str):
     """Handle admin callbacks"""
     if data == "admin_panel":
-        admin_text = f"👑 *АДМИН-ПАНЕЛЬ*\n\n"
-        admin_text += f"🔧 Управление сервисом УЗРИ\n\n"
-        admin_text += f"💎 *Начислить баланс* - добавить деньги пользователю\n"
-        admin_text += f"📊 *Статистика* - общая статистика сервиса\n"
-        admin_text += f"👥 *Пользователи* - список активных пользователей\n"
-        admin_text += f"💳 *Платежи* - история транзакций"
+        admin_text = ADMIN_PANEL_TEXT
         
-        await send_telegram_message(chat_id, admin_text, reply_markup=create_admin_menu())
+        await render_message(chat_id, admin_text, reply_markup=create_admin_menu())
     
     elif data == "admin_add_balance":
-        await send_telegram_message(
+        await render_message(
             chat_id,
             "💎 *НАЧИСЛЕНИЕ БАЛАНСА*\n\nОтправьте сообщение в формате:\n`ID СУММА`\n\nПример: `123456789 100`",
             reply_markup=create_back_keyboard()
         )
     
     elif data == "admin_stats":
-        total_users = await db.users.count_documents({})
-        total_searches = await db.searches.count_documents({})
-        total_revenue = await db.searches.aggregate([
-            {"$group": {"_id": None, "total": {"$sum": "$cost"}}}
-        ]).to_list(1)
-        active_subs = await db.users.count_documents({"subscription_expires": {"$gt": datetime.utcnow()}})
+        stats = await get_stats_snapshot()
         
         stats_text = f"📊 *СТАТИСТИКА СЕРВИСА*\n\n"
-        stats_text += f"👥 Пользователей: {total_users}\n"
-        stats_text += f"🔍 Поисков: {total_searches}\n"
-        stats_text += f"⭐ Активных подписок: {active_subs}\n"
-        revenue = total_revenue[0]['total'] if total_revenue else 0
+        stats_text += f"👥 Пользователей: {stats.get('users', 0)}\n"
+        stats_text += f"🔍 Поисков: {stats.get('searches', 0)}\n"
+        stats_text += f"⭐ Активных подписок: {stats.get('active_subscriptions', 0)}\n"
+        revenue = stats.get('search_revenue', 0)
         stats_text += f"💰 Выручка: {revenue:.2f} ₽"
         
-        await send_telegram_message(chat_id, stats_text, reply_markup=create_admin_menu())
+        await render_message(chat_id, stats_text, reply_markup=create_admin_menu())
     
     elif data == "admin_broadcast":
         await set_user_state(user.telegram_id, "waiting_broadcast_message")
         
-        broadcast_text = f"📢 *МАССОВАЯ РАССЫЛКА*\n\n"
-        broadcast_text += f"📝 *Отправьте сообщение, которое нужно разослать всем пользователям бота*\n\n"
-        broadcast_text += f"⚠️ *Внимание:* Сообщение будет отправлено всем пользователям без возможности отмены\n\n"
-        broadcast_text += f"💡 *Поддерживается Markdown форматирование*\n"
-        broadcast_text += f"❌ Для отмены нажмите кнопку ниже"
+        broadcast_text = BROADCAST_PROMPT_TEXT
         
-        await send_telegram_message(
+        await render_message(
             chat_id,
             broadcast_text,
             reply_markup=create_back_keyboard()
         )
 
+@instrumented
 async def handle_payment_callback(chat_id: int, user: User, data: str):
     """Handle payment callbacks"""
     if data == "pay_crypto":
         # Криптобот пополнение
-        crypto_text = f"🤖 *ПОПОЛНЕНИЕ ЧЕРЕЗ КРИПТОБОТ*\n\n"
-        crypto_text += f"💰 *Доступные способы:*\n"
-        crypto_text += f"₿ Bitcoin (BTC)\n"
-        crypto_text += f"💎 Ethereum (ETH)\n"  
-        crypto_text += f"💰 USDT (TRC-20/ERC-20)\n"
-        crypto_text += f"🔸 Litecoin (LTC)\n\n"
-        crypto_text += f"📋 *Как пополнить:*\n"
-        crypto_text += f"1. Выберите сумму и валюту\n"
-        crypto_text += f"2. Получите адрес кошелька\n"
-        crypto_text += f"3. Переведите средства\n"
-        crypto_text += f"4. Средства поступят автоматически\n\n"
-        crypto_text += f"⚡ *Минимальная сумма:* 100 ₽\n"
-        crypto_text += f"🚀 *Зачисление:* 1-30 минут\n\n"
-        crypto_text += f"📞 *Поддержка:* @Sigicara"
+        crypto_text = CRYPTO_PAYMENT_TEXT
         
-        crypto_keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "₿ Bitcoin", "callback_data": "crypto_btc"},
-                    {"text": "💎 Ethereum", "callback_data": "crypto_eth"}
-                ],
-                [
-                    {"text": "💰 USDT", "callback_data": "crypto_usdt"},
-                    {"text": "🔸 Litecoin", "callback_data": "crypto_ltc"}
-                ],
-                [
-                    {"text": "◀️ Назад", "callback_data": "menu_balance"}
-                ]
-            ]
-        }
-        
-        await send_telegram_message(chat_id, crypto_text, reply_markup=crypto_keyboard)
+        await render_message(chat_id, crypto_text, reply_markup=CRYPTO_CURRENCIES_MARKUP)
     
     elif data == "pay_stars":
         # Telegram Stars пополнение
-        stars_text = f"⭐ *ПОПОЛНЕНИЕ ЗВЕЗДАМИ TELEGRAM*\n\n"
-        stars_text += f"💫 *Быстро и удобно!*\n"
-        stars_text += f"Используйте звезды Telegram для мгновенного пополнения баланса\n\n"
-        stars_text += f"💰 *Курс обмена:*\n"
-        stars_text += f"1 ⭐ = 2 ₽\n\n"
-        stars_text += f"🎯 *Варианты пополнения:*\n\n"
-        
-        stars_keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "50⭐ = 100₽", "callback_data": "stars_100"},
-                    {"text": "125⭐ = 250₽", "callback_data": "stars_250"}
-                ],
-                [
-                    {"text": "250⭐ = 500₽", "callback_data": "stars_500"},
-                    {"text": "500⭐ = 1000₽", "callback_data": "stars_1000"}
-                ],
-                [
-                    {"text": "1000⭐ = 2000₽", "callback_data": "stars_2000"}
-                ],
-                [
-                    {"text": "💰 Своя сумма", "callback_data": "stars_custom"}
-                ],
-                [
-                    {"text": "◀️ Назад", "callback_data": "menu_balance"}
-                ]
-            ]
-        }
+        stars_text = STARS_PAYMENT_TEXT
         
-        await send_telegram_message(chat_id, stars_text, reply_markup=stars_keyboard)
+        await render_message(chat_id, stars_text, reply_markup=STARS_AMOUNTS_MARKUP)
     
     elif data == "buy_single_search":
         if user.balance >= 25.0:
-            await send_telegram_message(
+            await render_message(
                 chat_id,
                 "✅ *У вас уже есть средства для поиска*\n\n🔍 Перейдите в раздел 'Поиск'",
                 reply_markup=create_back_keyboard()
             )
         else:
             needed = 25.0 - user.balance
-            await send_telegram_message(
+            await render_message(
                 chat_id,
                 f"💳 *ПОКУПКА ПОИСКА*\n\n💎 Нужно доплатить: {needed:.2f} ₽\n\n💡 Пополните баланс на сумму от 100 ₽",
                 reply_markup=create_balance_menu()
             )
 
-async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: str, amount: str):
+@instrumented
+async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: str, amount: int):
     """Handle crypto payment with specific amount"""
     logging.info(f"💳 handle_crypto_payment_amount: chat_id={chat_id}, crypto_type={crypto_type}, amount={amount}")
     
-    crypto_names = {
-        "btc": "Bitcoin (BTC)",
-        "eth": "Ethereum (ETH)", 
-        "usdt": "USDT",
-        "ltc": "Litecoin (LTC)"
-    }
-    
     try:
         amount_float = float(amount)
         logging.info(f"💰 Конвертированная сумма: {amount_float}")
         
         if amount_float < 100:
             logging.warning(f"❌ Сумма слишком мала: {amount_float}")
-            await send_telegram_message(
+            await render_message(
                 chat_id,
                 "❌ Минимальная сумма пополнения: 100 ₽",
                 reply_markup=create_back_keyboard()
@@ -1200,7 +3231,7 @@ async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: st
             logging.info(f"✅ Инвойс создан: ID={invoice_id}, URL={invoice_url}")
             
             if invoice_url:
-                wallet_text = f"💰 *ПОПОЛНЕНИЕ ЧЕРЕЗ {crypto_names.get(crypto_type, crypto_type.upper())}*\n\n"
+                wallet_text = f"💰 *ПОПОЛНЕНИЕ ЧЕРЕЗ {CRYPTO_NAMES.get(crypto_type, crypto_type.upper())}*\n\n"
                 wallet_text += f"💎 Сумма: {amount_float} ₽\n"
                 wallet_text += f"📋 ID платежа: {invoice_id}\n\n"
                 wallet_text += f"⚡ *Зачисление:* 1-30 минут после оплаты\n"
@@ -1215,10 +3246,10 @@ async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: st
                 }
                 
                 logging.info("📤 Отправляем сообщение с кнопкой оплаты")
-                await send_telegram_message(chat_id, wallet_text, reply_markup=keyboard)
+                await render_message(chat_id, wallet_text, reply_markup=keyboard)
             else:
                 logging.error("❌ Нет URL инвойса в ответе")
-                await send_telegram_message(
+                await render_message(
                     chat_id,
                     "❌ Ошибка создания платежа. Попробуйте позже.",
                     reply_markup=create_back_keyboard()
@@ -1226,7 +3257,7 @@ async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: st
         else:
             error_msg = invoice_result.get('error', {}).get('message', 'Неизвестная ошибка')
             logging.error(f"❌ Ошибка создания инвойса: {error_msg}")
-            await send_telegram_message(
+            await render_message(
                 chat_id,
                 f"❌ Ошибка создания платежа: {error_msg}",
                 reply_markup=create_back_keyboard()
@@ -1234,98 +3265,55 @@ async def handle_crypto_payment_amount(chat_id: int, user: User, crypto_type: st
         
     except ValueError as e:
         logging.error(f"❌ Ошибка конвертации суммы: {e}")
-        await send_telegram_message(
+        await render_message(
             chat_id,
             "❌ Неверная сумма",
             reply_markup=create_back_keyboard()
         )
     except Exception as e:
         logging.error(f"❌ Непредвиденная ошибка в handle_crypto_payment_amount: {e}")
-        await send_telegram_message(
+        await render_message(
             chat_id,
             "❌ Произошла ошибка. Попробуйте позже.",
             reply_markup=create_back_keyboard()
         )
 
+@instrumented
 async def handle_crypto_payment(chat_id: int, user: User, crypto_type: str):
     """Handle crypto payment selection"""
     logging.info(f"🏠 handle_crypto_payment: chat_id={chat_id}, crypto_type={crypto_type}")
     
-    crypto_names = {
-        "btc": "Bitcoin (BTC)",
-        "eth": "Ethereum (ETH)", 
-        "usdt": "USDT",
-        "ltc": "Litecoin (LTC)"
-    }
-    
-    crypto_text = f"💰 *ПОПОЛНЕНИЕ ЧЕРЕЗ {crypto_names.get(crypto_type, crypto_type.upper())}*\n\n"
-    crypto_text += f"📝 *Выберите сумму для пополнения:*\n"
-    crypto_text += f"После выбора вы получите адрес кошелька для перевода\n\n"
-    crypto_text += f"⚡ *Зачисление: 1-30 минут*"
-    
-    crypto_amounts_keyboard = {
-        "inline_keyboard": [
-            [
-                {"text": "100₽", "callback_data": f"crypto_{crypto_type}_100"},
-                {"text": "250₽", "callback_data": f"crypto_{crypto_type}_250"}
-            ],
-            [
-                {"text": "500₽", "callback_data": f"crypto_{crypto_type}_500"},
-                {"text": "1000₽", "callback_data": f"crypto_{crypto_type}_1000"}
-            ],
-            [
-                {"text": "2000₽", "callback_data": f"crypto_{crypto_type}_2000"},
-                {"text": "5000₽", "callback_data": f"crypto_{crypto_type}_5000"}
-            ],
-            [
-                {"text": "💰 Своя сумма", "callback_data": f"crypto_{crypto_type}_custom"}
-            ],
-            [
-                {"text": "◀️ Назад", "callback_data": "pay_crypto"}
-            ]
-        ]
-    }
+    crypto_text = f"💰 *ПОПОЛНЕНИЕ ЧЕРЕЗ {CRYPTO_NAMES.get(crypto_type, crypto_type.upper())}*\n\n"
+    crypto_text += CRYPTO_AMOUNT_PROMPT_TEXT
     
-    await send_telegram_message(chat_id, crypto_text, reply_markup=crypto_amounts_keyboard)
+    await render_message(chat_id, crypto_text, reply_markup=crypto_amounts_markup(crypto_type))
 
+@instrumented
 async def handle_stars_custom_amount(chat_id: int, user: User):
     """Handle custom amount for Telegram Stars payment"""
     await set_user_state(user.telegram_id, "waiting_custom_amount_stars")
     
-    text = f"💰 *СВОЯ СУММА ПОПОЛНЕНИЯ*\n\n"
-    text += f"⭐ *Курс:* 1 звезда = 2₽\n\n"
-    text += f"📝 Введите сумму в рублях (от 100₽ до 50,000₽)\n"
-    text += f"💡 Сумма должна быть кратна 50₽\n\n"
-    text += f"❌ Для отмены нажмите кнопку"
-    
-    await send_telegram_message(
+    await render_message(
         chat_id,
-        text,
+        STARS_CUSTOM_AMOUNT_TEXT,
         reply_markup=create_back_keyboard()
     )
+@instrumented
 async def handle_crypto_custom_amount(chat_id: int, user: User, crypto_type: str):
     """Handle custom amount for crypto payment"""
-    crypto_names = {
-        "btc": "Bitcoin (BTC)",
-        "eth": "Ethereum (ETH)", 
-        "usdt": "USDT",
-        "ltc": "Litecoin (LTC)"
-    }
-    
     await set_user_state(user.telegram_id, "waiting_custom_amount_crypto", {"crypto_type": crypto_type})
     
-    text = f"💰 *СВОЯ СУММА ПОПОЛНЕНИЯ*\n\n"
-    text += f"🤖 *Валюта:* {crypto_names.get(crypto_type, crypto_type.upper())}\n\n"
-    text += f"📝 Введите сумму в рублях (от 100₽ до 50,000₽)\n"
-    text += f"💡 Сумма должна быть кратна 50₽\n\n"
-    text += f"❌ Для отмены нажмите кнопку"
+    text = CUSTOM_AMOUNT_HEADER_TEXT
+    text += f"🤖 *Валюта:* {CRYPTO_NAMES.get(crypto_type, crypto_type.upper())}\n\n"
+    text += CUSTOM_AMOUNT_FOOTER_TEXT
     
-    await send_telegram_message(
+    await render_message(
         chat_id,
         text,
         reply_markup=create_back_keyboard()
     )
 
+@instrumented
 async def handle_stars_payment(chat_id: int, user: User, amount: str):
     """Handle Telegram Stars payment"""
     amounts = {
@@ -1346,7 +3334,6 @@ async def handle_stars_payment(chat_id: int, user: User, amount: str):
         invoice_payload = f"stars_payment_{user.telegram_id}_{amount}"
         
         # Создаем инвойс для оплаты звездами
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendInvoice"
         invoice_data = {
             "chat_id": chat_id,
             "title": f"Пополнение баланса на {rubles}₽",
@@ -1356,8 +3343,8 @@ async def handle_stars_payment(chat_id: int, user: User, amount: str):
             "prices": [{"label": f"Пополнение {rubles}₽", "amount": stars_needed}]
         }
         
-        response = requests.post(url, json=invoice_data)
-        if response.status_code == 200:
+        result = await telegram_request("sendInvoice", invoice_data)
+        if result.get('ok'):
             await send_telegram_message(
                 chat_id,
                 f"⭐ *ОПЛАТА ЗВЕЗДАМИ*\n\n💰 Сумма: {rubles}₽\n⭐ К оплате: {stars_needed} звезд\n\n👆 Нажмите кнопку выше для оплаты"
@@ -1375,6 +3362,7 @@ async def handle_stars_payment(chat_id: int, user: User, amount: str):
             reply_markup=create_back_keyboard()
         )
 
+@instrumented
 async def handle_purchase_callback(chat_id: int, user: User, data: str):
     """Handle subscription purchase callbacks"""
     prices = {
@@ -1386,12 +3374,14 @@ async def handle_purchase_callback(chat_id: int, user: User, data: str):
     if data in prices:
         price, sub_type, days = prices[data]
         
+        purchased = False
         if user.balance >= price:
             # Purchase subscription
             expires = datetime.utcnow() + timedelta(days=days)
             
-            await db.users.update_one(
-                {"telegram_id": user.telegram_id},
+            # Условие на баланс в самом запросе - параллельные покупки не уведут баланс в минус
+            result = await db.users.update_one(
+                {"telegram_id": user.telegram_id, "balance": {"$gte": price}},
                 {
                     "$set": {
                         "subscription_type": sub_type,
@@ -1402,6 +3392,14 @@ async def handle_purchase_callback(chat_id: int, user: User, data: str):
                     "$inc": {"balance": -price}
                 }
             )
+            purchased = result.modified_count > 0
+        
+        if purchased:
+            counters = {"subscriptions": 1, f"subscriptions_by_type.{sub_type}": 1, "subscription_revenue": price}
+            if not await has_active_subscription(user):
+                # Истечения подписок учитываются при сверке
+                counters["active_subscriptions"] = 1
+            await increment_stats(counters)
             
             sub_names = {"day": "1 день", "3days": "3 дня", "month": "1 месяц"}
             await send_telegram_message(
@@ -1411,12 +3409,35 @@ async def handle_purchase_callback(chat_id: int, user: User, data: str):
             )
         else:
             needed = price - user.balance
-            await send_telegram_message(
+            await render_message(
                 chat_id,
                 f"❌ *НЕДОСТАТОЧНО СРЕДСТВ*\n\n💰 Ваш баланс: {user.balance:.2f} ₽\n💎 Нужно: {price} ₽\n📈 Доплатить: {needed:.2f} ₽",
                 reply_markup=create_balance_menu()
             )
 
+# Callback routes
+callback_router.add("check_subscription", lambda chat_id, user: handle_subscription_check(chat_id, user.telegram_id))
+callback_router.add("back_to_menu", show_main_menu)
+callback_router.add("menu_search", show_search_menu)
+callback_router.add("menu_profile", show_profile_menu)
+callback_router.add("menu_balance", show_balance_menu)
+callback_router.add("menu_pricing", show_pricing_menu)
+callback_router.add("menu_referral", show_referral_menu)
+callback_router.add("menu_help", show_help_menu)
+callback_router.add("menu_rules", show_rules_menu)
+for admin_action in ("admin_panel", "admin_add_balance", "admin_stats", "admin_broadcast"):
+    callback_router.add(admin_action, functools.partial(handle_admin_callback, data=admin_action), admin=True)
+for payment_action in ("pay_crypto", "pay_stars", "buy_single_search"):
+    callback_router.add(payment_action, functools.partial(handle_payment_callback, data=payment_action))
+for purchase_action in ("buy_day_sub", "buy_3days_sub", "buy_month_sub"):
+    callback_router.add(purchase_action, functools.partial(handle_purchase_callback, data=purchase_action))
+callback_router.add("crypto_{crypto_type:coin}", handle_crypto_payment)
+callback_router.add("crypto_{crypto_type:coin}_custom", handle_crypto_custom_amount)
+callback_router.add("crypto_{crypto_type:coin}_{amount:int}", handle_crypto_payment_amount)
+callback_router.add("stars_custom", handle_stars_custom_amount)
+callback_router.add("stars_{amount}", handle_stars_payment)
+
+@instrumented
 async def handle_custom_stars_amount_input(chat_id: int, user: User, text: str):
     """Handle custom amount input for stars payment"""
     await clear_user_state(user.telegram_id)
@@ -1436,7 +3457,6 @@ async def handle_custom_stars_amount_input(chat_id: int, user: User, text: str):
     try:
         invoice_payload = f"stars_payment_{user.telegram_id}_{amount}"
         
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendInvoice"
         invoice_data = {
             "chat_id": chat_id,
             "title": f"Пополнение баланса на {amount}₽",
@@ -1446,8 +3466,8 @@ async def handle_custom_stars_amount_input(chat_id: int, user: User, text: str):
             "prices": [{"label": f"Пополнение {amount}₽", "amount": stars_needed}]
         }
         
-        response = requests.post(url, json=invoice_data)
-        if response.status_code == 200:
+        result = await telegram_request("sendInvoice", invoice_data)
+        if result.get('ok'):
             await send_telegram_message(
                 chat_id,
                 f"⭐ *ОПЛАТА ЗВЕЗДАМИ*\n\n💰 Сумма: {amount}₽\n⭐ К оплате: {stars_needed} звезд\n\n👆 Нажмите кнопку выше для оплаты"
@@ -1465,6 +3485,7 @@ async def handle_custom_stars_amount_input(chat_id: int, user: User, text: str):
             reply_markup=create_back_keyboard()
         )
 
+@instrumented
 async def handle_custom_crypto_amount_input(chat_id: int, user: User, text: str, crypto_type: str):
     """Handle custom amount input for crypto payment"""
     await clear_user_state(user.telegram_id)
@@ -1481,121 +3502,190 @@ async def handle_custom_crypto_amount_input(chat_id: int, user: User, text: str,
     await handle_crypto_payment_amount(chat_id, user, crypto_type, str(amount))
 
 
+@instrumented
 async def handle_broadcast_message_input(chat_id: int, user: User, text: str):
     """Handle broadcast message input from admin"""
     await clear_user_state(user.telegram_id)
     
-    # Get all users from database
-    all_users_cursor = db.users.find({}, {"telegram_id": 1})
-    all_users = await all_users_cursor.to_list(length=None)
+    total_users = await db.users.count_documents(broadcast_users_filter(user.telegram_id))
+    job = BroadcastJob(admin_id=user.telegram_id, chat_id=chat_id, text=text, total=total_users)
     
-    total_users = len(all_users)
-    sent_count = 0
-    failed_count = 0
-    
-    # Send confirmation message to admin
+    # Send confirmation message to admin, it is edited with progress later
     confirmation_text = f"📢 *ЗАПУСК РАССЫЛКИ*\n\n"
     confirmation_text += f"👥 *Всего пользователей:* {total_users}\n"
     confirmation_text += f"📝 *Сообщение:*\n{text}\n\n"
     confirmation_text += f"⏳ Рассылка начинается..."
     
-    await send_telegram_message(chat_id, confirmation_text)
-    
-    # Send message to all users
-    for user_data in all_users:
-        user_id = user_data.get('telegram_id')
-        if user_id and user_id != user.telegram_id:  # Don't send to admin
-            success = await send_telegram_message(user_id, f"📢 *СООБЩЕНИЕ ОТ АДМИНИСТРАЦИИ:*\n\n{text}")
-            if success:
-                sent_count += 1
-            else:
-                failed_count += 1
+    result = await telegram_request("sendMessage", {
+        "chat_id": chat_id,
+        "text": confirmation_text,
+        "parse_mode": "Markdown"
+    })
+    if result.get('ok'):
+        job.progress_message_id = result['result']['message_id']
     
-    # Send results to admin
-    result_text = f"✅ *РАССЫЛКА ЗАВЕРШЕНА*\n\n"
-    result_text += f"👥 *Всего пользователей:* {total_users}\n"
-    result_text += f"✅ *Доставлено:* {sent_count}\n"
-    result_text += f"❌ *Не доставлено:* {failed_count}\n\n"
-    result_text += f"📊 *Эффективность:* {(sent_count/total_users*100):.1f}%" if total_users > 0 else ""
+    await db.broadcast_jobs.insert_one(job.dict())
+    start_broadcast_job(job.job_id)
+
+# Broadcasts
+broadcast_bucket = TokenBucket(BROADCAST_RATE_PER_SECOND)
+broadcast_tasks: Dict[str, asyncio.Task] = {}
+
+def broadcast_users_filter(admin_id: int) -> Dict[str, Any]:
+    """Users that should receive a broadcast"""
+    return {"telegram_id": {"$ne": admin_id}, "is_blocked": {"$ne": True}}
+
+async def send_broadcast_message(telegram_id: int, text: str) -> str:
+    """Send one broadcast message. Returns status: sent, blocked, failed or retry"""
+    payload = {
+        "chat_id": telegram_id,
+        "text": f"📢 *СООБЩЕНИЕ ОТ АДМИНИСТРАЦИИ:*\n\n{text}",
+        "parse_mode": "Markdown"
+    }
+    # Рассылка не должна занимать весь общий лимит: ответы пользователям идут вперед
+    await broadcast_bucket.acquire()
+    result = await telegram_request("sendMessage", payload, priority=PRIORITY_BULK)
+    if result.get('ok'):
+        return "sent"
+    if result.get('error_code') == 403:
+        # Бот заблокирован или аккаунт удален - исключаем из следующих рассылок
+        await db.users.update_one({"telegram_id": telegram_id}, {"$set": {"is_blocked": True}})
+        return "blocked"
+    error_code = result.get('error_code') or 0
+    if error_code == 0 or error_code == 429 or error_code >= 500:
+        # Telegram сообщение не отклонил (сеть, перегрузка, остановка) - отправим позже
+        return "retry"
     
-    await send_telegram_message(chat_id, result_text, reply_markup=create_admin_menu())
+    logging.error(f"❌ Broadcast to {telegram_id} failed: {result.get('error_code')} - {result.get('description')}")
+    return "failed"
 
+async def send_broadcast_batch(telegram_ids: List[int], text: str) -> List[str]:
+    """Send a batch; unsent messages are retried with backoff before the cursor moves past them"""
+    statuses = await asyncio.gather(*[send_broadcast_message(telegram_id, text) for telegram_id in telegram_ids])
+    delay = BROADCAST_RETRY_DELAY
+    while "retry" in statuses:
+        pending = [index for index, status in enumerate(statuses) if status == "retry"]
+        logging.warning(f"📢 {len(pending)} broadcast messages not sent, retrying in {delay:.0f}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+        retried = await asyncio.gather(*[send_broadcast_message(telegram_ids[index], text) for index in pending])
+        for index, status in zip(pending, retried):
+            statuses[index] = status
+    return statuses
 
-async def handle_pre_checkout_query(pre_checkout_query: Dict[str, Any]):
-    """Handle pre-checkout query from Telegram Stars payments"""
-    try:
-        query_id = pre_checkout_query.get('id')
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerPreCheckoutQuery"
-        
-        # Always approve the payment at this stage
-        payload = {
-            "pre_checkout_query_id": query_id,
-            "ok": True
-        }
-        
-        response = requests.post(url, json=payload)
-        if response.status_code != 200:
-            logging.error(f"Failed to answer pre-checkout query: {response.text}")
-            
-    except Exception as e:
-        logging.error(f"Error handling pre-checkout query: {e}")
+def format_broadcast_progress(job: Dict[str, Any]) -> str:
+    """Format broadcast progress message"""
+    processed = job['sent'] + job['failed'] + job['blocked']
+    progress_text = f"📢 *РАССЫЛКА В ПРОЦЕССЕ*\n\n"
+    progress_text += f"👥 *Всего пользователей:* {job['total']}\n"
+    progress_text += f"⏳ *Обработано:* {processed}\n"
+    progress_text += f"✅ *Доставлено:* {job['sent']}\n"
+    progress_text += f"❌ *Не доставлено:* {job['failed']}\n"
+    progress_text += f"🚫 *Заблокировали бота:* {job['blocked']}"
+    return progress_text
 
-async def handle_successful_payment(message: Dict[str, Any]):
-    """Handle successful payment notification"""
+def start_broadcast_job(job_id: str):
+    """Run broadcast job in background, unless another worker already runs it"""
+    if job_id in broadcast_tasks:
+        return
+    task = asyncio.create_task(run_with_lease(f"broadcast:{job_id}", lambda: run_broadcast_job(job_id)))
+    broadcast_tasks[job_id] = task
+    task.add_done_callback(lambda _: broadcast_tasks.pop(job_id, None))
+
+async def run_broadcast_job(job_id: str):
+    """Send broadcast to all users in batches, persisting progress after every batch"""
+    job = await db.broadcast_jobs.find_one({"job_id": job_id})
+    if not job or job['status'] != "running":
+        return
+    
+    logging.info(f"📢 Broadcast {job_id} started from {job.get('last_user_id') or 'beginning'}")
+    users_filter = broadcast_users_filter(job['admin_id'])
+    last_progress_at = time.monotonic()
+    
     try:
-        payment_info = message.get('successful_payment', {})
-        chat_id = message.get('chat', {}).get('id')
-        
-        if not payment_info or not chat_id:
-            return
-            
-        # Extract payment details
-        total_amount = float(payment_info.get('total_amount', 0)) / 100  # Convert from kopeks to rubles
-        payload = payment_info.get('invoice_payload', '')
-        
-        # Parse payload (format: "stars_payment_USER_ID_AMOUNT")
-        parts = payload.split('_')
-        if len(parts) >= 4 and parts[0] == 'stars' and parts[1] == 'payment':
-            user_id = int(parts[2])
-            amount = float(parts[3])
-            
-            # Create payment record
-            payment = Payment(
-                user_id=user_id,
-                amount=amount,
-                payment_type="stars",
-                payment_id=payment_info.get('telegram_payment_charge_id'),
-                status="completed"
-            )
-            
-            # Save payment to database
-            await db.payments.insert_one(payment.dict())
+        while True:
+            batch_filter = dict(users_filter)
+            if job.get('last_user_id') is not None:
+                batch_filter["_id"] = {"$gt": job['last_user_id']}
             
-            # Update user balance
-            await db.users.update_one(
-                {"telegram_id": user_id},
-                {"$inc": {"balance": amount}}
-            )
+            batch = await db.users.find(batch_filter, {"telegram_id": 1}).sort("_id", 1).limit(BROADCAST_BATCH_SIZE).to_list(BROADCAST_BATCH_SIZE)
+            if not batch:
+                break
             
-            # Send confirmation message
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-            message_text = (
-                f"✅ *Оплата успешно проведена!*\n\n"
-                f"💰 Сумма: {amount} ₽\n"
-                f"💫 Баланс пополнен\n\n"
-                f"🔍 Теперь вы можете пользоваться поиском!"
-            )
+            statuses = await send_broadcast_batch([user_data['telegram_id'] for user_data in batch if user_data.get('telegram_id')], job['text'])
             
-            payload = {
-                "chat_id": chat_id,
-                "text": message_text,
-                "parse_mode": "Markdown"
+            counts = {
+                "sent": statuses.count("sent"),
+                "failed": statuses.count("failed"),
+                "blocked": statuses.count("blocked")
             }
+            job['last_user_id'] = batch[-1]['_id']
+            for key, value in counts.items():
+                job[key] += value
             
-            requests.post(url, json=payload)
+            await db.broadcast_jobs.update_one(
+                {"job_id": job_id},
+                {
+                    "$set": {"last_user_id": job['last_user_id'], "updated_at": datetime.utcnow()},
+                    "$inc": counts
+                }
+            )
             
+            if job.get('progress_message_id') and time.monotonic() - last_progress_at >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress_at = time.monotonic()
+                await telegram_request("editMessageText", {
+                    "chat_id": job['chat_id'],
+                    "message_id": job['progress_message_id'],
+                    "text": format_broadcast_progress(job),
+                    "parse_mode": "Markdown"
+                })
+    except asyncio.CancelledError:
+        # Shutdown or lost lease - job stays "running" and is resumed by resume loop
+        logging.info(f"📢 Broadcast {job_id} interrupted, will resume from saved progress")
+        raise
     except Exception as e:
-        logging.error(f"Error handling successful payment: {e}")
+        logging.error(f"Broadcast {job_id} failed: {e}")
+        await db.broadcast_jobs.update_one({"job_id": job_id}, {"$set": {"status": "failed", "updated_at": datetime.utcnow()}})
+        await send_telegram_message(job['chat_id'], f"❌ *РАССЫЛКА ПРЕРВАНА*\n\n{format_broadcast_progress(job)}", reply_markup=create_admin_menu())
+        return
+    
+    await db.broadcast_jobs.update_one({"job_id": job_id}, {"$set": {"status": "completed", "updated_at": datetime.utcnow()}})
+    
+    total_users = job['total']
+    sent_count = job['sent']
+    
+    # Send results to admin
+    result_text = f"✅ *РАССЫЛКА ЗАВЕРШЕНА*\n\n"
+    result_text += f"👥 *Всего пользователей:* {total_users}\n"
+    result_text += f"✅ *Доставлено:* {sent_count}\n"
+    result_text += f"❌ *Не доставлено:* {job['failed']}\n"
+    result_text += f"🚫 *Заблокировали бота:* {job['blocked']}\n\n"
+    result_text += f"📊 *Эффективность:* {(sent_count/total_users*100):.1f}%" if total_users > 0 else ""
+    
+    await send_telegram_message(job['chat_id'], result_text, reply_markup=create_admin_menu())
+    logging.info(f"📢 Broadcast {job_id} completed: {sent_count}/{total_users}")
+
+async def resume_broadcast_jobs():
+    """Resume broadcasts interrupted by restart or left by another worker"""
+    async for job in db.broadcast_jobs.find({"status": "running"}, {"job_id": 1}):
+        start_broadcast_job(job['job_id'])
+
+async def broadcast_resume_loop():
+    """Pick up running broadcasts whose lease has expired"""
+    while True:
+        try:
+            await resume_broadcast_jobs()
+        except Exception as e:
+            logging.error(f"Broadcast resume failed: {e}")
+        await asyncio.sleep(LEASE_TTL)
+
+async def stop_broadcast_jobs():
+    """Cancel running broadcast tasks, progress is already persisted"""
+    tasks = list(broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 async def handle_telegram_update(update_data: Dict[str, Any]):
     """Process incoming Telegram update"""
     # Handle pre_checkout_query for Telegram Stars payments
@@ -1657,7 +3747,7 @@ async def handle_telegram_update(update_data: Dict[str, Any]):
             await process_referral(user.telegram_id, referral_code)
         
         if not user.is_admin:
-            is_subscribed = await check_subscription(user.telegram_id)
+            is_subscribed = await check_subscription(user.telegram_id, user)
             if not is_subscribed:
                 await send_telegram_message(
                     chat_id,
@@ -1700,10 +3790,11 @@ async def handle_telegram_update(update_data: Dict[str, Any]):
     else:
         await handle_search_query(chat_id, text, user)
 
+@instrumented
 async def handle_search_query(chat_id: int, query: str, user: User):
     """Handle search query"""
     if not user.is_admin:
-        is_subscribed = await check_subscription(user.telegram_id)
+        is_subscribed = await check_subscription(user.telegram_id, user)
         if not is_subscribed:
             await send_telegram_message(
                 chat_id,
@@ -1712,9 +3803,10 @@ async def handle_search_query(chat_id: int, query: str, user: User):
             )
             return
     
-    can_search_result, payment_method = await can_search(user)
+    # Списываем поиск до запроса, при ошибке сервиса возвращаем
+    reserved, payment_method = await reserve_search(user)
     
-    if not can_search_result and not user.is_admin:
+    if not reserved:
         if "превышен дневной лимит" in payment_method:
             await send_telegram_message(
                 chat_id,
@@ -1729,7 +3821,7 @@ async def handle_search_query(chat_id: int, query: str, user: User):
             )
         return
     
-    search_type = detect_search_type(query)
+    search_type, normalized_query = classify_search_query(query)
     
     await send_telegram_message(
         chat_id,
@@ -1737,46 +3829,165 @@ async def handle_search_query(chat_id: int, query: str, user: User):
     )
     
     try:
-        results = await usersbox_request("/search", {"q": query})
-        
-        formatted_results = format_search_results(results, query, search_type)
-        await send_telegram_message(chat_id, formatted_results, reply_markup=create_main_menu())
-        
-        # Process payment and save search
+        results = await search_usersbox(query, normalized_query)
+    except Exception as e:
+        logging.error(f"Search failed for user {user.telegram_id}: {e}")
+        await refund_search(user, payment_method)
+        await send_telegram_message(
+            chat_id,
+            "❌ Ошибка при выполнении поиска. Попробуйте позже.",
+            reply_markup=create_main_menu()
+        )
+        return
+    
+    cost = SEARCH_COST if payment_method == "balance" else 0.0
+    refunded = False
+    if results.get('status') == 'error':
+        # Ошибка сервиса - поиск не списываем
+        await refund_search(user, payment_method)
+        refunded = True
         cost = 0.0
-        if not user.is_admin:
-            if await has_active_subscription(user):
-                await db.users.update_one(
-                    {"telegram_id": user.telegram_id},
-                    {"$inc": {"daily_searches_used": 1}}
-                )
-                payment_method = "subscription"
-            else:
-                cost = 25.0
-                await db.users.update_one(
-                    {"telegram_id": user.telegram_id},
-                    {"$inc": {"balance": -25.0}}
-                )
-                payment_method = "balance"
+    
+    try:
+        reply = render_search_results(results, query, search_type)
+        delivered = await send_search_reply(chat_id, reply)
+        if not delivered and results.get('status') != 'error':
+            # Результаты не дошли - поиск не списываем
+            await refund_search(user, payment_method)
+            refunded = True
+            cost = 0.0
+        
+        results_ref = None
+        if results.get('status') == 'success':
+            # Ответы с ошибкой не хранятся: повторять из них нечего
+            try:
+                results_ref = await store_search_payload(normalized_query, results)
+            except Exception as e:
+                logging.error(f"Search payload store error: {e}")
         
         search = Search(
             user_id=user.telegram_id,
             query=query,
+            normalized_query=normalized_query,
             search_type=search_type,
-            results=results,
+            results_ref=results_ref,
+            results_count=(results.get('data') or {}).get('count', 0),
             success=results.get('status') == 'success',
             cost=cost,
             payment_method=payment_method
         )
         await db.searches.insert_one(search.dict())
+        await db.users.update_one(
+            {"telegram_id": user.telegram_id},
+            {"$inc": {"total_searches": 1, "successful_searches": int(search.success)}}
+        )
+        await increment_stats({"searches": 1, "successful_searches": int(search.success), "search_revenue": cost})
     
     except Exception as e:
+        logging.error(f"Search handling failed for user {user.telegram_id}: {e}")
+        if not refunded:
+            # Поиск не завершился - резерв возвращаем, как и при ошибке сервиса
+            await refund_search(user, payment_method)
         await send_telegram_message(
             chat_id,
             "❌ Ошибка при выполнении поиска. Попробуйте позже.",
             reply_markup=create_main_menu()
         )
 
+# User states
+def user_state_expired(user_state: UserState) -> bool:
+    """Mongo TTL monitor removes expired states only once a minute"""
+    return (datetime.utcnow() - user_state.created_at).total_seconds() >= USER_STATE_TTL
+
+class MongoUserStateBackend:
+    """User states in the user_states collection, shared by all workers"""
+
+    async def get(self, user_id: int) -> Optional[UserState]:
+        state_data = await db.user_states.find_one({"user_id": user_id})
+        if state_data:
+            return UserState(**state_data)
+        return None
+
+    async def set(self, user_state: UserState):
+        await db.user_states.update_one(
+            {"user_id": user_state.user_id},
+            {"$set": user_state.dict()},
+            upsert=True
+        )
+
+    async def clear(self, user_id: int):
+        await db.user_states.delete_one({"user_id": user_id})
+
+class MemoryUserStateBackend:
+    """User states in process memory, for single-process deployments"""
+
+    def __init__(self):
+        self._states: Dict[int, UserState] = {}
+
+    async def get(self, user_id: int) -> Optional[UserState]:
+        return self._states.get(user_id)
+
+    async def set(self, user_state: UserState):
+        self._states[user_state.user_id] = user_state
+
+    async def clear(self, user_id: int):
+        self._states.pop(user_id, None)
+
+USER_STATE_BACKENDS = {
+    "mongo": MongoUserStateBackend,
+    "memory": MemoryUserStateBackend,
+}
+
+class UserStateStore:
+    """Write-through cache in front of a user state backend.
+
+    A state set on another worker must be seen on the next message, or the
+    input is routed as a search. Users without a state are therefore cached
+    only for USER_STATE_NEGATIVE_CACHE_TTL. States are kept for
+    USER_STATE_CACHE_TTL only while cluster events can invalidate them on
+    other workers.
+    """
+
+    def __init__(self, backend, invalidated_elsewhere: bool = CLUSTER_EVENTS_MODE != "off"):
+        self.backend = backend
+        self.cache = TTLCache("user_state", USER_STATE_CACHE_SIZE, USER_STATE_CACHE_TTL)
+        self.state_ttl = USER_STATE_CACHE_TTL if invalidated_elsewhere else USER_STATE_NEGATIVE_CACHE_TTL
+
+    async def get(self, user_id: int) -> Optional[UserState]:
+        user_state = self.cache.get(user_id)
+        if user_state is CACHE_MISS:
+            user_state = await self.backend.get(user_id)
+            self._cache(user_id, user_state)
+        if user_state and user_state_expired(user_state):
+            await self.clear(user_id)
+            return None
+        return user_state
+
+    async def set(self, user_state: UserState):
+        await self._write(user_state.user_id, self.backend.set(user_state))
+        self._cache(user_state.user_id, user_state)
+
+    async def clear(self, user_id: int):
+        await self._write(user_id, self.backend.clear(user_id))
+        self._cache(user_id, None)
+
+    async def _write(self, user_id: int, write):
+        """Run a backend write; the cached value is dropped here and on other workers even if it fails"""
+        self.cache.invalidate(user_id)
+        try:
+            await write
+        finally:
+            await publish_cache_invalidation(self.cache, user_id)
+
+    def _cache(self, user_id: int, user_state: Optional[UserState]):
+        if user_state:
+            ttl = min(self.state_ttl, USER_STATE_TTL - (datetime.utcnow() - user_state.created_at).total_seconds())
+        else:
+            ttl = USER_STATE_NEGATIVE_CACHE_TTL
+        self.cache.set(user_id, user_state, max(ttl, 0))
+
+user_state_store = UserStateStore(USER_STATE_BACKENDS[USER_STATE_BACKEND]())
+
 async def set_user_state(user_id: int, state: str, data: Dict[str, Any] = None):
     """Set user state for custom input"""
     user_state = UserState(
@@ -1784,21 +3995,15 @@ async def set_user_state(user_id: int, state: str, data: Dict[str, Any] = None):
         state=state,
         data=data or {}
     )
-    # Удаляем старое состояние если есть
-    await db.user_states.delete_many({"user_id": user_id})
-    # Добавляем новое состояние
-    await db.user_states.insert_one(user_state.dict())
+    await user_state_store.set(user_state)
 
 async def get_user_state(user_id: int) -> Optional[UserState]:
     """Get user state"""
-    state_data = await db.user_states.find_one({"user_id": user_id})
-    if state_data:
-        return UserState(**state_data)
-    return None
+    return await user_state_store.get(user_id)
 
 async def clear_user_state(user_id: int):
     """Clear user state"""
-    await db.user_states.delete_many({"user_id": user_id})
+    await user_state_store.clear(user_id)
 
 def validate_custom_amount(amount_str: str) -> tuple[bool, str, float]:
     """Validate custom amount input"""
@@ -1822,12 +4027,6 @@ def validate_custom_amount(amount_str: str) -> tuple[bool, str, float]:
 async def create_cryptobot_invoice(amount: float, user_id: int, currency: str = "RUB") -> Dict[str, Any]:
     """Create CryptoBot invoice"""
     try:
-        url = f"{CRYPTOBOT_BASE_URL}/createInvoice"
-        headers = {
-            "Crypto-Pay-API-Token": CRYPTOBOT_TOKEN,
-            "Content-Type": "application/json"
-        }
-        
         payload = {
             "currency_type": "fiat",
             "fiat": currency,
@@ -1838,42 +4037,42 @@ async def create_cryptobot_invoice(amount: float, user_id: int, currency: str =
             "payload": f"crypto_payment_{user_id}_{amount}"
         }
         
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = await http_request("cryptobot", "POST", "/createInvoice", json=payload)
         return response.json()
         
     except Exception as e:
         logging.error(f"CryptoBot API error: {e}")
         return {"ok": False, "error": {"message": str(e)}}
 
+@instrumented
 async def handle_pre_checkout_query(pre_checkout_query: Dict[str, Any]):
     """Handle pre-checkout query for Telegram Stars payments"""
-    query_id = pre_checkout_query.get('id')
     user_id = pre_checkout_query.get('from', {}).get('id')
-    invoice_payload = pre_checkout_query.get('invoice_payload', '')
+    answer = pre_checkout_answer(pre_checkout_query)
     
     try:
-        # Always approve the pre-checkout query for valid Stars payments
-        if invoice_payload.startswith('stars_payment_'):
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerPreCheckoutQuery"
-            data = {
-                "pre_checkout_query_id": query_id,
-                "ok": True
-            }
-            requests.post(url, json=data, timeout=10)
+        # Valid Stars payments are always approved, usually right in the webhook response
+        if not replied_in_webhook("answerPreCheckoutQuery"):
+            await telegram_request("answerPreCheckoutQuery", answer)
+        if answer["ok"]:
             logging.info(f"Pre-checkout approved for user {user_id}")
         else:
             # Reject invalid payments
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerPreCheckoutQuery"
-            data = {
-                "pre_checkout_query_id": query_id,
-                "ok": False,
-                "error_message": "Неверный платеж"
-            }
-            requests.post(url, json=data, timeout=10)
             logging.warning(f"Pre-checkout rejected for user {user_id}: invalid payload")
     except Exception as e:
         logging.error(f"Error handling pre-checkout query: {e}")
 
+def stars_payment_amount(invoice_payload: str, total_amount: int) -> float:
+    """Rubles to credit for a Stars invoice payload stars_payment_{user_id}_{amount}"""
+    payload_parts = invoice_payload.split('_')
+    if len(payload_parts) == 4:
+        try:
+            return float(payload_parts[3])
+        except ValueError:
+            pass
+    return total_amount * 2  # 1 star = 2 rubles
+
+@instrumented
 async def handle_successful_payment(message: Dict[str, Any]):
     """Handle successful payment notification"""
     payment_info = message.get('successful_payment', {})
@@ -1888,30 +4087,16 @@ async def handle_successful_payment(message: Dict[str, Any]):
     try:
         # Process Stars payment
         if currency == 'XTR' and invoice_payload.startswith('stars_payment_'):
-            # Extract amount from payload: stars_payment_{user_id}_{amount}
-            payload_parts = invoice_payload.split('_')
-            if len(payload_parts) >= 3:
-                ruble_amount = float(payload_parts[2])
-            else:
-                ruble_amount = total_amount * 2  # 1 star = 2 rubles
+            ruble_amount = stars_payment_amount(invoice_payload, total_amount)
             
-            # Update user balance
-            result = await db.users.update_one(
-                {"telegram_id": user_id},
-                {"$inc": {"balance": ruble_amount}}
+            payment = Payment(
+                user_id=user_id,
+                amount=ruble_amount,
+                payment_type="stars",
+                payment_id=payment_info.get('telegram_payment_charge_id')
             )
             
-            if result.modified_count > 0:
-                # Save payment record
-                payment = Payment(
-                    user_id=user_id,
-                    amount=ruble_amount,
-                    payment_type="stars",
-                    payment_id=payment_info.get('telegram_payment_charge_id'),
-                    status="completed"
-                )
-                await db.payments.insert_one(payment.dict())
-                
+            if await credit_payment(payment):
                 # Send notification to user
                 notification_text = f"🎉 *ПОПОЛНЕНИЕ УСПЕШНО!*\n\n"
                 notification_text += f"⭐ *Способ:* Telegram Stars\n"
@@ -1927,8 +4112,6 @@ async def handle_successful_payment(message: Dict[str, Any]):
                 )
                 
                 logging.info(f"Stars payment processed: {ruble_amount}₽ for user {user_id}")
-            else:
-                logging.error(f"Failed to update balance for user {user_id}")
         else:
             logging.warning(f"Unknown payment type: currency={currency}, payload={invoice_payload}")
             
@@ -1962,6 +4145,7 @@ async def process_referral(referred_user_id: int, referral_code: str) -> bool:
             confirmed=False
         )
         await db.referrals.insert_one(referral.dict())
+        await increment_stats({"referrals": 1})
 
         await db.users.update_one(
             {"telegram_id": referrer['telegram_id']},
@@ -1979,29 +4163,82 @@ async def process_referral(referred_user_id: int, referral_code: str) -> bool:
         return False
 
 # API endpoints
+USERS_EXPORT_BATCH_SIZE = 1000
+
+def serialize_document(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Make Mongo document JSON-serializable"""
+    for key, value in document.items():
+        if isinstance(value, ObjectId):
+            document[key] = str(value)
+        elif isinstance(value, datetime):
+            document[key] = value.isoformat()
+    return document
+
 @api_router.get("/users")
-async def get_users():
-    """Get all users"""
-    users = await db.users.find().to_list(1000)
-    for user in users:
-        user["_id"] = str(user["_id"])
-    return users
+async def get_users(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    is_admin: Optional[bool] = None,
+    is_subscribed: Optional[bool] = None,
+    active_since: Optional[datetime] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    """Get users page by page (keyset on _id), or stream all of them as NDJSON"""
+    query_filter: Dict[str, Any] = {}
+    if cursor:
+        try:
+            query_filter["_id"] = {"$gt": ObjectId(cursor)}
+        except InvalidId:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    if is_admin is not None:
+        query_filter["is_admin"] = is_admin
+    if is_subscribed is not None:
+        query_filter["is_subscribed"] = is_subscribed
+    if active_since is not None:
+        query_filter["last_active"] = {"$gte": active_since}
+    
+    projection = None
+    if fields:
+        projection = {field.strip(): 1 for field in fields.split(",") if field.strip()}
+    
+    if format == "ndjson":
+        async def export_users():
+            users_cursor = db.users.find(query_filter, projection).sort("_id", 1).batch_size(USERS_EXPORT_BATCH_SIZE)
+            async for user in users_cursor:
+                yield json.dumps(serialize_document(user), ensure_ascii=False) + "\n"
+        
+        return StreamingResponse(export_users(), media_type="application/x-ndjson")
+    
+    users = await db.users.find(query_filter, projection).sort("_id", 1).limit(limit).to_list(limit)
+    next_cursor = str(users[-1]["_id"]) if len(users) == limit else None
+    return {
+        "users": [serialize_document(user) for user in users],
+        "next_cursor": next_cursor
+    }
 
 @api_router.get("/stats")
 async def get_stats():
     """Get bot statistics"""
-    total_users = await db.users.count_documents({})
-    total_searches = await db.searches.count_documents({})
-    total_referrals = await db.referrals.count_documents({})
-    active_subs = await db.users.count_documents({"subscription_expires": {"$gt": datetime.utcnow()}})
+    stats = await get_stats_snapshot()
 
     return {
-        "total_users": total_users,
-        "total_searches": total_searches,
-        "total_referrals": total_referrals,
-        "active_subscriptions": active_subs
+        "total_users": stats.get('users', 0),
+        "total_searches": stats.get('searches', 0),
+        "total_referrals": stats.get('referrals', 0),
+        "active_subscriptions": stats.get('active_subscriptions', 0),
+        "successful_searches": stats.get('successful_searches', 0),
+        "search_revenue": stats.get('search_revenue', 0.0),
+        "subscription_revenue": stats.get('subscription_revenue', 0.0),
+        "payments_amount": stats.get('payments_amount', {}),
+        "reconciled_at": stats.get('reconciled_at')
     }
 
+@api_router.get("/stats/daily")
+async def get_stats_daily(days: int = Query(30, ge=1, le=366)):
+    """Get daily searches, revenue and payments by payment type"""
+    return await get_daily_stats(days)
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -2019,6 +4256,33 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# httpx logs every request URL at INFO, and Telegram URLs contain the bot token
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def startup_background_services():
+    await ensure_indexes()
+    await init_http_clients()
+    telegram_dispatcher.start()
+    update_queue.start()
+    if CLUSTER_EVENTS_MODE != "off":
+        background_tasks.append(asyncio.create_task(cluster_events_listener()))
+    background_tasks.append(asyncio.create_task(broadcast_resume_loop()))
+    background_tasks.append(asyncio.create_task(singleton_loop("stats_reconcile", stats_reconcile_loop)))
+    background_tasks.append(asyncio.create_task(singleton_loop("subscription_expiry", subscription_expiry_loop)))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await update_queue.stop()
+    await stop_broadcast_jobs()
+    for task in background_tasks:
+        task.cancel()
+    # Singleton jobs release their leases while being cancelled
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await asyncio.gather(*detached_tasks, return_exceptions=True)
+    await telegram_dispatcher.stop()
+    await close_http_clients()
+    client.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк маршрутизации callback-кнопок
+
+Проверяет, что все callback_data из клавиатур находят маршрут, и измеряет
+время поиска маршрута в CallbackRouter: для точных маршрутов (меню) и для
+параметризованных (crypto_<валюта>_<сумма>, stars_<сумма>). Затем добавляет
+в роутер --extra-routes фиктивных меню и показывает, что поиск существующих
+маршрутов от этого не замедляется.
+
+Запуск:
+  python benchmarks/callback_router_benchmark.py [--iterations N] [--extra-routes N]
+"""
+
+import argparse
+import re
+import sys
+import timeit
+from pathlib import Path
+
+# Добавляем путь к backend
+SERVER_PATH = Path(__file__).resolve().parent.parent / 'backend' / 'server.py'
+sys.path.insert(0, str(SERVER_PATH.parent))
+
+from server import CRYPTO_NAMES, callback_router, show_help_menu
+
+# Кнопки без обработчика (были и до роутера)
+KNOWN_UNROUTED = {"admin_users", "admin_payments"}
+
+SAMPLES = ["menu_help", "back_to_menu", "stars_500", "crypto_usdt", "crypto_btc_1000", "crypto_eth_custom"]
+
+
+def keyboard_callbacks() -> set:
+    """callback_data всех кнопок server.py, f-строки раскрываются по валютам"""
+    callbacks = set()
+    for data in re.findall(r'"callback_data": f?"([^"]+)"', SERVER_PATH.read_text(encoding="utf-8")):
+        if "{crypto_type}" in data:
+            callbacks.update(data.replace("{crypto_type}", crypto_type) for crypto_type in CRYPTO_NAMES)
+        else:
+            callbacks.add(data)
+    return callbacks
+
+
+def measure(iterations: int) -> dict:
+    """Микросекунд на поиск маршрута для каждого образца"""
+    return {
+        data: min(timeit.repeat(lambda: callback_router.resolve(data), number=iterations, repeat=3)) / iterations * 1e6
+        for data in SAMPLES
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк маршрутизации callback-кнопок")
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--extra-routes", type=int, default=1000)
+    args = parser.parse_args()
+
+    unrouted = sorted(data for data in keyboard_callbacks() - KNOWN_UNROUTED if callback_router.resolve(data) is None)
+    for data in unrouted:
+        print(f"❌ Нет маршрута для {data!r}")
+    if not unrouted:
+        print("✅ Все кнопки клавиатур находят маршрут")
+
+    before = measure(args.iterations)
+    for index in range(args.extra_routes):
+        callback_router.add(f"menu_extra{index}", show_help_menu)
+        callback_router.add(f"extra{index}_{{amount:int}}", show_help_menu)
+    after = measure(args.iterations)
+
+    print(f"⚡ Поиск маршрута, мкс (до / после +{args.extra_routes * 2} маршрутов):")
+    for data in SAMPLES:
+        print(f"   {data}: {before[data]:.2f} / {after[data]:.2f}")
+
+    return 1 if unrouted else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Локальные заглушки Telegram Bot API, usersbox и CryptoBot для нагрузочных тестов
+
+Одно FastAPI-приложение обслуживает все три сервиса под префиксами
+/telegram, /usersbox и /cryptobot. Для каждого сервиса задается профиль:
+задержка ответа, разброс, доля ошибок 5xx и (для Telegram) доля ответов
+429 с retry_after. Все вызовы считаются по методам.
+
+Запуск отдельно (для ручной проверки server.py):
+  python benchmarks/fake_services.py [--port 8900] [--telegram-latency 0.05] ...
+
+Адреса для server.py:
+  TELEGRAM_API_URL=http://127.0.0.1:8900/telegram
+  USERSBOX_BASE_URL=http://127.0.0.1:8900/usersbox
+  CRYPTOBOT_BASE_URL=http://127.0.0.1:8900/cryptobot
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+@dataclass
+class ServiceProfile:
+    """Поведение заглушки: задержка, разброс и доли ошибок"""
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0  # Только Telegram: 429 Too Many Requests
+
+    async def delay(self):
+        latency = self.latency + random.uniform(0, self.jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def failure(self):
+        """Ответ с ошибкой или None"""
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return JSONResponse(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                 "parameters": {"retry_after": 1}},
+                status_code=429
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            return JSONResponse({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status_code=500)
+        return None
+
+
+def usersbox_results(query: str, sources: int, hits: int) -> dict:
+    """Синтетический ответ usersbox /search"""
+    items = [
+        {
+            "source": {"database": database, "collection": f"{database}_{index}"},
+            "hits": {
+                "hitsCount": hits,
+                "items": [
+                    {"phone": f"+7912{index:03d}{hit:04d}", "name": f"Тест {query} {hit}", "city": "Москва"}
+                    for hit in range(hits)
+                ]
+            }
+        }
+        for index, database in zip(range(sources), itertools.cycle(["vk", "ok", "yandex", "avito", "cdek"]))
+    ]
+    return {"status": "success", "data": {"count": sources * hits, "items": items}}
+
+
+def create_fake_app(telegram: ServiceProfile, usersbox: ServiceProfile, cryptobot: ServiceProfile,
+                    usersbox_sources: int = 3, usersbox_hits: int = 2) -> FastAPI:
+    """Приложение со всеми тремя заглушками; app.state.calls - счетчик вызовов"""
+    app = FastAPI(title="УЗРИ fake services")
+    calls = Counter()
+    message_ids = itertools.count(1)
+    invoice_ids = itertools.count(1)
+    app.state.calls = calls
+
+    @app.post("/telegram/bot{token}/{method}")
+    async def telegram_method(token: str, method: str, request: Request):
+        calls[f"telegram.{method}"] += 1
+        await telegram.delay()
+        failure = telegram.failure()
+        if failure is not None:
+            return failure
+
+        if method == "getChatMember":
+            return {"ok": True, "result": {"status": "member"}}
+        if method in ("sendMessage", "sendInvoice", "sendDocument"):
+            return {"ok": True, "result": {"message_id": next(message_ids), "date": int(time.time())}}
+        if method in ("editMessageText", "editMessageReplyMarkup"):
+            payload = await request.json()
+            now = int(time.time())
+            return {"ok": True, "result": {"message_id": payload.get("message_id"), "date": now, "edit_date": now}}
+        if method == "getUpdates":
+            return {"ok": True, "result": []}
+        return {"ok": True, "result": True}
+
+    @app.get("/usersbox/search")
+    async def usersbox_search(q: str = ""):
+        calls["usersbox.search"] += 1
+        await usersbox.delay()
+        failure = usersbox.failure()
+        if failure is not None:
+            return JSONResponse({"status": "error", "error": {"message": "fake upstream error"}}, status_code=500)
+        return usersbox_results(q, usersbox_sources, usersbox_hits)
+
+    @app.post("/cryptobot/createInvoice")
+    async def cryptobot_create_invoice():
+        calls["cryptobot.createInvoice"] += 1
+        await cryptobot.delay()
+        failure = cryptobot.failure()
+        if failure is not None:
+            return JSONResponse({"ok": False, "error": {"message": "fake upstream error"}}, status_code=500)
+        invoice_id = next(invoice_ids)
+        return {"ok": True, "result": {"invoice_id": invoice_id, "bot_invoice_url": f"https://t.me/CryptoBot?start={invoice_id}"}}
+
+    @app.get("/calls")
+    async def get_calls():
+        return dict(calls)
+
+    return app
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Параметры профилей заглушек (общие с load_test.py)"""
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--telegram-jitter", type=float, default=0.02)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-429-rate", type=float, default=0.0)
+    parser.add_argument("--usersbox-latency", type=float, default=0.3)
+    parser.add_argument("--usersbox-jitter", type=float, default=0.2)
+    parser.add_argument("--usersbox-error-rate", type=float, default=0.0)
+    parser.add_argument("--usersbox-sources", type=int, default=3)
+    parser.add_argument("--usersbox-hits", type=int, default=2)
+    parser.add_argument("--cryptobot-latency", type=float, default=0.1)
+    parser.add_argument("--cryptobot-error-rate", type=float, default=0.0)
+
+
+def fake_app_from_args(args) -> FastAPI:
+    return create_fake_app(
+        ServiceProfile(args.telegram_latency, args.telegram_jitter, args.telegram_error_rate, args.telegram_429_rate),
+        ServiceProfile(args.usersbox_latency, args.usersbox_jitter, args.usersbox_error_rate),
+        ServiceProfile(args.cryptobot_latency, 0.0, args.cryptobot_error_rate),
+        usersbox_sources=args.usersbox_sources,
+        usersbox_hits=args.usersbox_hits
+    )
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Заглушки Telegram, usersbox и CryptoBot")
+    parser.add_argument("--port", type=int, default=8900)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    print(f"🧪 Заглушки на http://127.0.0.1:{args.port} (/telegram, /usersbox, /cryptobot)")
+    uvicorn.run(fake_app_from_args(args), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
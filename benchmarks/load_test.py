@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+"""
+Офлайн нагрузочный тест бота
+
+Запускает заглушки Telegram Bot API, usersbox и CryptoBot (fake_services.py),
+поднимает backend/server.py через uvicorn против них и отдельной временной
+базы MongoDB, затем с заданной частотой отправляет в вебхук синтетическую
+смесь обновлений: поиски, переходы по меню, /start, оплату звездами и
+криптой (включая вебхук CryptoBot) и, по желанию, рассылку от админа.
+
+Отчет:
+  - p50/p95/p99 времени ответа вебхука и время обработки обновления
+    (по гистограмме bot_update_seconds из /api/metrics)
+  - обновлений в секунду
+  - команд MongoDB на обновление
+  - исходящих HTTP-вызовов на обновление (по сервисам)
+
+С --record-baseline результат сохраняется в load_baseline.json, иначе
+сравнивается с ним: ухудшение любой метрики больше --tolerance - ошибка,
+отсутствие базового файла - тоже ошибка. Сравниваются только метрики,
+которые есть в базовом файле. В репозитории он содержит лишь счетчики на
+обновление (команды MongoDB, исходящие вызовы): они не зависят от машины.
+Чтобы проверять и задержки, запишите базовый результат на своей машине.
+
+Нужен доступный MongoDB (--mongo-url); база uzri_bench_<время> удаляется
+после прогона.
+
+Запуск:
+  python benchmarks/load_test.py [--rate 50] [--duration 30] [--users 200]
+                                 [--mix search=30,menu=40,start=10,stars=10,crypto=10]
+                                 [--broadcast] [--record-baseline] [--tolerance 0.25]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import httpx
+import uvicorn
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
+
+from fake_services import add_profile_arguments, fake_app_from_args
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+BASELINE_PATH = Path(__file__).resolve().parent / 'load_baseline.json'
+
+WEBHOOK_SECRET = "bench-secret"
+ADMIN_ID = 1
+FIRST_USER_ID = 100000
+USER_BALANCE = 1_000_000.0
+
+MENU_CALLBACKS = ["menu_profile", "menu_balance", "menu_pricing", "menu_help", "menu_referral", "back_to_menu", "pay_crypto", "pay_stars"]
+HOT_QUERIES = ["+79123456789", "user@mail.ru", "@durov", "Иван Петров", "А123ВС777"]
+DEFAULT_MIX = "search=30,menu=40,start=10,stars=10,crypto=10"
+
+# Метрика -> чем больше, тем лучше
+REPORT_METRICS = {
+    "webhook_p50_ms": False,
+    "webhook_p95_ms": False,
+    "webhook_p99_ms": False,
+    "processing_p50_ms": False,
+    "processing_p95_ms": False,
+    "processing_p99_ms": False,
+    "updates_per_second": True,
+    "mongo_ops_per_update": False,
+    "outbound_calls_per_update": False,
+}
+
+METRIC_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"❌ Неизвестный сценарий {name!r}, доступны: {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# Разбор /api/metrics
+def parse_metrics(text: str) -> Dict[str, Dict[Tuple, float]]:
+    """Prometheus text -> {имя: {(метки...): значение}}"""
+    metrics = defaultdict(dict)
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = METRIC_LINE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            metrics[name][tuple(LABEL.findall(labels or ""))] = float(value)
+    return metrics
+
+
+def metrics_delta(before: Dict, after: Dict) -> Dict[str, Dict[Tuple, float]]:
+    return {
+        name: {labels: value - before.get(name, {}).get(labels, 0.0) for labels, value in series.items()}
+        for name, series in after.items()
+    }
+
+
+def metric_total(metrics: Dict, name: str) -> float:
+    return sum(metrics.get(name, {}).values())
+
+
+def metric_by_label(metrics: Dict, name: str, label: str) -> Counter:
+    totals = Counter()
+    for labels, value in metrics.get(name, {}).items():
+        totals[dict(labels).get(label, "")] += value
+    return totals
+
+
+def histogram_quantile(metrics: Dict, name: str, q: float) -> float:
+    """Квантиль по бакетам гистограммы (все метки вместе), линейная интерполяция внутри бакета"""
+    buckets = Counter()
+    for labels, value in metrics.get(f"{name}_bucket", {}).items():
+        buckets[float(dict(labels)["le"])] += value
+    bounds = sorted(buckets)
+    if not bounds or not buckets[bounds[-1]]:
+        return 0.0
+    rank = q * buckets[bounds[-1]]
+    lower, lower_count = 0.0, 0.0
+    for bound in bounds:
+        if buckets[bound] >= rank:
+            if bound == float("inf"):
+                return lower
+            share = (rank - lower_count) / (buckets[bound] - lower_count) if buckets[bound] > lower_count else 1.0
+            return lower + (bound - lower) * share
+        lower, lower_count = bound, buckets[bound]
+    return lower
+
+
+# Синтетические обновления
+class UpdateFactory:
+    """Генерирует обновления Telegram для сценариев нагрузки"""
+
+    def __init__(self, users: int, repeat_ratio: float):
+        self.user_ids = [FIRST_USER_ID + index for index in range(users)]
+        self.repeat_ratio = repeat_ratio
+        self.update_ids = itertools.count(1)
+        self.ids = itertools.count(1)
+
+    def user(self) -> int:
+        return random.choice(self.user_ids)
+
+    def sender(self, user_id: int) -> Dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"}
+
+    def message(self, user_id: int, text: str = None, **extra) -> Dict:
+        message = {
+            "message_id": next(self.ids),
+            "from": self.sender(user_id),
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+            **extra
+        }
+        if text is not None:
+            message["text"] = text
+        return {"update_id": next(self.update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str) -> Dict:
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.ids)),
+                "from": self.sender(user_id),
+                "message": {"message_id": next(self.ids), "chat": {"id": user_id, "type": "private"}},
+                "data": data
+            }
+        }
+
+    def pre_checkout(self, user_id: int, amount: int) -> Dict:
+        return {
+            "update_id": next(self.update_ids),
+            "pre_checkout_query": {
+                "id": str(next(self.ids)),
+                "from": self.sender(user_id),
+                "currency": "XTR",
+                "total_amount": amount // 2,
+                "invoice_payload": f"stars_payment_{user_id}_{amount}"
+            }
+        }
+
+    def successful_payment(self, user_id: int, amount: int) -> Dict:
+        return self.message(user_id, successful_payment={
+            "currency": "XTR",
+            "total_amount": amount // 2,
+            "invoice_payload": f"stars_payment_{user_id}_{amount}",
+            "telegram_payment_charge_id": f"bench_charge_{next(self.ids)}",
+            "provider_payment_charge_id": ""
+        })
+
+    def search_query(self) -> str:
+        if random.random() < self.repeat_ratio:
+            return random.choice(HOT_QUERIES)
+        return f"+7912{random.randrange(10_000_000):07d}"
+
+    def cryptobot_paid(self, user_id: int, amount: int) -> Dict:
+        return {
+            "update_type": "invoice_paid",
+            "payload": {
+                "invoice_id": next(self.ids),
+                "status": "paid",
+                "amount": str(amount),
+                "currency_type": "fiat",
+                "fiat": "RUB",
+                "description": f"Пополнение баланса УЗРИ для пользователя {user_id}"
+            }
+        }
+
+
+# Сценарий -> список запросов (путь, тело), отправляются последовательно
+def scenario_search(factory: UpdateFactory):
+    user_id = factory.user()
+    return [("webhook", factory.message(user_id, factory.search_query()))]
+
+
+def scenario_menu(factory: UpdateFactory):
+    return [("webhook", factory.callback(factory.user(), random.choice(MENU_CALLBACKS)))]
+
+
+def scenario_start(factory: UpdateFactory):
+    return [("webhook", factory.message(factory.user(), "/start"))]
+
+
+def scenario_stars(factory: UpdateFactory):
+    user_id = factory.user()
+    return [
+        ("webhook", factory.callback(user_id, "stars_100")),
+        ("webhook", factory.pre_checkout(user_id, 100)),
+        ("webhook", factory.successful_payment(user_id, 100)),
+    ]
+
+
+def scenario_crypto(factory: UpdateFactory):
+    user_id = factory.user()
+    return [
+        ("webhook", factory.callback(user_id, "crypto_btc_100")),
+        ("cryptobot", factory.cryptobot_paid(user_id, 100)),
+    ]
+
+
+SCENARIOS = {
+    "search": scenario_search,
+    "menu": scenario_menu,
+    "start": scenario_start,
+    "stars": scenario_stars,
+    "crypto": scenario_crypto,
+}
+
+
+class LoadRunner:
+    """Отправляет сценарии в server.py и собирает время ответов"""
+
+    def __init__(self, client: httpx.AsyncClient, base_url: str):
+        self.client = client
+        self.urls = {
+            "webhook": f"{base_url}/api/webhook/{WEBHOOK_SECRET}",
+            "cryptobot": f"{base_url}/api/cryptobot/webhook",
+        }
+        self.latencies = defaultdict(list)
+        self.statuses = Counter()
+        self.updates_sent = 0
+
+    async def post(self, target: str, body: Dict):
+        started = time.perf_counter()
+        try:
+            response = await self.client.post(self.urls[target], json=body)
+            self.statuses[f"{target}:{response.status_code}"] += 1
+        except httpx.HTTPError as e:
+            self.statuses[f"{target}:{type(e).__name__}"] += 1
+        self.latencies[target].append(time.perf_counter() - started)
+        if target == "webhook":
+            self.updates_sent += 1
+
+    async def run_scenario(self, requests):
+        for target, body in requests:
+            await self.post(target, body)
+
+    async def replay(self, factory: UpdateFactory, mix: Dict[str, float], rate: float, duration: float) -> float:
+        """Открытая модель нагрузки: сценарии стартуют по расписанию, не дожидаясь ответов"""
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        tasks = []
+        started = time.perf_counter()
+        for index in itertools.count():
+            due = started + index / rate
+            if due - started >= duration:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            scenario = SCENARIOS[random.choices(names, weights)[0]]
+            tasks.append(asyncio.create_task(self.run_scenario(scenario(factory))))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+
+async def wait_until_ready(client: httpx.AsyncClient, url: str, process, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise SystemExit(f"❌ server.py завершился с кодом {process.returncode}")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit(f"❌ server.py не ответил за {timeout:.0f} с")
+
+
+async def wait_until_drained(client: httpx.AsyncClient, base_url: str, database, timeout: float):
+    """Ждет пустой очереди обновлений и завершения рассылок"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        queue = (await client.get(f"{base_url}/api/updates/metrics")).json()
+        running = await database.broadcast_jobs.count_documents({"status": "running"})
+        if not queue["pending"] and not running:
+            return True
+        await asyncio.sleep(0.2)
+    print(f"⚠️ Очередь не опустела за {timeout:.0f} с, метрики неполные")
+    return False
+
+
+def server_env(args, fake_url: str, db_name: str) -> Dict[str, str]:
+    # load_dotenv в server.py не перезаписывает уже заданные переменные
+    return {
+        **os.environ,
+        "MONGO_URL": args.mongo_url,
+        "DB_NAME": db_name,
+        "TELEGRAM_TOKEN": "bench:token",
+        "TELEGRAM_API_URL": f"{fake_url}/telegram",
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "USERSBOX_TOKEN": "bench-token",
+        "USERSBOX_BASE_URL": f"{fake_url}/usersbox",
+        "CRYPTOBOT_TOKEN": "bench-token",
+        "CRYPTOBOT_BASE_URL": f"{fake_url}/cryptobot",
+        "ADMIN_USERNAME": "bench_admin",
+        "ADMIN_TELEGRAM_ID": str(ADMIN_ID),
+        "REQUIRED_CHANNEL": "@bench_channel",
+        "CLUSTER_EVENTS_MODE": "off",
+        "WORKER_ID": "bench",
+    }
+
+
+def build_report(runner: LoadRunner, elapsed: float, delta: Dict) -> Dict:
+    processed = metric_total(delta, "bot_update_queue_processed_total") + metric_total(delta, "bot_update_queue_failed_total")
+    processed = processed or runner.updates_sent
+    per_update = lambda value: round(value / processed, 3) if processed else 0.0
+    webhook = runner.latencies["webhook"]
+    outbound = metric_by_label(delta, "bot_http_seconds_count", "service")
+    return {
+        "webhook_p50_ms": round(percentile(webhook, 0.50) * 1000, 2),
+        "webhook_p95_ms": round(percentile(webhook, 0.95) * 1000, 2),
+        "webhook_p99_ms": round(percentile(webhook, 0.99) * 1000, 2),
+        "processing_p50_ms": round(histogram_quantile(delta, "bot_update_seconds", 0.50) * 1000, 2),
+        "processing_p95_ms": round(histogram_quantile(delta, "bot_update_seconds", 0.95) * 1000, 2),
+        "processing_p99_ms": round(histogram_quantile(delta, "bot_update_seconds", 0.99) * 1000, 2),
+        "updates_per_second": round(processed / elapsed, 2) if elapsed else 0.0,
+        "mongo_ops_per_update": per_update(metric_total(delta, "bot_mongo_seconds_count")),
+        "outbound_calls_per_update": per_update(sum(outbound.values())),
+        "outbound_by_service": {service: per_update(count) for service, count in sorted(outbound.items())},
+        "mongo_by_command": {command: per_update(count) for command, count in
+                             metric_by_label(delta, "bot_mongo_seconds_count", "command").most_common(10)},
+        "updates": int(processed),
+    }
+
+
+def compare_with_baseline(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Список регрессий относительно сохраненного результата"""
+    regressions = []
+    for name, higher_is_better in REPORT_METRICS.items():
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        actual = report[name]
+        change = (actual - expected) / expected
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{name}: {actual} против {expected} ({change:+.0%})")
+    return regressions
+
+
+def print_report(report: Dict, runner: LoadRunner, fake_calls: Counter):
+    print(f"\n📊 Обновлений: {report['updates']}, {report['updates_per_second']} в секунду")
+    print(f"⏱️ Вебхук p50/p95/p99: {report['webhook_p50_ms']} / {report['webhook_p95_ms']} / {report['webhook_p99_ms']} мс")
+    print(f"⚙️ Обработка p50/p95/p99: {report['processing_p50_ms']} / {report['processing_p95_ms']} / {report['processing_p99_ms']} мс")
+    print(f"🗄️ Команд MongoDB на обновление: {report['mongo_ops_per_update']}")
+    for command, value in report["mongo_by_command"].items():
+        print(f"   {command}: {value}")
+    print(f"🌐 Исходящих вызовов на обновление: {report['outbound_calls_per_update']}")
+    for service, value in report["outbound_by_service"].items():
+        print(f"   {service}: {value}")
+    print(f"🧪 Вызовы заглушек: {dict(fake_calls.most_common())}")
+    failed = {status: count for status, count in runner.statuses.items() if not status.endswith(":200")}
+    if failed:
+        print(f"⚠️ Неуспешные ответы: {failed}")
+
+
+async def run(args) -> int:
+    mix = parse_mix(args.mix)
+    if not args.record_baseline and not args.baseline.exists():
+        # Без базового результата сравнивать не с чем - прогон не должен выглядеть успешным
+        print(f"❌ Нет базового результата {args.baseline}, запишите его с --record-baseline")
+        return 2
+    fake_port, server_port = free_port(), free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    base_url = f"http://127.0.0.1:{server_port}"
+    db_name = f"uzri_bench_{int(time.time())}"
+
+    mongo = AsyncIOMotorClient(args.mongo_url, serverSelectionTimeoutMS=5000)
+    try:
+        await mongo.admin.command("ping")
+    except PyMongoError as e:
+        print(f"❌ MongoDB недоступен ({args.mongo_url}): {e}")
+        return 2
+    database = mongo[db_name]
+
+    fake_app = fake_app_from_args(args)
+    fake_server = uvicorn.Server(uvicorn.Config(fake_app, host="127.0.0.1", port=fake_port, log_level="warning"))
+    fake_task = asyncio.create_task(fake_server.serve())
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "server:app",
+        "--host", "127.0.0.1", "--port", str(server_port), "--log-level", "warning",
+        cwd=BACKEND_DIR, env=server_env(args, fake_url, db_name)
+    )
+
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            await wait_until_ready(client, f"{base_url}/api/", process)
+            print(f"🚀 server.py на {base_url}, заглушки на {fake_url}, база {db_name}")
+
+            factory = UpdateFactory(args.users, args.repeat_ratio)
+            runner = LoadRunner(client, base_url)
+
+            # Прогрев: создаем пользователей и пополняем баланс, в метрики не входит
+            await asyncio.gather(*(runner.post("webhook", factory.message(user_id, "/start")) for user_id in factory.user_ids))
+            await wait_until_drained(client, base_url, database, args.drain_timeout)
+            await database.users.update_many({}, {"$set": {"balance": USER_BALANCE}})
+
+            before = parse_metrics((await client.get(f"{base_url}/api/metrics")).text)
+            fake_calls_before = Counter(fake_app.state.calls)
+            runner = LoadRunner(client, base_url)
+
+            print(f"🔥 Нагрузка: {args.rate} сценариев/с в течение {args.duration} с, смесь {mix}")
+            started = time.perf_counter()
+            replay = asyncio.create_task(runner.replay(factory, mix, args.rate, args.duration))
+            if args.broadcast:
+                await asyncio.sleep(args.duration / 2)
+                await runner.run_scenario([
+                    ("webhook", factory.callback(ADMIN_ID, "admin_broadcast")),
+                    ("webhook", factory.message(ADMIN_ID, "Нагрузочный тест")),
+                ])
+            await replay
+            await wait_until_drained(client, base_url, database, args.drain_timeout)
+            elapsed = time.perf_counter() - started
+
+            after = parse_metrics((await client.get(f"{base_url}/api/metrics")).text)
+            fake_calls = Counter(fake_app.state.calls)
+            fake_calls.subtract(fake_calls_before)
+    finally:
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+        fake_server.should_exit = True
+        await fake_task
+        await mongo.drop_database(db_name)
+        mongo.close()
+
+    report = build_report(runner, elapsed, metrics_delta(before, after))
+    print_report(report, runner, +fake_calls)
+
+    if args.record_baseline:
+        args.baseline.write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n")
+        print(f"💾 Результат сохранен как базовый: {args.baseline}")
+        return 0
+    regressions = compare_with_baseline(report, json.loads(args.baseline.read_text()), args.tolerance)
+    for regression in regressions:
+        print(f"❌ Регрессия {regression}")
+    if not regressions:
+        print(f"✅ Без регрессий относительно {args.baseline.name} (допуск {args.tolerance:.0%})")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный тест бота")
+    parser.add_argument("--rate", type=float, default=50, help="Сценариев в секунду")
+    parser.add_argument("--duration", type=float, default=30, help="Длительность нагрузки, с")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Веса сценариев ({', '.join(SCENARIOS)})")
+    parser.add_argument("--repeat-ratio", type=float, default=0.5, help="Доля повторных поисковых запросов")
+    parser.add_argument("--broadcast", action="store_true", help="Запустить рассылку админа посреди нагрузки")
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--mongo-url", default=os.environ.get("BENCH_MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--record-baseline", "--save-baseline", dest="record_baseline", action="store_true",
+                        help="Сохранить результат как базовый вместо сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Допустимое ухудшение метрик")
+    add_profile_arguments(parser)
+    return asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
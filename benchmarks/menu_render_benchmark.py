@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк подготовки статических меню
+
+Сравнивает стоимость формирования тела sendMessage для главного меню
+и экрана тарифов: прежний путь (сборка клавиатуры и текста на каждый
+апдейт + json.dumps всего payload) против заранее сериализованных
+шаблонов (render_json с RawJSON). Заодно проверяет, что оба пути
+отдают Telegram одинаковый JSON.
+
+Запуск:
+  python benchmarks/menu_render_benchmark.py [--iterations N]
+"""
+
+import argparse
+import json
+import sys
+import timeit
+from pathlib import Path
+
+# Добавляем путь к backend
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from server import MAIN_MENU_MARKUP, PRICING_MENU_MARKUP, PRICING_TEXT, render_json
+
+
+def legacy_main_menu() -> dict:
+    """Прежний create_main_menu: клавиатура собирается заново на каждый вызов"""
+    keyboard = [
+        [
+            {"text": "🔍 Поиск", "callback_data": "menu_search"},
+            {"text": "👤 Профиль", "callback_data": "menu_profile"}
+        ],
+        [
+            {"text": "💰 Баланс", "callback_data": "menu_balance"},
+            {"text": "🛒 Тарифы", "callback_data": "menu_pricing"}
+        ],
+        [
+            {"text": "🔗 Рефералы", "callback_data": "menu_referral"},
+            {"text": "❓ Помощь", "callback_data": "menu_help"}
+        ],
+        [
+            {"text": "📋 Правила", "callback_data": "menu_rules"},
+            {"text": "💎 Купить поиск (25₽)", "callback_data": "buy_single_search"}
+        ]
+    ]
+    return {"inline_keyboard": keyboard}
+
+
+def legacy_pricing_menu() -> dict:
+    """Прежний create_pricing_menu"""
+    return {
+        "inline_keyboard": [
+            [
+                {"text": "📅 1д (149₽)", "callback_data": "buy_day_sub"},
+                {"text": "📅 3д (299₽)", "callback_data": "buy_3days_sub"}
+            ],
+            [
+                {"text": "📅 1мес (1700₽)", "callback_data": "buy_month_sub"}
+            ],
+            [
+                {"text": "◀️ Назад", "callback_data": "back_to_menu"}
+            ]
+        ]
+    }
+
+
+def legacy_pricing_text() -> str:
+    """Прежняя сборка текста тарифов построчной конкатенацией"""
+    pricing_text = f"🛒 *ТАРИФЫ И ПОДПИСКИ*\n\n"
+    pricing_text += f"💎 *РАЗОВЫЕ ПОИСКИ:*\n"
+    pricing_text += f"🔍 1 поиск = 25 ₽\n"
+    pricing_text += f"💡 Идеально для разового использования\n\n"
+    pricing_text += f"⭐ *ВЫГОДНЫЕ ПОДПИСКИ*:\n\n"
+    pricing_text += f"📅 *1 ДЕНЬ - 149 ₽*\n"
+    pricing_text += f"• До 12 поисков в день\n"
+    pricing_text += f"• Экономия: 151 ₽ (по сравнению с разовыми)\n"
+    pricing_text += f"• Цена за поиск: ~12₽\n\n"
+    pricing_text += f"📅 *3 ДНЯ - 299 ₽* 🔥\n"
+    pricing_text += f"• До 36 поисков за 3 дня\n"
+    pricing_text += f"• Экономия: 601 ₽\n"
+    pricing_text += f"• Цена за поиск: ~8₽\n\n"
+    pricing_text += f"📅 *1 МЕСЯЦ - 1700 ₽* 💎\n"
+    pricing_text += f"• До 360 поисков за месяц\n"
+    pricing_text += f"• Экономия: 7300 ₽\n"
+    pricing_text += f"• Цена за поиск: ~5₽\n\n"
+    pricing_text += f"🎁 *БЕСПЛАТНО:*\n"
+    pricing_text += f"• Приглашайте друзей и получайте бесплатные поиски!\n"
+    pricing_text += f"• 1 одобренный реферал = 1 бесплатная попытка\n\n"
+    pricing_text += f"💡 *Чем больше тариф, тем больше экономия!*"
+    return pricing_text
+
+
+def legacy_updates():
+    """Главное меню + тарифы, как раньше (httpx json= -> json.dumps)"""
+    main = {"chat_id": 123456789, "text": "🎯 *СЕРВИС УЗРИ*", "parse_mode": "Markdown",
+            "reply_markup": legacy_main_menu()}
+    pricing = {"chat_id": 123456789, "text": legacy_pricing_text(), "parse_mode": "Markdown",
+               "reply_markup": legacy_pricing_menu()}
+    return json.dumps(main).encode(), json.dumps(pricing).encode()
+
+
+def template_updates():
+    """Главное меню + тарифы из готовых шаблонов"""
+    main = {"chat_id": 123456789, "text": "🎯 *СЕРВИС УЗРИ*", "parse_mode": "Markdown",
+            "reply_markup": MAIN_MENU_MARKUP}
+    pricing = {"chat_id": 123456789, "text": PRICING_TEXT, "parse_mode": "Markdown",
+               "reply_markup": PRICING_MENU_MARKUP}
+    return render_json(main), render_json(pricing)
+
+
+def check_equivalence() -> int:
+    """Оба пути должны давать одинаковые payload после декодирования"""
+    errors = 0
+    for legacy, template in zip(legacy_updates(), template_updates()):
+        if json.loads(legacy) != json.loads(template):
+            errors += 1
+    if errors:
+        print(f"❌ Шаблоны расходятся с прежней сборкой: {errors}")
+    else:
+        print("✅ Шаблоны совпадают с прежней сборкой")
+    return errors
+
+
+def measure(func, iterations: int) -> float:
+    """Микросекунд на апдейт (пара меню)"""
+    seconds = min(timeit.repeat(func, number=iterations, repeat=3))
+    return seconds / iterations * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк подготовки статических меню")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    errors = check_equivalence()
+
+    legacy_us = measure(legacy_updates, args.iterations)
+    template_us = measure(template_updates, args.iterations)
+    legacy_size = sum(len(body) for body in legacy_updates())
+    template_size = sum(len(body) for body in template_updates())
+    print(f"🐢 прежняя сборка: {legacy_us:.1f} мкс/апдейт, {legacy_size} байт")
+    print(f"⚡ шаблоны: {template_us:.1f} мкс/апдейт, {template_size} байт")
+    print(f"📊 Экономия CPU: {legacy_us - template_us:.1f} мкс/апдейт (x{legacy_us / template_us:.2f})")
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк определения типа поиска
+
+Измеряет пропускную способность classify_search_query на размеченном корпусе
+из tests/test_classifier.py в сравнении с прежней реализацией
+detect_search_type. Точность по корпусу проверяют тесты (pytest).
+
+Запуск:
+  python benchmarks/search_type_benchmark.py [--iterations N] [--min-qps N]
+"""
+
+import argparse
+import re
+import sys
+import timeit
+from pathlib import Path
+
+# Добавляем путь к backend и к корню репозитория (корпус лежит в tests)
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR / 'backend'))
+sys.path.insert(0, str(ROOT_DIR))
+
+from server import classify_search_query
+from tests.test_classifier import ADDRESS, CAR, CORPUS, EMAIL, FULL_NAME, GENERAL, IP, NICKNAME, PHONE
+
+
+def legacy_detect_search_type(query: str) -> str:
+    """Прежняя реализация detect_search_type (для сравнения скорости)"""
+    query = query.strip()
+
+    phone_patterns = [
+        r'^\+?[7-8]\d{10}$',
+        r'^\+?\d{10,15}$',
+        r'^[7-8]\(\d{3}\)\d{3}-?\d{2}-?\d{2}$'
+    ]
+
+    for pattern in phone_patterns:
+        if re.match(pattern, query.replace(' ', '').replace('-', '').replace('(', '').replace(')', '')):
+            return PHONE
+
+    if re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', query):
+        return EMAIL
+
+    if re.match(r'^[АВЕКМНОРСТУХ]\d{3}[АВЕКМНОРСТУХ]{2}\d{2,3}$', query.upper().replace(' ', '')):
+        return CAR
+
+    if query.startswith('@') or re.match(r'^[a-zA-Z0-9_]+$', query):
+        return NICKNAME
+
+    if re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', query):
+        return IP
+
+    address_keywords = ['улица', 'ул', 'проспект', 'пр', 'переулок', 'пер', 'дом', 'д', 'квартира', 'кв']
+    if any(keyword in query.lower() for keyword in address_keywords):
+        return ADDRESS
+
+    words = query.split()
+    if 2 <= len(words) <= 3 and all(re.match(r'^[а-яА-ЯёЁa-zA-Z]+$', word) for word in words):
+        return FULL_NAME
+
+    return GENERAL
+
+
+def measure(func, iterations: int) -> float:
+    """Запросов в секунду на всем корпусе"""
+    queries = [query for query, _, _ in CORPUS]
+
+    def run():
+        for query in queries:
+            func(query)
+
+    seconds = min(timeit.repeat(run, number=iterations, repeat=3))
+    return len(queries) * iterations / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк определения типа поиска")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--min-qps", type=float, default=0, help="Минимально допустимая скорость, запросов/с")
+    args = parser.parse_args()
+
+    new_qps = measure(classify_search_query, args.iterations)
+    legacy_qps = measure(legacy_detect_search_type, args.iterations)
+    print(f"⚡ classify_search_query: {new_qps:,.0f} запросов/с")
+    print(f"🐢 прежний detect_search_type: {legacy_qps:,.0f} запросов/с")
+    print(f"📊 Ускорение: x{new_qps / legacy_qps:.2f}")
+
+    if args.min_qps and new_qps < args.min_qps:
+        print(f"❌ Скорость ниже порога {args.min_qps:,.0f} запросов/с")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Обслуживание базы данных бота УЗРИ
+
+Команды:
+  indexes  - создать/обновить все индексы коллекций
+  explain  - проверить планы запросов и найти COLLSCAN
+  payloads - перенести ответы usersbox из searches в search_payloads
+  counters - пересчитать счетчики пользователей (поиски, рефералы)
+"""
+
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+# Добавляем путь к backend
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+import server
+from pymongo import UpdateOne
+
+MIGRATION_BATCH_SIZE = 500
+
+
+async def create_indexes():
+    """Создает индексы всех коллекций"""
+    await server.ensure_indexes()
+    for collection in sorted({collection for collection, _, _ in server.MONGO_INDEXES}):
+        indexes = await server.db[collection].index_information()
+        print(f"📁 {collection}:")
+        for name, info in indexes.items():
+            unique = " (unique)" if info.get('unique') else ""
+            print(f"   🔑 {name}{unique}")
+    print("\n✅ Индексы созданы")
+    return 0
+
+
+async def explain_queries():
+    """Проверяет планы запросов"""
+    report = await server.audit_query_plans()
+    collscans = 0
+    for entry in report:
+        status = "❌ COLLSCAN" if entry['collscan'] else "✅"
+        print(f"{status} {entry['collection']}.{entry['operation']} {entry['filter']}")
+        print(f"   📊 {' <- '.join(entry['stages'])}")
+        collscans += entry['collscan']
+    print(f"\n📊 Запросов: {len(report)}, COLLSCAN: {collscans}")
+    return 1 if collscans else 0
+
+
+async def migrate_search_payloads():
+    """Переносит ответы usersbox из searches в search_payloads"""
+    await server.ensure_indexes()
+    cursor = server.db.searches.find(
+        {"results": {"$exists": True}},
+        {"query": 1, "normalized_query": 1, "results": 1, "timestamp": 1}
+    )
+    migrated = 0
+    batch = []
+    async for search in cursor:
+        results = search.get('results') or {}
+        normalized_query = search.get('normalized_query') or server.normalize_search_query(search.get('query', ''))
+        results_ref = None
+        if results.get('status') == 'success':
+            # Ответы с ошибкой просто удаляются - хранятся только результаты
+            results_ref = await server.store_search_payload(normalized_query, results, search.get('timestamp'))
+        batch.append(UpdateOne(
+            {"_id": search['_id']},
+            {
+                "$set": {"results_ref": results_ref, "results_count": (results.get('data') or {}).get('count', 0)},
+                "$unset": {"results": ""}
+            }
+        ))
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            await server.db.searches.bulk_write(batch, ordered=False)
+            migrated += len(batch)
+            batch = []
+            print(f"📦 Перенесено: {migrated}")
+    if batch:
+        await server.db.searches.bulk_write(batch, ordered=False)
+        migrated += len(batch)
+
+    payloads = await server.db.search_payloads.count_documents({})
+    print(f"\n✅ Перенесено поисков: {migrated}, уникальных ответов: {payloads}")
+    print("💡 Чтобы вернуть место на диске, выполните compact для коллекции searches")
+    return 0
+
+
+async def reconcile_counters():
+    """Пересчитывает счетчики поисков и рефералов в профилях"""
+    updated = await server.reconcile_user_counters()
+    await server.reconcile_stats()
+    print(f"✅ Счетчики пересчитаны: {updated} пользователей")
+    return 0
+
+
+COMMANDS = {
+    "indexes": create_indexes,
+    "explain": explain_queries,
+    "payloads": migrate_search_payloads,
+    "counters": reconcile_counters,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных УЗРИ")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    try:
+        return asyncio.run(COMMANDS[args.command]())
+    finally:
+        server.client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
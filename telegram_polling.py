@@ -1,79 +1,197 @@
 #!/usr/bin/env python3
+"""
+Получение обновлений Telegram через long polling
+
+Запасной вариант, когда вебхук недоступен. Обновления забираются пачками
+(getUpdates, limit до 100, long polling на стороне Telegram) и
+обрабатываются параллельно через server.update_queue: разные чаты
+одновременно, обновления одного чата - строго по порядку.
+
+Offset подтверждается только после обработки: в запрос уходит id самого
+раннего еще не обработанного обновления, поэтому при падении процесса
+необработанные обновления придут повторно. Обновление, которое
+обрабатывается дольше POLLING_STUCK_TIMEOUT, перестает держать offset (с
+предупреждением в логе): иначе одно зависшее обновление остановило бы прием
+после limit следующих. Останавливается по SIGTERM/SIGINT, дожидаясь
+обработки уже полученных обновлений.
+
+Запуск:
+  python telegram_polling.py
+"""
 
 import asyncio
-import requests
-import json
-import sys
 import os
+import signal
+import sys
+import time
 from pathlib import Path
 
 # Добавляем путь к backend
-sys.path.insert(0, '/app/backend')
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+import server
+
+POLLING_LIMIT = int(os.environ.get('POLLING_LIMIT', '100'))
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', '50'))  # Long polling на стороне Telegram, секунд
+POLLING_BACKOFF_MIN = float(os.environ.get('POLLING_BACKOFF_MIN', '1'))
+POLLING_BACKOFF_MAX = float(os.environ.get('POLLING_BACKOFF_MAX', '60'))
+POLLING_PROGRESS_WAIT = 0.5  # Пауза, когда Telegram вернул только обновления в обработке
+POLLING_SHUTDOWN_TIMEOUT = float(os.environ.get('POLLING_SHUTDOWN_TIMEOUT', '30'))
+POLLING_STUCK_TIMEOUT = float(os.environ.get('POLLING_STUCK_TIMEOUT', '300'))  # После этого offset идет дальше
+
 
-# Импортируем настройки
-from dotenv import load_dotenv
-load_dotenv('/app/backend/.env')
+class UpdateOffsetTracker:
+    """Считает offset для getUpdates по обработанным обновлениям"""
 
-TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
+    def __init__(self, stuck_timeout: float = POLLING_STUCK_TIMEOUT):
+        self.in_flight = {}  # update_id -> время начала обработки
+        self.stuck = set()  # Обрабатываются слишком долго и не держат offset
+        self.stuck_timeout = stuck_timeout
+        self.last_seen = None
+        self.progress = asyncio.Event()
+
+    @property
+    def offset(self):
+        """Первое обновление, которое еще не обработано (кроме зависших)"""
+        waiting = self.in_flight.keys() - self.stuck
+        if waiting:
+            return min(waiting)
+        return self.last_seen + 1 if self.last_seen is not None else None
+
+    @property
+    def waiting(self) -> bool:
+        """Есть обновления в обработке, которые держат offset"""
+        return len(self.in_flight) > len(self.stuck)
+
+    def release_stuck(self, now: float = None):
+        """Перестает держать offset на обновлениях дольше stuck_timeout"""
+        now = time.monotonic() if now is None else now
+        for update_id, started_at in self.in_flight.items():
+            if update_id not in self.stuck and now - started_at >= self.stuck_timeout:
+                self.stuck.add(update_id)
+                print(f"⚠️ Обновление {update_id} обрабатывается дольше {self.stuck_timeout:.0f}с - "
+                      f"подтверждаем offset дальше, при падении процесса оно не придет повторно")
+
+    def is_new(self, update_id: int) -> bool:
+        return self.last_seen is None or update_id > self.last_seen
+
+    def started(self, update_id: int):
+        self.in_flight[update_id] = time.monotonic()
+        self.last_seen = update_id if self.last_seen is None else max(self.last_seen, update_id)
+
+    def finished(self, update_id: int):
+        offset = self.offset
+        self.in_flight.pop(update_id, None)
+        self.stuck.discard(update_id)
+        if self.offset != offset:
+            self.progress.set()
+
+    async def wait_progress(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.progress.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-# Импортируем функцию обработки
-from server import handle_telegram_update
 
-async def get_updates(offset=None):
+async def get_updates(offset, timeout: int, limit: int = POLLING_LIMIT):
     """Получить обновления от Telegram"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
-    params = {
-        "timeout": 10,
-        "limit": 10
-    }
-    if offset:
+    params = {"timeout": timeout, "limit": limit}
+    if offset is not None:
         params["offset"] = offset
-    
+    # HTTP-таймаут больше серверного, иначе long polling оборвется раньше ответа
+    return await server.telegram_request("getUpdates", params, timeout=timeout + server.TELEGRAM_TIMEOUT)
+
+
+async def sleep_or_stop(stop: asyncio.Event, delay: float):
     try:
-        response = requests.get(url, params=params, timeout=15)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            print(f"❌ Ошибка получения обновлений: {response.status_code}")
-            return None
-    except Exception as e:
-        print(f"❌ Исключение при получении обновлений: {e}")
+        await asyncio.wait_for(stop.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+def dispatch_update(update, tracker: UpdateOffsetTracker):
+    """Передает обновление в очередь обработки"""
+    update_id = update['update_id']
+    tracker.started(update_id)
+    if server.update_queue.submit(update, on_done=lambda _: tracker.finished(update_id)):
         return None
+    # Очередь переполнена - обрабатываем сразу, притормаживая получение
+    return update_id
 
-async def poll_updates():
+
+async def poll_updates(stop: asyncio.Event):
     """Polling обновлений от Telegram"""
-    print("🤖 Запуск Telegram polling...")
-    offset = None
-    
-    while True:
-        try:
-            result = await get_updates(offset)
-            
-            if result and result.get('ok'):
-                updates = result.get('result', [])
-                
-                for update in updates:
-                    update_id = update.get('update_id')
-                    offset = update_id + 1
-                    
-                    print(f"📨 Получено обновление {update_id}")
-                    
-                    # Обрабатываем обновление
-                    try:
-                        await handle_telegram_update(update)
-                        print(f"✅ Обновление {update_id} обработано")
-                    except Exception as e:
-                        print(f"❌ Ошибка обработки обновления {update_id}: {e}")
-            
-            await asyncio.sleep(1)  # Небольшая пауза между запросами
-            
-        except KeyboardInterrupt:
-            print("🛑 Остановка polling...")
+    print(f"🤖 Запуск Telegram polling (limit={POLLING_LIMIT}, timeout={POLLING_TIMEOUT}s, "
+          f"воркеров: {server.update_queue.workers})...")
+    tracker = UpdateOffsetTracker()
+    backoff = POLLING_BACKOFF_MIN
+
+    while not stop.is_set():
+        tracker.progress.clear()
+        tracker.release_stuck()
+        # Пока есть обновления в обработке, Telegram сразу вернет их снова - ждать на сервере нечего
+        timeout = 0 if tracker.waiting else POLLING_TIMEOUT
+        request = asyncio.create_task(get_updates(tracker.offset, timeout))
+        stopped = asyncio.create_task(stop.wait())
+        await asyncio.wait({request, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+        if not request.done():
+            request.cancel()
             break
-        except Exception as e:
-            print(f"❌ Ошибка в polling: {e}")
-            await asyncio.sleep(5)  # Пауза при ошибке
+
+        result = request.result()
+        if not result.get('ok'):
+            print(f"❌ Ошибка получения обновлений: {result.get('error_code')} - {result.get('description')}, "
+                  f"повтор через {backoff:.0f}с")
+            if result.get('error_code') == 409:
+                print("💡 Для бота установлен вебхук - polling работает только без него (deleteWebhook)")
+            await sleep_or_stop(stop, backoff)
+            backoff = min(backoff * 2, POLLING_BACKOFF_MAX)
+            continue
+        backoff = POLLING_BACKOFF_MIN
+
+        new_updates = 0
+        for update in result.get('result', []):
+            if not tracker.is_new(update['update_id']):
+                continue
+            new_updates += 1
+            overflow_id = dispatch_update(update, tracker)
+            if overflow_id is not None:
+                try:
+                    await server.process_telegram_update(update)
+                except Exception as e:
+                    print(f"❌ Ошибка обработки обновления {overflow_id}: {e}")
+                tracker.finished(overflow_id)
+
+        if not new_updates and tracker.waiting:
+            # Пришли только обновления, которые еще обрабатываются - ждем сдвига offset
+            await tracker.wait_progress(POLLING_PROGRESS_WAIT)
+
+    print("🛑 Остановка polling, ждем обработки полученных обновлений...")
+    await server.update_queue.stop(timeout=POLLING_SHUTDOWN_TIMEOUT)
+    if tracker.offset is not None:
+        # Подтверждаем обработанные обновления, чтобы они не пришли повторно
+        await get_updates(tracker.offset, timeout=0, limit=1)
+    if tracker.waiting:
+        print(f"⚠️ Не обработано {len(tracker.in_flight) - len(tracker.stuck)} обновлений - они придут повторно при следующем запуске")
+    if tracker.stuck:
+        print(f"⚠️ Не завершились зависшие обновления {sorted(tracker.stuck)} - повторно они не придут")
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    await server.startup_background_services()
+    try:
+        await poll_updates(stop)
+    finally:
+        await server.shutdown_db_client()
+    print("✅ Polling остановлен")
+
 
 if __name__ == "__main__":
-    print(f"🔑 Token: {TELEGRAM_TOKEN[:10]}..." if TELEGRAM_TOKEN else "❌ Token не найден")
-    asyncio.run(poll_updates())
\ No newline at end of file
+    print(f"🔑 Token: {server.TELEGRAM_TOKEN[:10]}..." if server.TELEGRAM_TOKEN else "❌ Token не найден")
+    asyncio.run(main())
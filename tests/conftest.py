@@ -0,0 +1,141 @@
+"""
+Общие фикстуры тестов backend/server.py
+
+server.py импортируется без MongoDB и внешних сервисов: переменные окружения
+заполняются заглушками, а db подменяется FakeDatabase - in-memory коллекциями
+с тем подмножеством API Motor, которое используют тестируемые функции.
+"""
+
+import itertools
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+for name, value in {
+    "MONGO_URL": "mongodb://localhost:27017",
+    "DB_NAME": "test_db",
+    "TELEGRAM_TOKEN": "test-token",
+    "WEBHOOK_SECRET": "test-secret",
+    "USERSBOX_TOKEN": "test-token",
+    "USERSBOX_BASE_URL": "http://usersbox.invalid",
+    "CRYPTOBOT_TOKEN": "test-token",
+    "CRYPTOBOT_BASE_URL": "http://cryptobot.invalid",
+    "ADMIN_USERNAME": "admin",
+    "ADMIN_TELEGRAM_ID": "1",
+    "REQUIRED_CHANNEL": "@test_channel",
+}.items():
+    os.environ.setdefault(name, value)
+
+from pymongo.errors import DuplicateKeyError
+
+import server
+
+
+class Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op == "$lt" and not (value is not None and value < operand):
+                    return False
+                if op == "$ne" and value == operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCollection:
+    """In-memory коллекция: уникальные поля, $set/$inc и внедрение ошибок"""
+
+    def __init__(self, unique=()):
+        self.documents = []
+        self.unique = ("_id",) + tuple(unique)
+        self.failures = {}  # Имя метода -> исключение для следующего вызова
+        self.ids = itertools.count(1)
+
+    def fail_next(self, method: str, error: Exception):
+        self.failures[method] = error
+
+    def _check_failure(self, method: str):
+        error = self.failures.pop(method, None)
+        if error is not None:
+            raise error
+
+    def _find(self, query: dict):
+        return next((document for document in self.documents if matches(document, query)), None)
+
+    @staticmethod
+    def _apply(document: dict, update: dict):
+        document.update(update.get("$set", {}))
+        for key, amount in update.get("$inc", {}).items():
+            document[key] = document.get(key, 0) + amount
+
+    async def insert_one(self, document: dict):
+        self._check_failure("insert_one")
+        document = dict(document)
+        document.setdefault("_id", next(self.ids))
+        for key in self.unique:
+            if document.get(key) is not None and self._find({key: document[key]}) is not None:
+                raise DuplicateKeyError(f"duplicate {key}")
+        self.documents.append(document)
+        return Result(inserted_id=document["_id"])
+
+    async def find_one(self, query: dict, projection=None):
+        self._check_failure("find_one")
+        document = self._find(query)
+        return dict(document) if document is not None else None
+
+    async def find_one_and_update(self, query: dict, update: dict, **kwargs):
+        self._check_failure("find_one_and_update")
+        document = self._find(query)
+        if document is None:
+            return None
+        before = dict(document)
+        self._apply(document, update)
+        return before
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        self._check_failure("update_one")
+        document = self._find(query)
+        if document is None:
+            return Result(matched_count=0, modified_count=0)
+        self._apply(document, update)
+        return Result(matched_count=1, modified_count=1)
+
+    async def delete_one(self, query: dict):
+        self._check_failure("delete_one")
+        document = self._find(query)
+        if document is not None:
+            self.documents.remove(document)
+        return Result(deleted_count=int(document is not None))
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        return Result(bulk_api_result={})
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.payments = FakeCollection(unique=("payment_id",))
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        collection = FakeCollection()
+        setattr(self, name, collection)
+        return collection
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    server.processed_updates_cache.clear()
+    return database
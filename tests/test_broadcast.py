@@ -0,0 +1,50 @@
+import asyncio
+
+import httpx
+
+import server
+
+
+def test_bulk_sends_wait_for_queue_capacity(monkeypatch):
+    async def fake_http_request(service, method, path, **kwargs):
+        await asyncio.sleep(0.001)
+        return httpx.Response(200, json={"ok": True, "result": {"message_id": 1}})
+
+    monkeypatch.setattr(server, "http_request", fake_http_request)
+
+    async def scenario():
+        dispatcher = server.TelegramDispatcher(workers=2, max_pending=3, rate=1000, chat_interval=0, max_retries=0)
+        dispatcher.start()
+        results = await asyncio.gather(*[
+            dispatcher.call("sendMessage", {}, chat_id=index, priority=server.PRIORITY_BULK) for index in range(20)
+        ])
+        await dispatcher.stop(timeout=1)
+        return dispatcher, results
+
+    dispatcher, results = asyncio.run(scenario())
+    assert all(result["ok"] for result in results)
+    assert dispatcher.sent == 20
+    assert dispatcher.dropped == {"retries": 0, "shutdown": 0}
+
+
+def test_broadcast_batch_retries_unsent_messages(fake_db, monkeypatch):
+    responses = {
+        1: [{"ok": True}],
+        2: [server.telegram_error("Dispatcher stopped"), {"ok": True}],
+        3: [{"ok": False, "error_code": 502, "description": "Bad Gateway"}, {"ok": True}],
+        4: [{"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}],
+        5: [{"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}],
+    }
+    sent_to = []
+
+    async def fake_telegram_request(method, payload=None, **kwargs):
+        sent_to.append(payload["chat_id"])
+        return responses[payload["chat_id"]].pop(0)
+
+    monkeypatch.setattr(server, "telegram_request", fake_telegram_request)
+    monkeypatch.setattr(server, "BROADCAST_RETRY_DELAY", 0)
+
+    statuses = asyncio.run(server.send_broadcast_batch([1, 2, 3, 4, 5], "hello"))
+
+    assert statuses == ["sent", "sent", "sent", "failed", "blocked"]
+    assert sorted(sent_to) == [1, 2, 2, 3, 3, 4, 5]
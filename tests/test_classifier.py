@@ -0,0 +1,62 @@
+import pytest
+
+from server import classify_search_query, detect_search_type, normalize_search_query
+
+PHONE = "📱 Телефон"
+EMAIL = "📧 Email"
+CAR = "🚗 Автомобиль"
+NICKNAME = "🆔 Никнейм"
+IP = "🌐 IP-адрес"
+ADDRESS = "🏠 Адрес"
+FULL_NAME = "👤 ФИО"
+GENERAL = "🔍 Общий поиск"
+
+# (запрос, ожидаемый тип, ожидаемый нормализованный запрос)
+CORPUS = [
+    ("+79123456789", PHONE, "+79123456789"),
+    ("89123456789", PHONE, "89123456789"),
+    ("+7 (912) 345-67-89", PHONE, "+79123456789"),
+    ("8 912 345 67 89", PHONE, "89123456789"),
+    ("  +380 44 123 4567 ", PHONE, "+380441234567"),
+    ("user@mail.ru", EMAIL, "user@mail.ru"),
+    ("Admin.Site@Example.COM", EMAIL, "admin.site@example.com"),
+    ("first_last+tag@gmail.com", EMAIL, "first_last+tag@gmail.com"),
+    ("А123ВС777", CAR, "А123ВС777"),
+    ("в456ор 199", CAR, "В456ОР199"),
+    ("Е001КХ 50", CAR, "Е001КХ50"),
+    ("@username", NICKNAME, "@username"),
+    ("@Durov", NICKNAME, "@durov"),
+    ("nickname", NICKNAME, "nickname"),
+    ("John_Doe_1990", NICKNAME, "john_doe_1990"),
+    ("12345", NICKNAME, "12345"),
+    ("192.168.1.1", IP, "192.168.1.1"),
+    ("8.8.8.8", IP, "8.8.8.8"),
+    ("улица Ленина дом 5", ADDRESS, "улица ленина дом 5"),
+    ("ул. Тверская, д. 7, кв. 12", ADDRESS, "ул. тверская, д. 7, кв. 12"),
+    ("Невский проспект 28", ADDRESS, "невский проспект 28"),
+    ("пер. Столярный 5", ADDRESS, "пер. столярный 5"),
+    ("Москва, пр Мира д 10", ADDRESS, "москва, пр мира д 10"),
+    ("Иван Петров", FULL_NAME, "иван петров"),
+    ("Иван Петров Сергеевич", FULL_NAME, "иван петров сергеевич"),
+    ("Дмитрий Иванов", FULL_NAME, "дмитрий иванов"),
+    ("Анна  Сергеевна", FULL_NAME, "анна сергеевна"),
+    ("Пётр Дроздов", FULL_NAME, "пётр дроздов"),
+    ("John Smith", FULL_NAME, "john smith"),
+    ("Иванов", GENERAL, "иванов"),
+    ("Иванов Иван Иванович Младший", GENERAL, "иванов иван иванович младший"),
+    ("что-то странное, 42", GENERAL, "что-то странное, 42"),
+    ("ООО Ромашка 2020", GENERAL, "ооо ромашка 2020"),
+]
+
+
+@pytest.mark.parametrize("query, expected_type, expected_normalized", CORPUS)
+def test_classify_search_query(query, expected_type, expected_normalized):
+    result = classify_search_query(query)
+
+    assert (result.search_type, result.normalized) == (expected_type, expected_normalized)
+
+
+def test_detect_search_type_matches_classifier():
+    for query, expected_type, expected_normalized in CORPUS:
+        assert detect_search_type(query) == expected_type
+        assert normalize_search_query(query) == expected_normalized
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def user(fake_db):
+    run(fake_db.users.insert_one({"telegram_id": 42, "balance": 0}))
+    return fake_db.users.documents[0]
+
+
+def stars_payment(amount: float = 100) -> server.Payment:
+    return server.Payment(user_id=42, amount=amount, payment_type="stars", payment_id="charge-1")
+
+
+def test_payment_is_credited_once(fake_db, user):
+    assert run(server.credit_payment(stars_payment())) is True
+    assert run(server.credit_payment(stars_payment())) is False
+
+    assert user["balance"] == 100
+    assert fake_db.payments.documents[0]["status"] == "completed"
+
+
+def test_replay_finishes_payment_left_pending(fake_db, user):
+    # Первая доставка упала сразу после вставки платежа
+    run(fake_db.payments.insert_one(stars_payment().dict()))
+
+    assert run(server.credit_payment(stars_payment())) is True
+    assert run(server.credit_payment(stars_payment())) is False
+
+    assert user["balance"] == 100
+    assert fake_db.payments.documents[0]["status"] == "completed"
+
+
+def test_payment_being_credited_is_not_credited_again(fake_db, user):
+    run(fake_db.payments.insert_one({**stars_payment().dict(), "status": "crediting"}))
+
+    assert run(server.credit_payment(stars_payment())) is False
+    assert user["balance"] == 0
+
+
+def test_payment_for_unknown_user_fails(fake_db):
+    assert run(server.credit_payment(stars_payment())) is False
+    assert fake_db.payments.documents[0]["status"] == "failed"
+
+
+def test_stars_amount_is_read_from_amount_field():
+    assert server.stars_payment_amount("stars_payment_123456789_500", 250) == 500
+    assert server.stars_payment_amount("stars_payment_123456789_1500.0", 750) == 1500
+    assert server.stars_payment_amount("stars_payment_broken", 250) == 500
+
+
+def test_successful_stars_payment_credits_ruble_amount(fake_db, user, monkeypatch):
+    async def send_telegram_message(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr(server, "send_telegram_message", send_telegram_message)
+    message = {
+        "from": {"id": 42},
+        "chat": {"id": 42},
+        "successful_payment": {
+            "currency": "XTR",
+            "total_amount": 250,
+            "invoice_payload": "stars_payment_42_500",
+            "telegram_payment_charge_id": "charge-2",
+        },
+    }
+
+    run(server.handle_successful_payment(message))
+    run(server.handle_successful_payment(message))
+
+    assert user["balance"] == 500
@@ -0,0 +1,36 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram_polling import UpdateOffsetTracker
+
+
+def test_offset_waits_for_earliest_unfinished_update():
+    tracker = UpdateOffsetTracker(stuck_timeout=60)
+    for update_id in (1, 2, 3):
+        tracker.started(update_id)
+    tracker.finished(2)
+
+    assert tracker.offset == 1
+    tracker.finished(1)
+    assert tracker.offset == 3
+
+
+def test_stuck_update_stops_holding_offset(capsys):
+    tracker = UpdateOffsetTracker(stuck_timeout=60)
+    tracker.started(1)
+    tracker.started(2)
+    tracker.finished(2)
+
+    tracker.release_stuck(time.monotonic() + 30)
+    assert tracker.offset == 1
+
+    tracker.release_stuck(time.monotonic() + 61)
+    assert tracker.offset == 3
+    assert not tracker.waiting
+    assert "Обновление 1" in capsys.readouterr().out
+
+    tracker.finished(1)
+    assert tracker.in_flight == {} and tracker.stuck == set()
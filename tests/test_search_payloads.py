@@ -0,0 +1,23 @@
+import server
+
+
+def test_payload_round_trip_with_configured_codec():
+    ref, raw = server.encode_search_payload("иванов", {"status": "success", "data": {"count": 1}})
+    codec = server.search_payload_codec()
+    payload = {"codec": codec, "data": server.SEARCH_PAYLOAD_CODECS[codec][0](raw)}
+
+    assert server.decode_search_payload(payload) == {"status": "success", "data": {"count": 1}}
+
+
+def test_unavailable_codec_falls_back_to_zlib(monkeypatch, caplog):
+    monkeypatch.setattr(server, "SEARCH_PAYLOAD_CODEC", "brotli")
+    server.search_payload_codec.cache_clear()
+    try:
+        assert server.search_payload_codec() == "zlib"
+        assert server.search_payload_codec() == "zlib"
+    finally:
+        server.search_payload_codec.cache_clear()
+
+    assert [record.message for record in caplog.records].count(
+        "Search payload codec 'brotli' is not available, storing payloads with zlib"
+    ) == 1
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def search(fake_db, monkeypatch):
+    """Поиск за баланс: Usersbox и Telegram подменены, возвращается документ пользователя"""
+    run(fake_db.users.insert_one({"telegram_id": 42, "balance": 0}))
+    user = server.User(telegram_id=42, referral_code="ref42", is_admin=True)
+
+    async def reserve_search(user):
+        return True, "balance"
+
+    async def search_usersbox(query, normalized_query=None):
+        return {"status": "success", "data": {"count": 1, "items": []}}
+
+    async def send(*args, **kwargs):
+        return True
+
+    async def store_search_payload(normalized_query, results):
+        return "ref"
+
+    async def increment_stats(counters):
+        pass
+
+    monkeypatch.setattr(server, "reserve_search", reserve_search)
+    monkeypatch.setattr(server, "search_usersbox", search_usersbox)
+    monkeypatch.setattr(server, "render_search_results", lambda *args: None)
+    monkeypatch.setattr(server, "send_search_reply", send)
+    monkeypatch.setattr(server, "send_telegram_message", send)
+    monkeypatch.setattr(server, "store_search_payload", store_search_payload)
+    monkeypatch.setattr(server, "increment_stats", increment_stats)
+
+    def handle():
+        run(server.handle_search_query(42, "ivan", user))
+        return fake_db.users.documents[0]
+
+    return handle
+
+
+def test_completed_search_is_charged(fake_db, search):
+    assert search()["balance"] == 0
+    assert len(fake_db.searches.documents) == 1
+
+
+def test_unexpected_error_refunds_reservation(fake_db, search):
+    fake_db.searches.fail_next("insert_one", RuntimeError("mongo down"))
+
+    assert search()["balance"] == server.SEARCH_COST
+
+
+def test_unexpected_error_after_refund_does_not_refund_twice(fake_db, search, monkeypatch):
+    async def send_search_reply(chat_id, reply):
+        return False
+
+    monkeypatch.setattr(server, "send_search_reply", send_search_reply)
+    fake_db.searches.fail_next("insert_one", RuntimeError("mongo down"))
+
+    assert search()["balance"] == server.SEARCH_COST
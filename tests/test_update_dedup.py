@@ -0,0 +1,82 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import server
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    calls = []
+
+    async def handler(update_data):
+        calls.append(update_data["update_id"])
+        if update_data.get("fail"):
+            raise RuntimeError("handler failed")
+
+    monkeypatch.setattr(server, "handle_telegram_update", handler)
+    monkeypatch.setattr(server, "PROCESSED_UPDATES_COMPLETE_BACKOFF", 0)
+    return calls
+
+
+def test_duplicate_delivery_is_handled_once(fake_db, handled):
+    run(server.process_telegram_update({"update_id": 10}))
+    run(server.process_telegram_update({"update_id": 10}))
+
+    assert handled == [10]
+    assert fake_db.processed_updates.documents[0]["status"] == "done"
+
+
+def test_duplicate_from_another_worker_is_skipped(fake_db, handled):
+    run(server.process_telegram_update({"update_id": 11}))
+    server.processed_updates_cache.clear()  # Другой воркер: в его кэше обновления нет
+
+    run(server.process_telegram_update({"update_id": 11}))
+
+    assert handled == [11]
+
+
+def test_insert_failure_does_not_swallow_redelivery(fake_db, handled):
+    fake_db.processed_updates.fail_next("insert_one", AutoReconnect("mongo is down"))
+    with pytest.raises(AutoReconnect):
+        run(server.process_telegram_update({"update_id": 12}))
+
+    run(server.process_telegram_update({"update_id": 12}))
+
+    assert handled == [12]
+
+
+def test_failed_handler_releases_claim(fake_db, handled):
+    with pytest.raises(RuntimeError):
+        run(server.process_telegram_update({"update_id": 13, "fail": True}))
+
+    run(server.process_telegram_update({"update_id": 13}))
+
+    assert handled == [13, 13]
+
+
+def test_expired_lease_is_taken_over(fake_db, handled):
+    now = datetime.utcnow()
+    run(fake_db.processed_updates.insert_one(
+        {"_id": 14, "status": "processing", "lease_until": now + timedelta(seconds=60), "created_at": now}
+    ))
+    run(server.process_telegram_update({"update_id": 14}))
+    assert handled == []
+
+    fake_db.processed_updates.documents[0]["lease_until"] = now - timedelta(seconds=1)
+    run(server.process_telegram_update({"update_id": 14}))
+    assert handled == [14]
+
+
+def test_completion_is_retried(fake_db, handled):
+    fake_db.processed_updates.fail_next("update_one", AutoReconnect("mongo is down"))
+
+    run(server.process_telegram_update({"update_id": 15}))
+
+    assert fake_db.processed_updates.documents[0]["status"] == "done"
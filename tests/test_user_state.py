@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def isolated(fake_db, monkeypatch):
+    # Хранилища тестов регистрируют свой кэш под тем же именем - вернем настоящий
+    monkeypatch.setitem(server.caches, "user_state", server.caches["user_state"])
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def worker_store(backend, invalidated_elsewhere=False):
+    """Хранилище одного воркера поверх общего бэкенда"""
+    return server.UserStateStore(backend, invalidated_elsewhere=invalidated_elsewhere)
+
+
+def test_state_set_on_another_worker_is_seen(monkeypatch):
+    monkeypatch.setattr(server, "USER_STATE_NEGATIVE_CACHE_TTL", 0)
+    backend = server.MemoryUserStateBackend()
+    worker_a, worker_b = worker_store(backend), worker_store(backend)
+
+    assert run(worker_b.get(7)) is None  # "Нет состояния" попадает в кэш воркера B
+    run(worker_a.set(server.UserState(user_id=7, state="awaiting_custom_amount")))
+
+    assert run(worker_b.get(7)).state == "awaiting_custom_amount"
+
+
+def test_state_cleared_on_another_worker_expires_without_cluster_events(monkeypatch):
+    monkeypatch.setattr(server, "USER_STATE_NEGATIVE_CACHE_TTL", 0)
+    backend = server.MemoryUserStateBackend()
+    worker_a, worker_b = worker_store(backend), worker_store(backend)
+
+    run(worker_a.set(server.UserState(user_id=8, state="awaiting_broadcast_message")))
+    assert run(worker_b.get(8)).state == "awaiting_broadcast_message"
+    run(worker_a.clear(8))
+
+    assert run(worker_b.get(8)) is None
+
+
+def test_failed_write_drops_cached_state():
+    class FailingBackend(server.MemoryUserStateBackend):
+        async def clear(self, user_id):
+            raise RuntimeError("backend is down")
+
+    store = worker_store(FailingBackend())
+    run(store.set(server.UserState(user_id=9, state="awaiting_custom_amount")))
+    try:
+        run(store.clear(9))
+    except RuntimeError:
+        pass
+
+    assert store.cache.get(9) is server.CACHE_MISS